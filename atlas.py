@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+
+# Makes an atlas: cuts a large region into a grid of page-sized sheets
+# that overlap a bit, and renders them all.  The sheets get rendered in
+# parallel worker processes.  Before that, the tiles for all the sheets
+# get downloaded into the tile cache in one step, so the tiles along the
+# overlaps are only downloaded once.
+#
+# The result is a multi-page PDF, or one file per sheet.
+
+import os
+import math
+import shutil
+import tempfile
+import argparse
+import concurrent.futures
+import config
+import maplayout
+import chartgeometry
+import chartrenderer
+import paperrenderer
+import tile_provider
+import tilecache
+import tilefetcher
+import seedcache
+import testutils
+from units import *
+from tilecoords import *
+from parsedegrees import *
+from lamaperia import jsonfile
+
+# Portrait sizes in millimeters
+paper_sizes = {
+    "letter" : (inch_to_mm (8.5), inch_to_mm (11)),
+    "legal"  : (inch_to_mm (8.5), inch_to_mm (14)),
+    "ledger" : (inch_to_mm (11), inch_to_mm (17)),
+    "a4"     : (210.0, 297.0),
+    "a3"     : (297.0, 420.0),
+}
+
+default_margin_mm = 10.0
+
+# Room below the map for the map scale indicator
+default_scale_band_mm = 20.0
+
+default_overlap_mm = 10.0
+
+# Returns the JSON keys for a map that fills a sheet of paper, except for
+# the margins and some room for the scale indicator below the map.
+#
+def make_paper_template (paper_width_mm, paper_height_mm, margin_mm = default_margin_mm):
+    map_height_mm = paper_height_mm - margin_mm - default_scale_band_mm
+
+    return {
+        "paper-width"        : float (paper_width_mm),
+        "paper-height"       : float (paper_height_mm),
+        "map-width"          : float (paper_width_mm - 2 * margin_mm),
+        "map-height"         : float (map_height_mm),
+        "map-to-left-margin" : float (margin_mm),
+        "map-to-top-margin"  : float (margin_mm),
+        "scale-xpos"         : float (paper_width_mm / 2.0),
+        "scale-ypos"         : float (margin_mm + map_height_mm + default_scale_band_mm / 4.0),
+    }
+
+# How many tiles at the layout's zoom level fit in one millimeter of
+# paper, for a map centered at latitude lat.
+#
+def compute_tiles_per_mm (layout, lat):
+    return layout.map_scale_denom / compute_real_world_mm_per_tile (lat, layout.zoom)
+
+# Cuts the bounding box into a grid of sheets.  Each sheet is like the
+# template JSON layout, but with its own center.  Adjacent sheets
+# overlap by overlap_mm on the paper.  Returns a list of (row, column,
+# layout_json), with rows from north to south.
+#
+# The map scale depends on latitude, so each row of sheets gets its
+# height in tiles from its own latitude.
+#
+def compute_sheet_layouts (template_json, lat1, lon1, lat2, lon2, overlap_mm = default_overlap_mm):
+    layout = maplayout.MapLayout ()
+    layout.load_from_json (template_json)
+
+    z = layout.zoom
+
+    if overlap_mm >= min (layout.map_width_mm, layout.map_height_mm):
+        raise ValueError ("the overlap between sheets must be smaller than the map")
+
+    (west, north) = coordinates_to_tile_and_fraction (z, max (lat1, lat2), min (lon1, lon2))
+    (east, south) = coordinates_to_tile_and_fraction (z, min (lat1, lat2), max (lon1, lon2))
+
+    sheets = []
+    top = north
+    row = 0
+
+    while True:
+        # The sheet's height depends on the latitude of its center, which
+        # depends on its height; a few iterations are plenty.
+        height = layout.map_height_mm * compute_tiles_per_mm (layout, tile_number_to_coordinates (z, west, top)[0])
+        for i in range (3):
+            (center_lat, unused) = tile_number_to_coordinates (z, west, top + height / 2.0)
+            tiles_per_mm = compute_tiles_per_mm (layout, center_lat)
+            height = layout.map_height_mm * tiles_per_mm
+
+        width = layout.map_width_mm * tiles_per_mm
+        overlap = overlap_mm * tiles_per_mm
+
+        # Center the row of sheets over the bounding box
+        num_columns = max (1, math.ceil ((east - west - overlap) / (width - overlap)))
+        row_width = num_columns * (width - overlap) + overlap
+        left = west - (row_width - (east - west)) / 2.0
+
+        for column in range (num_columns):
+            center_x = left + column * (width - overlap) + width / 2.0
+            (unused, center_lon) = tile_number_to_coordinates (z, center_x, top + height / 2.0)
+
+            sheet_json = dict (template_json)
+            sheet_json["center-lat"] = center_lat
+            sheet_json["center-lon"] = center_lon
+
+            sheets.append ((row, column, sheet_json))
+
+        if top + height >= south:
+            break
+
+        top += height - overlap
+        row += 1
+
+    return sheets
+
+# "atlas.pdf" -> "atlas-02-03.pdf" for the sheet in row 2, column 3
+def make_sheet_filename (filename, row, column):
+    (base, ext) = os.path.splitext (filename)
+    return "{0}-{1:02d}-{2:02d}{3}".format (base, row + 1, column + 1, ext)
+
+# Runs in a worker process.  Renders one sheet to filename, or if
+# filename is None, just makes the sheet's map mosaic so that it is
+# waiting in the mosaic cache.
+#
+def render_sheet (config_data, sheet_json, format, filename, dpi):
+    map_layout = maplayout.MapLayout ()
+    map_layout.load_from_json (sheet_json)
+
+    provider = tile_provider.make_tile_provider (config_data)
+    geometry = chartgeometry.ChartGeometry (map_layout, provider)
+
+    chart_renderer = chartrenderer.ChartRenderer (geometry)
+    chart_renderer.load_config (config_data)
+
+    try:
+        geometry.compute_extents_of_downloaded_tiles ()
+
+        if filename is None:
+            chart_renderer.make_map_mosaic ()
+        else:
+            paper_renderer = paperrenderer.PaperRenderer (map_layout)
+            paper_renderer.render (format, filename, chart_renderer, dpi)
+    finally:
+        chart_renderer.close ()
+        provider.close ()
+
+# Downloads all the tiles that the sheets need, once.  Returns False if
+# there is no tile cache to download them into.
+#
+def seed_sheet_tiles (config_data, sheets):
+    provider = tile_provider.make_tile_provider (config_data)
+
+    # Closing the provider writes the tiles that the store is still
+    # holding, before the sheet workers look for them
+    try:
+        if not isinstance (provider, tile_provider.CachingTileProvider):
+            return False
+
+        tiles = set ()
+        for (row, column, sheet_json) in sheets:
+            map_layout = maplayout.MapLayout ()
+            map_layout.load_from_json (sheet_json)
+            tiles |= seedcache.compute_tiles_for_layout (map_layout, provider)
+
+        seedcache.seed_tiles (provider, tiles, config_data.get ("download_threads", tilefetcher.default_max_tiles_in_flight))
+        return True
+    finally:
+        provider.close ()
+
+def render_sheets_in_parallel (config_data, sheets, format, filenames, dpi, jobs):
+    # The sheets already keep all the cores busy, and the processes share
+    # the request limits
+    worker_config = tile_provider.split_request_limits (dict (config_data, decode_processes = 0), jobs)
+    tile_provider.warn_about_directory_cache (config_data, jobs)
+
+    with concurrent.futures.ProcessPoolExecutor (max_workers = jobs) as executor:
+        futures = [executor.submit (render_sheet, worker_config, sheet_json, format, filename, dpi)
+                   for ((row, column, sheet_json), filename) in zip (sheets, filenames)]
+
+        for (i, future) in enumerate (concurrent.futures.as_completed (futures)):
+            future.result ()
+            print ("Rendered sheet {0} of {1}".format (i + 1, len (sheets)))
+
+def render_atlas (config_data, sheets, format, output, dpi, per_sheet, jobs):
+    if not seed_sheet_tiles (config_data, sheets):
+        print ("The tile cache is turned off, so tiles along the overlaps get downloaded once per sheet.")
+
+    if per_sheet or format != "pdf":
+        filenames = [make_sheet_filename (output, row, column) for (row, column, sheet_json) in sheets]
+        render_sheets_in_parallel (config_data, sheets, format, filenames, dpi, jobs)
+        return
+
+    # A multi-page PDF has to be written by a single process.  The
+    # workers do the expensive part, compositing each sheet's map into a
+    # mosaic in the mosaic cache; then this process assembles the pages
+    # from the cached mosaics.
+    config_data = dict (config_data, mosaic_cache = True)
+
+    # Copies, so the caller's sheets stay as they were
+    sheets = [(row, column, dict (sheet_json, **{ "map-mosaic" : True })) for (row, column, sheet_json) in sheets]
+
+    render_sheets_in_parallel (config_data, sheets, format, [None] * len (sheets), dpi, jobs)
+
+    provider = tile_provider.make_tile_provider (config_data)
+    chart_renderers = []
+
+    for (row, column, sheet_json) in sheets:
+        map_layout = maplayout.MapLayout ()
+        map_layout.load_from_json (sheet_json)
+
+        chart_renderer = chartrenderer.ChartRenderer (chartgeometry.ChartGeometry (map_layout, provider))
+        chart_renderer.load_config (config_data)
+        chart_renderers.append (chart_renderer)
+
+    try:
+        paper_renderer = paperrenderer.PaperRenderer (chart_renderers[0].map_layout)
+        paper_renderer.render_pdf_pages (output, chart_renderers)
+    finally:
+        for chart_renderer in chart_renderers:
+            chart_renderer.close ()
+
+        provider.close ()
+
+def main (config_data):
+    parser = argparse.ArgumentParser (description = "Makes an atlas of overlapping page-sized maps that cover a region.")
+
+    parser.add_argument ("--bbox",      type = parse_degrees, nargs = 4, required = True,
+                         metavar = ("LAT1", "LON1", "LAT2", "LON2"))
+    parser.add_argument ("--layout",    type = jsonfile, metavar = "JSON-FILENAME",
+                         help = "map layout to use for every sheet; its center is ignored")
+    parser.add_argument ("--paper",     type = str, choices = sorted (paper_sizes.keys ()),
+                         help = "fill this paper size with the map, overriding the layout's sizes")
+    parser.add_argument ("--landscape", action = "store_true")
+    parser.add_argument ("--margin",    type = parse_units_str, default = default_margin_mm, metavar = "LENGTH")
+    parser.add_argument ("--overlap",   type = parse_units_str, default = default_overlap_mm, metavar = "LENGTH",
+                         help = "how much adjacent sheets overlap on the paper")
+    parser.add_argument ("--scale",     type = int, metavar = "DENOMINATOR")
+    parser.add_argument ("--zoom",      type = int)
+    parser.add_argument ("--format",    type = str, default = "pdf",
+                         choices = [ "pdf", "svg" ] + paperrenderer.raster_formats)
+    parser.add_argument ("--output",    type = str, required = True, metavar = "FILENAME")
+    parser.add_argument ("--per-sheet", action = "store_true",
+                         help = "write one file per sheet instead of a multi-page PDF")
+    parser.add_argument ("--dpi",       type = float, default = paperrenderer.default_raster_dpi, metavar = "DPI",
+                         help = "resolution for raster formats")
+    parser.add_argument ("--jobs",      type = int, default = os.cpu_count (),
+                         help = "how many sheets to render at the same time")
+
+    args = parser.parse_args ()
+
+    template_json = dict (args.layout or {})
+
+    if args.paper is not None:
+        (width_mm, height_mm) = paper_sizes[args.paper]
+        if args.landscape:
+            (width_mm, height_mm) = (height_mm, width_mm)
+
+        template_json.update (make_paper_template (width_mm, height_mm, args.margin))
+
+    if args.scale is not None:
+        template_json["map-scale"] = args.scale
+
+    if args.zoom is not None:
+        template_json["zoom"] = args.zoom
+
+    (lat1, lon1, lat2, lon2) = args.bbox
+    sheets = compute_sheet_layouts (template_json, lat1, lon1, lat2, lon2, args.overlap)
+
+    print ("The atlas has {0} sheets in {1} rows".format (len (sheets), sheets[-1][0] + 1))
+
+    render_atlas (config_data, sheets, args.format, args.output, args.dpi, args.per_sheet, args.jobs)
+
+#################### tests ####################
+
+class TestAtlas (testutils.TestCaseHelper):
+    def make_template (self):
+        template = make_paper_template (*paper_sizes["letter"])
+        template["zoom"] = 15
+        template["map-scale"] = 50000
+
+        return template
+
+    def make_geometry (self, sheet_json):
+        layout = maplayout.MapLayout ()
+        layout.load_from_json (sheet_json)
+
+        geometry = chartgeometry.ChartGeometry (layout, tile_provider.NullTileProvider ())
+        geometry.compute_extents_of_downloaded_tiles ()
+
+        return geometry
+
+    # Returns (north, west, south, east) of a sheet's map
+    def compute_sheet_bounds (self, sheet_json):
+        geometry = self.make_geometry (sheet_json)
+        layout = geometry.map_layout
+
+        (north, west) = geometry.transform_page_mm_to_lat_lon (layout.map_to_left_margin_mm, layout.map_to_top_margin_mm)
+        (south, east) = geometry.transform_page_mm_to_lat_lon (layout.map_to_left_margin_mm + layout.map_width_mm,
+                                                               layout.map_to_top_margin_mm + layout.map_height_mm)
+
+        return (north, west, south, east)
+
+    def test_sheets_cover_the_bbox (self):
+        sheets = compute_sheet_layouts (self.make_template (), 19.3, -97.1, 19.6, -96.8)
+
+        bounds = [self.compute_sheet_bounds (sheet_json) for (row, column, sheet_json) in sheets]
+
+        self.assertGreater (len (sheets), 1)
+
+        # The outer sheets end right at the bbox, give or take rounding
+        self.assertGreaterEqual (max (north for (north, west, south, east) in bounds), 19.6 - testutils.EPSILON)
+        self.assertLessEqual (min (south for (north, west, south, east) in bounds), 19.3 + testutils.EPSILON)
+        self.assertLessEqual (min (west for (north, west, south, east) in bounds), -97.1 + testutils.EPSILON)
+        self.assertGreaterEqual (max (east for (north, west, south, east) in bounds), -96.8 - testutils.EPSILON)
+
+    def test_adjacent_sheets_overlap (self):
+        overlap_mm = 15.0
+        sheets = compute_sheet_layouts (self.make_template (), 19.3, -97.1, 19.6, -96.8, overlap_mm)
+
+        by_position = { (row, column) : sheet_json for (row, column, sheet_json) in sheets }
+
+        (north, west, south, east) = self.compute_sheet_bounds (by_position[(0, 0)])
+        (next_north, next_west, next_south, next_east) = self.compute_sheet_bounds (by_position[(0, 1)])
+        (below_north, below_west, below_south, below_east) = self.compute_sheet_bounds (by_position[(1, 0)])
+
+        # Convert the overlap in degrees back to millimeters on the paper
+        layout = maplayout.MapLayout ()
+        layout.load_from_json (by_position[(0, 0)])
+
+        mm_per_degree_lon = layout.map_width_mm / (east - west)
+        mm_per_degree_lat = layout.map_height_mm / (north - south)
+
+        self.assertAlmostEqual ((east - next_west) * mm_per_degree_lon, overlap_mm, delta = 0.5)
+        self.assertAlmostEqual ((below_north - south) * mm_per_degree_lat, overlap_mm, delta = 0.5)
+
+    def test_rejects_overlap_bigger_than_the_map (self):
+        with self.assertRaises (ValueError):
+            compute_sheet_layouts (self.make_template (), 19.3, -97.1, 19.6, -96.8, 1000.0)
+
+    def test_seeded_tiles_are_in_the_store (self):
+        path = tempfile.mkdtemp ()
+        filename = os.path.join (path, "tiles.mbtiles")
+
+        def make_tile_provider (config_data):
+            return tile_provider.CachingTileProvider (tile_provider.NullTileProvider (),
+                                                      tilecache.MBTilesTileStore (filename, 1024 * 1024 * 1024))
+
+        saved_make_tile_provider = tile_provider.make_tile_provider
+        tile_provider.make_tile_provider = make_tile_provider
+
+        try:
+            sheets = compute_sheet_layouts (self.make_template (), 19.4, -97.0, 19.5, -96.9)
+            self.assertTrue (seed_sheet_tiles ({}, sheets))
+
+            tiles = set ()
+            for (row, column, sheet_json) in sheets:
+                tiles |= seedcache.compute_tiles_for_layout (self.make_geometry (sheet_json).map_layout,
+                                                             tile_provider.NullTileProvider ())
+
+            # A new connection only sees what got written to the file
+            store = tilecache.MBTilesTileStore (filename, 1024 * 1024 * 1024)
+
+            try:
+                self.assertEqual ([t for t in tiles if not store.has_tile (*t)], [])
+            finally:
+                store.close ()
+        finally:
+            tile_provider.make_tile_provider = saved_make_tile_provider
+            shutil.rmtree (path)
+
+    def test_makes_sheet_filenames (self):
+        self.assertEqual (make_sheet_filename ("out/atlas.pdf", 1, 2), "out/atlas-02-03.pdf")
+
+if __name__ == "__main__":
+    try:
+        config_data = config.config_load ()
+    except IOError as e:
+        print ("La Mapería is not configured yet.  Run ./lamaperia.py first to configure it.")
+        exit (1)
+    except ValueError as e:
+        print ("The configuration in {} is not valid: {}".format (config.config_get_configuration_filename (),
+                                                                  e.args[0]))
+        exit (1)
+
+    main (config_data)
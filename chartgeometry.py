@@ -1,6 +1,7 @@
 import math
 import cairo
 import json
+import numpy
 from tilecoords import *
 import tile_provider
 from units import *
@@ -23,6 +24,10 @@ class ChartGeometry:
 
         self.tile_provider = tile_provider
 
+        # See get_cached_matrices()
+        self.matrix_key = None
+        self.matrices = None
+
     # We need to scale tiles by this much to get them to the final rendered size
     def compute_tile_scale_factor (self):
         tile_size = self.tile_provider.get_tile_size ()
@@ -78,12 +83,45 @@ class ChartGeometry:
 
         return (center_tile_x * tile_size, center_tile_y * tile_size)
 
+    # Everything that compute_matrix_from_page_mm_to_map_surface_coordinates()
+    # depends on.  The matrices get recomputed when this changes.
+    def compute_matrix_key (self):
+        layout = self.map_layout
+
+        return (layout.zoom, layout.center_lat, layout.center_lon, layout.map_scale_denom,
+                layout.map_width_mm, layout.map_height_mm,
+                layout.map_to_left_margin_mm, layout.map_to_top_margin_mm,
+                self.tile_provider, self.tile_provider.get_tile_size (),
+                self.west_tile_idx, self.north_tile_idx)
+
+    # Returns (to_map_surface, to_page), the cached matrices from page
+    # millimeters to map surface pixels and back.  Don't modify them.
+    def get_cached_matrices (self):
+        key = self.compute_matrix_key ()
+
+        if self.matrix_key != key:
+            to_map_surface = self.build_matrix_from_page_mm_to_map_surface_coordinates ()
+
+            to_page = to_map_surface.multiply (cairo.Matrix ())
+            to_page.invert ()
+
+            self.matrices = (to_map_surface, to_page)
+            self.matrix_key = key
+
+        return self.matrices
+
     # If we start with a CTM so that (0, 0) is at the page's top-left corner,
     # and 1 unit is 1 mm, this computes a transformation matrix to get
     # from there to map coordinates:  (0, 0) will be at the north-west
     # corner of the downloaded tiles, and 1 unit will be 1 pixel in the tiles.
     #
+    # The result is a copy, so callers can modify it.
+    #
     def compute_matrix_from_page_mm_to_map_surface_coordinates (self):
+        (to_map_surface, to_page) = self.get_cached_matrices ()
+        return to_map_surface.multiply (cairo.Matrix ())
+
+    def build_matrix_from_page_mm_to_map_surface_coordinates (self):
         m = cairo.Matrix () # starts with a unit matrix
 
         # Center on the map
@@ -109,7 +147,7 @@ class ChartGeometry:
         return m
 
     def transform_page_mm_to_lat_lon (self, page_x, page_y):
-        matrix = self.compute_matrix_from_page_mm_to_map_surface_coordinates ()
+        (matrix, unused) = self.get_cached_matrices ()
 
         (pixel_x, pixel_y) = matrix.transform_point (page_x, page_y)
 
@@ -121,8 +159,7 @@ class ChartGeometry:
         return tile_number_to_coordinates (self.map_layout.zoom, global_pixel_x, global_pixel_y)
 
     def transform_lat_lon_to_page_mm (self, lat, lon):
-        matrix = self.compute_matrix_from_page_mm_to_map_surface_coordinates ()
-        matrix.invert ()
+        (unused, matrix) = self.get_cached_matrices ()
 
         tile_size = self.tile_provider.get_tile_size ()
 
@@ -132,6 +169,57 @@ class ChartGeometry:
 
         return matrix.transform_point (pixel_x, pixel_y)
 
+    # Like transform_page_mm_to_lat_lon(), but for arrays of points.
+    # Returns (lat, lon) arrays.
+    def transform_page_mm_to_lat_lon_array (self, page_x, page_y):
+        (matrix, unused) = self.get_cached_matrices ()
+
+        (pixel_x, pixel_y) = transform_points_array (matrix, page_x, page_y)
+
+        tile_size = self.tile_provider.get_tile_size ()
+
+        global_pixel_x = self.west_tile_idx + pixel_x / tile_size
+        global_pixel_y = self.north_tile_idx + pixel_y / tile_size
+
+        return tile_number_to_coordinates_array (self.map_layout.zoom, global_pixel_x, global_pixel_y)
+
+    # Like transform_lat_lon_to_page_mm(), but for arrays of points.
+    # Returns (x, y) arrays.
+    def transform_lat_lon_to_page_mm_array (self, lat, lon):
+        (unused, matrix) = self.get_cached_matrices ()
+
+        tile_size = self.tile_provider.get_tile_size ()
+
+        (tile_x, tile_y) = coordinates_to_tile_and_fraction_array (self.map_layout.zoom, lat, lon)
+        pixel_x = (tile_x - self.west_tile_idx) * tile_size
+        pixel_y = (tile_y - self.north_tile_idx) * tile_size
+
+        return transform_points_array (matrix, pixel_x, pixel_y)
+
+    # Returns (west, south, east, north), the longitudes and latitudes of
+    # the map area's edges, grown by margin_mm on paper on every side.
+    def compute_map_lat_lon_bounds (self, margin_mm = 0.0):
+        layout = self.map_layout
+
+        (north, west) = self.transform_page_mm_to_lat_lon (layout.map_to_left_margin_mm - margin_mm,
+                                                           layout.map_to_top_margin_mm - margin_mm)
+        (south, east) = self.transform_page_mm_to_lat_lon (layout.map_to_left_margin_mm + layout.map_width_mm + margin_mm,
+                                                           layout.map_to_top_margin_mm + layout.map_height_mm + margin_mm)
+
+        return (west, south, east, north)
+
+# Applies a cairo.Matrix to arrays of x and y coordinates
+def transform_points_array (matrix, x, y):
+    (x0, y0) = matrix.transform_point (0, 0)
+    (xx, yx) = matrix.transform_distance (1, 0)
+    (xy, yy) = matrix.transform_distance (0, 1)
+
+    x = numpy.asarray (x, dtype = numpy.float64)
+    y = numpy.asarray (y, dtype = numpy.float64)
+
+    return (xx * x + xy * y + x0,
+            yx * x + yy * y + y0)
+
 #################### tests ####################
 
 class TestChartGeometry (testutils.TestCaseHelper):
@@ -212,3 +300,61 @@ class TestChartGeometry (testutils.TestCaseHelper):
 
         self.assertFloatEquals (x, map_area_center_x)
         self.assertFloatEquals (y, map_area_center_y)
+
+    def test_map_bounds_contain_the_center (self):
+        map_layout = self.make_test_map_layout ()
+        chart_geometry = ChartGeometry (map_layout, tile_provider.NullTileProvider ())
+
+        chart_geometry.compute_extents_of_downloaded_tiles ()
+
+        (west, south, east, north) = chart_geometry.compute_map_lat_lon_bounds ()
+        self.assertTrue (west < map_layout.center_lon < east)
+        self.assertTrue (south < map_layout.center_lat < north)
+
+        (x, y) = chart_geometry.transform_lat_lon_to_page_mm (north, west)
+        self.assertFloatEquals (x, map_layout.map_to_left_margin_mm)
+        self.assertFloatEquals (y, map_layout.map_to_top_margin_mm)
+
+        (grown_west, grown_south, grown_east, grown_north) = chart_geometry.compute_map_lat_lon_bounds (1.0)
+        self.assertTrue (grown_west < west and grown_east > east)
+        self.assertTrue (grown_south < south and grown_north > north)
+
+    def test_array_transforms_match_point_transforms (self):
+        map_layout = self.make_test_map_layout ()
+        provider = tile_provider.NullTileProvider ()
+        chart_geometry = ChartGeometry (map_layout, provider)
+
+        chart_geometry.compute_extents_of_downloaded_tiles ()
+
+        xs = numpy.linspace (0, map_layout.paper_width_mm, 7)
+        ys = numpy.linspace (0, map_layout.paper_height_mm, 7)
+
+        (lats, lons) = chart_geometry.transform_page_mm_to_lat_lon_array (xs, ys)
+        (xs2, ys2) = chart_geometry.transform_lat_lon_to_page_mm_array (lats, lons)
+
+        for i in range (len (xs)):
+            (lat, lon) = chart_geometry.transform_page_mm_to_lat_lon (xs[i], ys[i])
+
+            self.assertFloatEquals (lats[i], lat)
+            self.assertFloatEquals (lons[i], lon)
+            self.assertFloatEquals (xs2[i], xs[i])
+            self.assertFloatEquals (ys2[i], ys[i])
+
+    def test_matrices_follow_layout_changes (self):
+        map_layout = self.make_test_map_layout ()
+        provider = tile_provider.NullTileProvider ()
+        chart_geometry = ChartGeometry (map_layout, provider)
+
+        chart_geometry.compute_extents_of_downloaded_tiles ()
+
+        (lat, lon) = chart_geometry.transform_page_mm_to_lat_lon (0, 0)
+
+        # Modifying a returned matrix doesn't affect the cached one
+        chart_geometry.compute_matrix_from_page_mm_to_map_surface_coordinates ().invert ()
+        self.assertEqual (chart_geometry.transform_page_mm_to_lat_lon (0, 0), (lat, lon))
+
+        map_layout.map_to_left_margin_mm += 10
+        (lat2, lon2) = chart_geometry.transform_page_mm_to_lat_lon (10, 0)
+
+        self.assertFloatEquals (lat2, lat)
+        self.assertFloatEquals (lon2, lon)
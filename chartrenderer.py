@@ -3,7 +3,16 @@ import math
 import sys
 import cairo
 import io
+import os
 import json
+import shutil
+import tempfile
+import hashlib
+import threading
+import collections
+import config
+import mosaicstore
+import tiledecoder
 from tilecoords import *
 import tile_provider
 import framerenderer
@@ -12,7 +21,84 @@ from units import *
 import testutils
 import maplayout
 import tile_provider
+import tilefetcher
 import chartgeometry
+import overlayrenderer
+
+# Raised by a ChartRenderer when its cancel_event gets set
+class RenderCancelled (Exception):
+    pass
+
+# Decoded tile surfaces, keyed by (z, x, y), from least to most recently
+# used, with at most max_tiles of them.  Several ChartRenderers can share
+# one, also from different threads, like the maps of a batch or the
+# workers of the render service.  Holds nothing when max_tiles is 0.
+class DecodedTileCache:
+    def __init__ (self, max_tiles = 0):
+        self.max_tiles = max_tiles
+        self.tiles = collections.OrderedDict ()
+        self.lock = threading.Lock ()
+
+        # The configured limit, and the extra room that renders in
+        # progress asked for with reserve_capacity()
+        self.base_max_tiles = max_tiles
+        self.reservations = []
+
+    def __len__ (self):
+        with self.lock:
+            return len (self.tiles)
+
+    # Returns a dict with the surfaces for the (x, y) in coords at zoom z
+    # from provider that are in the cache.  Other renderers can evict
+    # tiles at any time, so the caller should use these instead of
+    # looking them up again.
+    def get_tiles (self, provider, z, coords):
+        source = self.get_tile_source (provider)
+        tiles = {}
+
+        with self.lock:
+            for (x, y) in coords:
+                key = (source, z, x, y)
+                tile_surf = self.tiles.get (key)
+
+                if tile_surf is not None:
+                    self.tiles.move_to_end (key)
+                    tiles[(x, y)] = tile_surf
+
+        return tiles
+
+    def add_tile (self, provider, z, x, y, tile_surf):
+        source = self.get_tile_source (provider)
+
+        with self.lock:
+            if self.max_tiles <= 0:
+                return
+
+            self.tiles[(source, z, x, y)] = tile_surf
+            self.evict_tiles ()
+
+    # Renderers with different styles or tile sizes can share the cache,
+    # so the same (z, x, y) must not give them each other's tiles
+    def get_tile_source (self, provider):
+        return (provider.get_cache_namespace (), provider.get_tile_size ())
+
+    # Makes room for at least max_tiles tiles until the matching call to
+    # release_capacity()
+    def reserve_capacity (self, max_tiles):
+        with self.lock:
+            self.reservations.append (max_tiles)
+            self.max_tiles = max ([self.base_max_tiles] + self.reservations)
+
+    def release_capacity (self, max_tiles):
+        with self.lock:
+            self.reservations.remove (max_tiles)
+            self.max_tiles = max ([self.base_max_tiles] + self.reservations)
+            self.evict_tiles ()
+
+    # Call with the lock held
+    def evict_tiles (self):
+        while len (self.tiles) > max (self.max_tiles, 0):
+            self.tiles.popitem (last = False)
 
 class ChartRenderer:
     def __init__ (self, chart_geometry):
@@ -21,18 +107,139 @@ class ChartRenderer:
 
         self.map_layout = chart_geometry.map_layout
 
-    # Assumes that the current transformation matrix is set up for millimeters
-    def render_to_cairo (self, cr):
-        self.geometry.compute_extents_of_downloaded_tiles ()
+        self.max_tiles_in_flight = tilefetcher.default_max_tiles_in_flight
+
+        # A DecodedTileCache.  This lets consecutive bands of a banded
+        # render share the tiles that straddle them, and the maps of a
+        # batch share the tiles they have in common.
+        self.decoded_tiles = DecodedTileCache ()
+
+        # If not None, map mosaics live in memory-mapped files in this
+        # directory, and get reused when the same map is rendered again.
+        self.mosaic_cache_dir = None
+        self.mosaic_cache_max_size_bytes = 4096 * 1024 * 1024
+
+        # Number of worker processes for decoding tile PNGs; 0 decodes them
+        # in this process.  The tiledecoder.TileDecoder gets created the
+        # first time it is needed.
+        self.decode_processes = tiledecoder.default_decode_processes
+        self.tile_decoder = None
+
+        # A threading.Event that another thread can set to stop rendering
+        # with RenderCancelled; it gets checked before painting each tile.
+        self.cancel_event = None
+
+        # The map_layout.overlays, recorded the first time they get drawn
+        # so that banded renders don't parse the GeoJSON files once per band
+        self.overlay_recording = None
+
+        # The map frame and the scale, recorded in pixels by
+        # start_banded_render() so that each band only replays them
+        self.decorations_recording = None
+        self.decorations_px_per_mm = None
+
+        # The room that start_banded_render() reserved in decoded_tiles
+        self.reserved_decoded_tiles = None
+
+    # Picks up the rendering options from La Mapería's configuration
+    # file, i.e. the ones that depend on the machine and not on the map.
+    def load_config (self, config_data):
+        if "download_threads" in config_data:
+            self.max_tiles_in_flight = config_data["download_threads"]
+
+        if config_data.get ("mosaic_cache", False):
+            self.mosaic_cache_dir = config_data.get ("mosaic_cache_dir",
+                                                     os.path.join (config.config_get_cache_path (), "mosaics"))
+
+        if "decode_processes" in config_data:
+            self.decode_processes = config_data["decode_processes"]
+
+        if "mosaic_cache_max_mb" in config_data:
+            self.mosaic_cache_max_size_bytes = config_data["mosaic_cache_max_mb"] * 1024 * 1024
+
+    # Assumes that the current transformation matrix is set up for millimeters.
+    #
+    # page_rect_mm can be (x, y, width, height) to render only the part of
+    # the page that is inside that rectangle, for banded rendering.  Only
+    # the tiles that intersect it get fetched.  Call start_banded_render()
+    # before the first band.
+    def render_to_cairo (self, cr, page_rect_mm = None):
+        self.check_cancelled ()
+
+        banded = page_rect_mm is not None and self.decorations_recording is not None
+
+        if not banded:
+            self.geometry.compute_extents_of_downloaded_tiles ()
 
         if self.map_layout.draw_map:
-            self.render_map_data (cr)
+            if page_rect_mm is None:
+                self.render_map_data (cr)
+            else:
+                self.render_map_data_in_rect (cr, page_rect_mm)
+
+        if len (self.map_layout.overlays) > 0:
+            self.render_overlays (cr)
+
+        if banded:
+            cr.save ()
+            cr.scale (1 / self.decorations_px_per_mm, 1 / self.decorations_px_per_mm)
+            cr.set_source_surface (self.decorations_recording, 0, 0)
+            cr.paint ()
+            cr.restore ()
+        else:
+            self.render_decorations (cr)
+
+    # Does the work of a banded render at dpi that is the same for every
+    # band: finding the tiles, and drawing the frame and the scale, which
+    # get recorded for render_to_cairo() to replay in each band.  They get
+    # recorded in pixels, so that text and lines snap to the same pixels
+    # as when they are drawn in the band directly.  Call
+    # end_banded_render() after the last band.
+    def start_banded_render (self, dpi):
+        geometry = self.geometry
+        geometry.compute_extents_of_downloaded_tiles ()
+
+        width_tiles = geometry.east_tile_idx - geometry.west_tile_idx + 1
+        height_tiles = geometry.south_tile_idx - geometry.north_tile_idx + 1
+
+        # Keep the tiles that straddle two bands decoded, but not many more
+        self.end_banded_render ()
+        self.reserved_decoded_tiles = 2 * width_tiles
+        self.decoded_tiles.reserve_capacity (self.reserved_decoded_tiles)
 
+        if self.map_layout.draw_map:
+            print ("Downloading {0} tiles...".format (width_tiles * height_tiles))
+
+        self.decorations_recording = cairo.RecordingSurface (cairo.CONTENT_COLOR_ALPHA, None)
+        self.decorations_px_per_mm = dpi / 25.4
+
+        recording_cr = cairo.Context (self.decorations_recording)
+        recording_cr.scale (self.decorations_px_per_mm, self.decorations_px_per_mm)
+        self.render_decorations (recording_cr)
+        del recording_cr
+
+    # Gives back the room in decoded_tiles that the bands needed, so that a
+    # shared cache goes back to its configured size
+    def end_banded_render (self):
+        if self.reserved_decoded_tiles is not None:
+            self.decoded_tiles.release_capacity (self.reserved_decoded_tiles)
+            self.reserved_decoded_tiles = None
+
+        self.decorations_recording = None
+        self.decorations_px_per_mm = None
+
+    def render_decorations (self, cr):
         self.render_map_frame (cr)
 
         if self.map_layout.draw_scale:
             self.render_scale (cr)
 
+    # Stops the tile decoding processes, if any
+    def close (self):
+        if self.tile_decoder is not None:
+            self.tile_decoder.close ()
+            self.tile_decoder = None
+
     def render_map_frame (self, cr):
         cr.save ()
 
@@ -46,18 +253,41 @@ class ChartRenderer:
 
         cr.restore ()
 
+    def render_overlays (self, cr):
+        if self.overlay_recording is None:
+            self.overlay_recording = cairo.RecordingSurface (cairo.CONTENT_COLOR_ALPHA, None)
+
+            recording_cr = cairo.Context (self.overlay_recording)
+            overlayrenderer.OverlayRenderer (self.geometry).render (recording_cr)
+            del recording_cr
+
+        cr.save ()
+        self.clip_to_map (cr)
+        cr.set_source_surface (self.overlay_recording, 0, 0)
+        cr.paint ()
+        cr.restore ()
+
     def clip_to_map (self, cr):
         cr.rectangle (self.map_layout.map_to_left_margin_mm, self.map_layout.map_to_top_margin_mm,
                       self.map_layout.map_width_mm, self.map_layout.map_height_mm)
         cr.clip ()
 
-    # Downloads tiles and paints them on the master surface
-    def make_map_surface (self, cr):
+    # Downloads tiles and paints them on the master surface.  By default
+    # this paints all the tiles from compute_extents_of_downloaded_tiles();
+    # tile_range can be (west, north, east, south) tile numbers (inclusive)
+    # to paint only part of them.  With show_progress = False, it doesn't
+    # print how many tiles it downloads, for callers that do it themselves.
+    def make_map_surface (self, cr, tile_range = None, show_progress = True):
         geometry = self.geometry
         provider = geometry.tile_provider
 
-        width_tiles = geometry.east_tile_idx - geometry.west_tile_idx + 1
-        height_tiles = geometry.south_tile_idx - geometry.north_tile_idx + 1
+        if tile_range is None:
+            tile_range = (geometry.west_tile_idx, geometry.north_tile_idx, geometry.east_tile_idx, geometry.south_tile_idx)
+
+        (west_tile_idx, north_tile_idx, east_tile_idx, south_tile_idx) = tile_range
+
+        width_tiles = east_tile_idx - west_tile_idx + 1
+        height_tiles = south_tile_idx - north_tile_idx + 1
 
         assert width_tiles >= 1
         assert height_tiles >= 1
@@ -66,28 +296,330 @@ class ChartRenderer:
 
         tiles_downloaded = 0
 
-        print ("Downloading {0} tiles...".format (width_tiles * height_tiles))
+        if show_progress:
+            print ("Downloading {0} tiles...".format (width_tiles * height_tiles))
+
+        # Row-major order, so tiles get painted in the same order every time
+        tile_coords = [(x + west_tile_idx, y + north_tile_idx)
+                       for y in range (0, height_tiles)
+                       for x in range (0, width_tiles)]
+
+        z = self.map_layout.zoom
+        cached_tiles = self.decoded_tiles.get_tiles (provider, z, tile_coords)
+        coords_to_fetch = [(x, y) for (x, y) in tile_coords if (x, y) not in cached_tiles]
 
-        for y in range (0, height_tiles):
-            for x in range (0, width_tiles):
-                tile_x = x + geometry.west_tile_idx
-                tile_y = y + geometry.north_tile_idx
+        if len (coords_to_fetch) > 0:
+            provider.prefetch_tiles (z, west_tile_idx, north_tile_idx, east_tile_idx, south_tile_idx)
 
-                tiles_downloaded += 1
-                print ("Downloading tile {0}".format(tiles_downloaded), end='\r', flush=True)
+        fetched = tilefetcher.fetch_tiles (provider, z, coords_to_fetch, self.max_tiles_in_flight)
+        decoded = self.decode_tiles (fetched)
 
-                png_data = provider.get_tile_png (self.map_layout.zoom, tile_x, tile_y)
-                tile_surf = cairo.ImageSurface.create_from_png (io.BytesIO (png_data))
+        try:
+            for (tile_x, tile_y) in tile_coords:
+                self.check_cancelled ()
 
-                tile_xpos = x * tile_size
-                tile_ypos = y * tile_size
+                tile_surf = cached_tiles.get ((tile_x, tile_y))
+
+                if tile_surf is None:
+                    # decoded yields tiles in the same order as tile_coords
+                    (decoded_x, decoded_y, tile_surf) = next (decoded)
+                    assert (decoded_x, decoded_y) == (tile_x, tile_y)
+
+                    tiles_downloaded += 1
+                    if show_progress:
+                        print ("Downloading tile {0}".format(tiles_downloaded), end='\r', flush=True)
+
+                    self.remember_decoded_tile (z, tile_x, tile_y, tile_surf)
+
+                tile_xpos = (tile_x - geometry.west_tile_idx) * tile_size
+                tile_ypos = (tile_y - geometry.north_tile_idx) * tile_size
 
                 cr.set_source_surface (tile_surf, tile_xpos, tile_ypos)
                 cr.paint ()
 
                 del tile_surf
+        finally:
+            decoded.close ()
+            fetched.close ()
+            provider.flush ()
+
+        if show_progress:
+            print ("")
+
+    def check_cancelled (self):
+        if self.cancel_event is not None and self.cancel_event.is_set ():
+            raise RenderCancelled ()
+
+    # Turns the (x, y, png_data) from tilefetcher.fetch_tiles() into (x, y,
+    # surface), in the same order.
+    def decode_tiles (self, fetched):
+        if self.decode_processes <= 0:
+            return ((x, y, tiledecoder.decode_png (png_data)) for (x, y, png_data) in fetched)
+
+        if self.tile_decoder is None:
+            self.tile_decoder = tiledecoder.TileDecoder (self.decode_processes, self.geometry.tile_provider.get_tile_size ())
+
+        return self.tile_decoder.decode_tiles (fetched)
+
+    def remember_decoded_tile (self, z, x, y, tile_surf):
+        if self.decoded_tiles.max_tiles <= 0:
+            return
+
+        # Surfaces from the TileDecoder get reused for the next tiles
+        if self.tile_decoder is not None:
+            tile_surf = tiledecoder.copy_surface (tile_surf)
+
+        self.decoded_tiles.add_tile (self.geometry.tile_provider, z, x, y, tile_surf)
+
+    # Returns (x, y, width, height) of the part of the map surface that is
+    # visible through clip_to_map(), in whole pixels.  If page_rect_mm is
+    # given as (x, y, width, height), the result only covers the part of
+    # the map that is inside that rectangle of the page; returns None if
+    # there is no such part.
+    def compute_visible_map_pixels (self, page_rect_mm = None):
+        layout = self.map_layout
+
+        left = layout.map_to_left_margin_mm
+        top = layout.map_to_top_margin_mm
+        right = left + layout.map_width_mm
+        bottom = top + layout.map_height_mm
+
+        if page_rect_mm is not None:
+            (x, y, width, height) = page_rect_mm
+
+            left = max (left, x)
+            top = max (top, y)
+            right = min (right, x + width)
+            bottom = min (bottom, y + height)
+
+            if left >= right or top >= bottom:
+                return None
+
+        matrix = self.geometry.compute_matrix_from_page_mm_to_map_surface_coordinates ()
+
+        corners = [matrix.transform_point (x, y)
+                   for x in (left, right)
+                   for y in (top, bottom)]
+
+        # One extra pixel around the edges, so that resampling at the
+        # borders of the map doesn't blend with transparent pixels.
+        x1 = int (math.floor (min (x for (x, y) in corners))) - 1
+        y1 = int (math.floor (min (y for (x, y) in corners))) - 1
+        x2 = int (math.ceil (max (x for (x, y) in corners))) + 1
+        y2 = int (math.ceil (max (y for (x, y) in corners))) + 1
+
+        tile_size = self.geometry.tile_provider.get_tile_size ()
+        geometry = self.geometry
+
+        x1 = max (x1, 0)
+        y1 = max (y1, 0)
+        x2 = min (x2, (geometry.east_tile_idx - geometry.west_tile_idx + 1) * tile_size)
+        y2 = min (y2, (geometry.south_tile_idx - geometry.north_tile_idx + 1) * tile_size)
+
+        if x1 >= x2 or y1 >= y2:
+            return None
+
+        return (x1, y1, x2 - x1, y2 - y1)
+
+    # Returns the (west, north, east, south) tile numbers that cover a
+    # rectangle in map surface pixels.
+    def compute_tile_range_for_pixels (self, x, y, width, height):
+        tile_size = self.geometry.tile_provider.get_tile_size ()
+
+        return (self.geometry.west_tile_idx + x // tile_size,
+                self.geometry.north_tile_idx + y // tile_size,
+                self.geometry.west_tile_idx + (x + width - 1) // tile_size,
+                self.geometry.north_tile_idx + (y + height - 1) // tile_size)
+
+    # Composites the visible part of the map into a single image.  Returns
+    # (surface, x, y), where (x, y) is the position of the image's
+    # top-left corner in map surface pixels.
+    def make_map_mosaic (self):
+        (x, y, width, height) = self.compute_visible_map_pixels ()
+
+        if self.mosaic_cache_dir is not None:
+            return (self.make_mapped_map_mosaic (x, y, width, height), x, y)
+
+        mosaic = cairo.ImageSurface (cairo.FORMAT_RGB24, width, height)
+        mosaic_cr = cairo.Context (mosaic)
+        mosaic_cr.translate (-x, -y)
+
+        self.make_map_surface (mosaic_cr, self.compute_tile_range_for_pixels (x, y, width, height))
+
+        del mosaic_cr
+        mosaic.flush ()
+
+        return (mosaic, x, y)
+
+    # Identifies the pixels of a mosaic: which tiles it comes from, and
+    # which part of them it covers.
+    def compute_mosaic_key (self, x, y, width, height):
+        geometry = self.geometry
+        provider = geometry.tile_provider
+
+        key = "{0} {1} {2} {3} {4} {5} {6} {7} {8}".format (provider.get_cache_namespace (),
+                                                          provider.get_tile_size (),
+                                                          self.map_layout.zoom,
+                                                          geometry.west_tile_idx, geometry.north_tile_idx,
+                                                          x, y, width, height)
+
+        return hashlib.sha1 (key.encode ("utf-8")).hexdigest ()
+
+    # Like make_map_mosaic(), but the pixels live in a memory-mapped file
+    # from mosaicstore.  If the file already exists, no tiles need to be
+    # fetched or decoded at all.
+    def make_mapped_map_mosaic (self, x, y, width, height):
+        stride = cairo.ImageSurface.format_stride_for_width (cairo.FORMAT_RGB24, width)
+        filename = os.path.join (self.mosaic_cache_dir, self.compute_mosaic_key (x, y, width, height) + ".mosaic")
+
+        mapped = mosaicstore.open_mosaic (filename, width, height, stride)
+        if mapped is not None:
+            print ("Reusing the map mosaic in {0}".format (filename))
+            return cairo.ImageSurface.create_for_data (mapped.get_pixels (), cairo.FORMAT_RGB24, width, height, stride)
+
+        mapped = mosaicstore.create_mosaic (filename, width, height, stride)
+        mosaic = self.fill_mapped_mosaic (mapped, x, y)
+
+        mosaicstore.commit_mosaic (mapped)
+        mosaicstore.evict_mosaics (self.mosaic_cache_dir, self.mosaic_cache_max_size_bytes)
+
+        return mosaic
+
+    # Composites the map surface pixels starting at (x, y) into a mosaic
+    # from mosaicstore.create_mosaic(), and returns a surface for them.
+    def fill_mapped_mosaic (self, mapped, x, y):
+        mosaic = cairo.ImageSurface.create_for_data (mapped.get_pixels (), cairo.FORMAT_RGB24, mapped.width, mapped.height, mapped.stride)
+
+        try:
+            mosaic_cr = cairo.Context (mosaic)
+            mosaic_cr.translate (-x, -y)
+
+            self.make_map_surface (mosaic_cr, self.compute_tile_range_for_pixels (x, y, mapped.width, mapped.height))
+
+            del mosaic_cr
+            mosaic.flush ()
+        except:
+            # Don't leave a mosaic-sized temporary file behind if the
+            # download fails or the render gets cancelled
+            mosaic.finish ()
+            mosaicstore.discard_mosaic (mapped)
+            raise
+
+        return mosaic
+
+    # Returns the size in pixels of a mosaic of width x height map surface
+    # pixels, resampled to dpi pixels per inch on the page.
+    def compute_resampled_size (self, width, height, dpi):
+        mm_per_pixel = self.geometry.compute_tile_scale_factor () * pt_to_mm (1.0)
+        pixels_per_pixel = mm_per_pixel * dpi / 25.4
+
+        return (max (1, int (round (width * pixels_per_pixel))),
+                max (1, int (round (height * pixels_per_pixel))))
+
+    # Resamples a mosaic so that it has exactly dpi pixels per inch when
+    # placed on the page.  The result goes into the resampled surface if
+    # one is given; it must have the size from compute_resampled_size().
+    def resample_mosaic (self, mosaic, dpi, resampled = None):
+        (width, height) = self.compute_resampled_size (mosaic.get_width (), mosaic.get_height (), dpi)
+
+        if resampled is None:
+            resampled = cairo.ImageSurface (cairo.FORMAT_RGB24, width, height)
+
+        resampled_cr = cairo.Context (resampled)
+        resampled_cr.scale (width / mosaic.get_width (), height / mosaic.get_height ())
+
+        pattern = cairo.SurfacePattern (mosaic)
+        pattern.set_filter (cairo.FILTER_BEST)
+        pattern.set_extend (cairo.EXTEND_PAD)
+        resampled_cr.set_source (pattern)
+        resampled_cr.paint ()
+
+        del resampled_cr
+        resampled.flush ()
 
-        print ("")
+        return resampled
+
+    # Identifies the map layer: everything that changes its pixels, and
+    # nothing else, so that changing the frame, ticks, scale indicator or
+    # margins still finds the same layer.
+    def compute_map_layer_key (self, x, y, width, height):
+        layout = self.map_layout
+        provider = self.geometry.tile_provider
+
+        key = json.dumps ([provider.get_cache_namespace (), provider.get_tile_size (),
+                           layout.zoom, layout.center_lat, layout.center_lon, layout.map_scale_denom,
+                           layout.map_width_mm, layout.map_height_mm, layout.target_dpi,
+                           x, y, width, height])
+
+        return hashlib.sha1 (key.encode ("utf-8")).hexdigest ()
+
+    # Returns (surface, x, y, width, height) with the map as a single image,
+    # resampled to the layout's target_dpi if it has one.  The image
+    # covers width x height map surface pixels starting at (x, y).
+    #
+    # With a mosaic cache, the resampled layer gets kept there, so
+    # re-rendering a map where only the decorations changed doesn't need
+    # to touch the tiles at all.  The full-resolution mosaic only gets
+    # kept as well if the layout asks for map-mosaic.
+    #
+    def make_map_layer (self):
+        dpi = self.map_layout.target_dpi
+
+        if dpi is None:
+            (mosaic, x, y) = self.make_map_mosaic ()
+            return (mosaic, x, y, mosaic.get_width (), mosaic.get_height ())
+
+        (x, y, width, height) = self.compute_visible_map_pixels ()
+
+        if self.mosaic_cache_dir is None:
+            (mosaic, x, y) = self.make_map_mosaic ()
+            return (self.resample_mosaic (mosaic, dpi), x, y, width, height)
+
+        (layer_width, layer_height) = self.compute_resampled_size (width, height, dpi)
+        stride = cairo.ImageSurface.format_stride_for_width (cairo.FORMAT_RGB24, layer_width)
+        filename = os.path.join (self.mosaic_cache_dir, self.compute_map_layer_key (x, y, width, height) + ".mosaic")
+
+        mapped = mosaicstore.open_mosaic (filename, layer_width, layer_height, stride)
+        if mapped is not None:
+            print ("Reusing the map layer in {0}".format (filename))
+            layer = cairo.ImageSurface.create_for_data (mapped.get_pixels (), cairo.FORMAT_RGB24, layer_width, layer_height, stride)
+            return (layer, x, y, width, height)
+
+        mapped = mosaicstore.create_mosaic (filename, layer_width, layer_height, stride)
+        layer = cairo.ImageSurface.create_for_data (mapped.get_pixels (), cairo.FORMAT_RGB24, layer_width, layer_height, stride)
+
+        try:
+            if self.map_layout.map_mosaic:
+                # The full-resolution mosaic was asked for, so keep it too
+                (mosaic, x, y) = self.make_map_mosaic ()
+                self.resample_mosaic (mosaic, dpi, layer)
+            else:
+                self.resample_scratch_mosaic (x, y, width, height, dpi, layer)
+        except:
+            layer.finish ()
+            mosaicstore.discard_mosaic (mapped)
+            raise
+
+        mosaicstore.commit_mosaic (mapped)
+        mosaicstore.evict_mosaics (self.mosaic_cache_dir, self.mosaic_cache_max_size_bytes)
+
+        return (layer, x, y, width, height)
+
+    # Composites a full-resolution mosaic just to resample it into the
+    # layer surface.  It lives in a temporary mosaic file, which gets
+    # removed afterwards instead of taking up room in the mosaic cache.
+    def resample_scratch_mosaic (self, x, y, width, height, dpi, layer):
+        stride = cairo.ImageSurface.format_stride_for_width (cairo.FORMAT_RGB24, width)
+        filename = os.path.join (self.mosaic_cache_dir, self.compute_mosaic_key (x, y, width, height) + ".mosaic")
+
+        scratch = mosaicstore.create_mosaic (filename, width, height, stride)
+        mosaic = self.fill_mapped_mosaic (scratch, x, y)
+
+        try:
+            self.resample_mosaic (mosaic, dpi, layer)
+        finally:
+            mosaic.finish ()
+            mosaicstore.discard_mosaic (scratch)
 
     def render_map_data (self, cr):
         cr.save ()
@@ -97,7 +629,40 @@ class ChartRenderer:
         matrix = self.geometry.compute_matrix_from_page_mm_to_map_surface_coordinates ()
         matrix.invert ()
         cr.transform (matrix)
-        self.make_map_surface (cr)
+
+        if (self.map_layout.map_mosaic or self.map_layout.target_dpi is not None
+            or self.mosaic_cache_dir is not None):
+            # One image for the whole map, instead of one per tile, which is
+            # much smaller in PDF/SVG output and has no seams between tiles.
+            (layer, x, y, width, height) = self.make_map_layer ()
+
+            cr.translate (x, y)
+            cr.scale (width / layer.get_width (), height / layer.get_height ())
+
+            cr.set_source_surface (layer, 0, 0)
+            cr.paint ()
+        else:
+            self.make_map_surface (cr)
+
+        cr.restore ()
+
+    # For banded rendering to a raster.  The output is already an image at
+    # the final resolution, so the tiles get painted directly on it (no
+    # mosaic or resampling), and only the ones that intersect the band.
+    def render_map_data_in_rect (self, cr, page_rect_mm):
+        visible = self.compute_visible_map_pixels (page_rect_mm)
+        if visible is None:
+            return
+
+        cr.save ()
+
+        self.clip_to_map (cr)
+
+        matrix = self.geometry.compute_matrix_from_page_mm_to_map_surface_coordinates ()
+        matrix.invert ()
+        cr.transform (matrix)
+
+        self.make_map_surface (cr, self.compute_tile_range_for_pixels (*visible), show_progress = False)
 
         cr.restore ()
 
@@ -147,3 +712,361 @@ class TestChartRenderer (testutils.TestCaseHelper):
         self.assertEqual (provider.north_tile_requested_limit, 14573)
         self.assertEqual (provider.east_tile_requested_limit, 7569)
         self.assertEqual (provider.south_tile_requested_limit, 14581)
+
+    def test_mosaic_covers_the_visible_map (self):
+        map_layout = self.make_test_map_layout ()
+        provider = tile_provider.NullTileProvider ()
+        geometry = chartgeometry.ChartGeometry (map_layout, provider)
+
+        chart_renderer = ChartRenderer (geometry)
+
+        geometry.compute_extents_of_downloaded_tiles ()
+
+        (x, y, width, height) = chart_renderer.compute_visible_map_pixels ()
+        matrix = geometry.compute_matrix_from_page_mm_to_map_surface_coordinates ()
+
+        (left, top) = matrix.transform_point (map_layout.map_to_left_margin_mm, map_layout.map_to_top_margin_mm)
+        (right, bottom) = matrix.transform_point (map_layout.map_to_left_margin_mm + map_layout.map_width_mm,
+                                                  map_layout.map_to_top_margin_mm + map_layout.map_height_mm)
+
+        self.assertLessEqual (x, left)
+        self.assertLessEqual (y, top)
+        self.assertGreaterEqual (x + width, right)
+        self.assertGreaterEqual (y + height, bottom)
+
+        (mosaic, mosaic_x, mosaic_y) = chart_renderer.make_map_mosaic ()
+
+        self.assertEqual ((mosaic_x, mosaic_y), (x, y))
+        self.assertEqual ((mosaic.get_width (), mosaic.get_height ()), (width, height))
+
+        # Only the tiles that intersect the visible area get requested
+        self.assertGreaterEqual (provider.west_tile_requested_limit, geometry.west_tile_idx)
+        self.assertLessEqual (provider.east_tile_requested_limit, geometry.east_tile_idx)
+
+    def test_resamples_mosaic_to_target_dpi (self):
+        map_layout = self.make_test_map_layout ()
+        provider = tile_provider.NullTileProvider ()
+        geometry = chartgeometry.ChartGeometry (map_layout, provider)
+
+        chart_renderer = ChartRenderer (geometry)
+
+        geometry.compute_extents_of_downloaded_tiles ()
+
+        (mosaic, x, y) = chart_renderer.make_map_mosaic ()
+        resampled = chart_renderer.resample_mosaic (mosaic, 300)
+
+        mm_per_pixel = geometry.compute_tile_scale_factor () * pt_to_mm (1.0)
+        width_mm = mosaic.get_width () * mm_per_pixel
+
+        self.assertAlmostEqual (resampled.get_width (), width_mm / 25.4 * 300, delta = 1)
+
+    def test_only_fetches_tiles_for_a_band (self):
+        map_layout = self.make_test_map_layout ()
+        provider = tile_provider.NullTileProvider ()
+        geometry = chartgeometry.ChartGeometry (map_layout, provider)
+
+        chart_renderer = ChartRenderer (geometry)
+
+        # A thin band across the top of the map
+        band = (0, 0, map_layout.paper_width_mm, map_layout.map_to_top_margin_mm + 1)
+
+        surface = cairo.ImageSurface (cairo.FORMAT_RGB24, 256, 256)
+        cr = cairo.Context (surface)
+        chart_renderer.render_to_cairo (cr, band)
+
+        self.assertEqual (provider.north_tile_requested_limit, geometry.north_tile_idx)
+        self.assertLess (provider.south_tile_requested_limit, geometry.south_tile_idx)
+        self.assertEqual (provider.west_tile_requested_limit, geometry.west_tile_idx)
+        self.assertEqual (provider.east_tile_requested_limit, geometry.east_tile_idx)
+
+    def test_draws_the_frame_once_for_all_bands (self):
+        map_layout = self.make_test_map_layout ()
+        geometry = chartgeometry.ChartGeometry (map_layout, tile_provider.NullTileProvider ())
+
+        chart_renderer = ChartRenderer (geometry)
+
+        frames = []
+        render_map_frame = chart_renderer.render_map_frame
+        chart_renderer.render_map_frame = lambda cr: frames.append (render_map_frame (cr))
+
+        chart_renderer.start_banded_render (100)
+
+        band_height_mm = map_layout.paper_height_mm / 4
+        surface = cairo.ImageSurface (cairo.FORMAT_RGB24, 256, 256)
+
+        for i in range (4):
+            chart_renderer.render_to_cairo (cairo.Context (surface),
+                                            (0, i * band_height_mm, map_layout.paper_width_mm, band_height_mm))
+
+        self.assertEqual (len (frames), 1)
+
+    def test_banded_render_gives_back_the_tile_cache_room (self):
+        decoded_tiles = DecodedTileCache (3)
+
+        map_layout = self.make_test_map_layout ()
+        geometry = chartgeometry.ChartGeometry (map_layout, tile_provider.NullTileProvider ())
+
+        chart_renderer = ChartRenderer (geometry)
+        chart_renderer.decoded_tiles = decoded_tiles
+
+        chart_renderer.start_banded_render (100)
+        self.assertGreater (decoded_tiles.max_tiles, 3)
+
+        surface = cairo.ImageSurface (cairo.FORMAT_RGB24, 256, 256)
+        chart_renderer.render_to_cairo (cairo.Context (surface),
+                                        (0, 0, map_layout.paper_width_mm, map_layout.paper_height_mm))
+        self.assertGreater (len (decoded_tiles), 3)
+
+        chart_renderer.end_banded_render ()
+        self.assertEqual (decoded_tiles.max_tiles, 3)
+        self.assertEqual (len (decoded_tiles), 3)
+
+    def test_reuses_decoded_tiles (self):
+        map_layout = self.make_test_map_layout ()
+        provider = tile_provider.NullTileProvider ()
+        geometry = chartgeometry.ChartGeometry (map_layout, provider)
+
+        chart_renderer = ChartRenderer (geometry)
+        chart_renderer.decoded_tiles = DecodedTileCache (1000)
+
+        geometry.compute_extents_of_downloaded_tiles ()
+
+        surface = cairo.ImageSurface (cairo.FORMAT_RGB24, 256, 256)
+        cr = cairo.Context (surface)
+        chart_renderer.make_map_surface (cr)
+
+        provider.west_tile_requested_limit = -1
+        chart_renderer.make_map_surface (cr)
+
+        self.assertEqual (provider.west_tile_requested_limit, -1)
+
+    def test_decoded_tiles_are_kept_apart_by_provider (self):
+        class OtherStyleTileProvider (tile_provider.NullTileProvider):
+            def get_cache_namespace (self):
+                return "other"
+
+        decoded_tiles = DecodedTileCache (10)
+        (provider, other) = (tile_provider.NullTileProvider (), OtherStyleTileProvider ())
+
+        tile_surf = cairo.ImageSurface (cairo.FORMAT_RGB24, 1, 1)
+        decoded_tiles.add_tile (provider, 10, 1, 2, tile_surf)
+
+        self.assertEqual (decoded_tiles.get_tiles (provider, 10, [(1, 2)]), { (1, 2) : tile_surf })
+        self.assertEqual (decoded_tiles.get_tiles (other, 10, [(1, 2)]), {})
+
+    def test_renderers_share_a_bounded_tile_cache (self):
+        decoded_tiles = DecodedTileCache (10)
+        providers = []
+
+        def render ():
+            provider = tile_provider.NullTileProvider ()
+            geometry = chartgeometry.ChartGeometry (self.make_test_map_layout (), provider)
+            geometry.compute_extents_of_downloaded_tiles ()
+
+            chart_renderer = ChartRenderer (geometry)
+            chart_renderer.decoded_tiles = decoded_tiles
+
+            surface = cairo.ImageSurface (cairo.FORMAT_RGB24, 256, 256)
+            chart_renderer.make_map_surface (cairo.Context (surface))
+
+            providers.append (provider)
+
+        threads = [threading.Thread (target = render) for i in range (4)]
+        for thread in threads:
+            thread.start ()
+        for thread in threads:
+            thread.join ()
+
+        self.assertEqual (len (providers), 4)
+        self.assertEqual (len (decoded_tiles), 10)
+
+    def test_decodes_tiles_in_processes (self):
+        map_layout = self.make_test_map_layout ()
+        geometry = chartgeometry.ChartGeometry (map_layout, tile_provider.NullTileProvider ())
+        geometry.compute_extents_of_downloaded_tiles ()
+
+        chart_renderer = ChartRenderer (geometry)
+        (serial, x, y) = chart_renderer.make_map_mosaic ()
+
+        chart_renderer.decode_processes = 2
+
+        try:
+            (parallel, x, y) = chart_renderer.make_map_mosaic ()
+        finally:
+            chart_renderer.close ()
+
+        self.assertEqual (bytes (serial.get_data ()), bytes (parallel.get_data ()))
+
+    def test_stops_when_cancelled (self):
+        map_layout = self.make_test_map_layout ()
+        geometry = chartgeometry.ChartGeometry (map_layout, tile_provider.NullTileProvider ())
+        geometry.compute_extents_of_downloaded_tiles ()
+
+        chart_renderer = ChartRenderer (geometry)
+        chart_renderer.cancel_event = threading.Event ()
+        chart_renderer.cancel_event.set ()
+
+        surface = cairo.ImageSurface (cairo.FORMAT_RGB24, 256, 256)
+        cr = cairo.Context (surface)
+
+        with self.assertRaises (RenderCancelled):
+            chart_renderer.make_map_surface (cr)
+
+    def test_reuses_mapped_mosaic (self):
+        map_layout = self.make_test_map_layout ()
+        provider = tile_provider.NullTileProvider ()
+        geometry = chartgeometry.ChartGeometry (map_layout, provider)
+
+        chart_renderer = ChartRenderer (geometry)
+        chart_renderer.mosaic_cache_dir = tempfile.mkdtemp ()
+
+        try:
+            geometry.compute_extents_of_downloaded_tiles ()
+
+            (first, x, y) = chart_renderer.make_map_mosaic ()
+
+            provider.west_tile_requested_limit = -1
+            (second, x, y) = chart_renderer.make_map_mosaic ()
+
+            self.assertEqual (provider.west_tile_requested_limit, -1)
+            self.assertEqual (bytes (first.get_data ()), bytes (second.get_data ()))
+        finally:
+            shutil.rmtree (chart_renderer.mosaic_cache_dir)
+
+    def test_failed_mosaic_leaves_no_temporary_file (self):
+        map_layout = self.make_test_map_layout ()
+        geometry = chartgeometry.ChartGeometry (map_layout, tile_provider.NullTileProvider ())
+
+        chart_renderer = ChartRenderer (geometry)
+        chart_renderer.mosaic_cache_dir = tempfile.mkdtemp ()
+
+        # Fails while filling in the mosaic, before the first tile
+        chart_renderer.cancel_event = threading.Event ()
+        chart_renderer.cancel_event.set ()
+
+        try:
+            geometry.compute_extents_of_downloaded_tiles ()
+
+            with self.assertRaises (RenderCancelled):
+                chart_renderer.make_map_mosaic ()
+
+            self.assertEqual (os.listdir (chart_renderer.mosaic_cache_dir), [])
+        finally:
+            shutil.rmtree (chart_renderer.mosaic_cache_dir)
+
+    def test_failed_map_layer_leaves_no_temporary_file (self):
+        map_layout = self.make_test_map_layout ()
+        map_layout.target_dpi = 150
+        geometry = chartgeometry.ChartGeometry (map_layout, tile_provider.NullTileProvider ())
+
+        chart_renderer = ChartRenderer (geometry)
+        chart_renderer.mosaic_cache_dir = tempfile.mkdtemp ()
+
+        chart_renderer.cancel_event = threading.Event ()
+        chart_renderer.cancel_event.set ()
+
+        try:
+            geometry.compute_extents_of_downloaded_tiles ()
+
+            with self.assertRaises (RenderCancelled):
+                chart_renderer.make_map_layer ()
+
+            self.assertEqual (os.listdir (chart_renderer.mosaic_cache_dir), [])
+        finally:
+            shutil.rmtree (chart_renderer.mosaic_cache_dir)
+
+    def test_map_layer_keeps_full_resolution_mosaic_only_for_map_mosaic (self):
+        map_layout = self.make_test_map_layout ()
+        map_layout.target_dpi = 150
+        geometry = chartgeometry.ChartGeometry (map_layout, tile_provider.NullTileProvider ())
+
+        chart_renderer = ChartRenderer (geometry)
+        chart_renderer.mosaic_cache_dir = tempfile.mkdtemp ()
+
+        try:
+            geometry.compute_extents_of_downloaded_tiles ()
+
+            chart_renderer.make_map_layer ()
+            self.assertEqual (len (os.listdir (chart_renderer.mosaic_cache_dir)), 1)
+
+            map_layout.map_mosaic = True
+            map_layout.target_dpi = 200
+            chart_renderer.make_map_layer ()
+            self.assertEqual (len (os.listdir (chart_renderer.mosaic_cache_dir)), 3)
+        finally:
+            shutil.rmtree (chart_renderer.mosaic_cache_dir)
+
+    def test_reuses_map_layer_when_only_decorations_change (self):
+        map_layout = self.make_test_map_layout ()
+        map_layout.target_dpi = 150
+        provider = tile_provider.NullTileProvider ()
+        geometry = chartgeometry.ChartGeometry (map_layout, provider)
+
+        chart_renderer = ChartRenderer (geometry)
+        chart_renderer.mosaic_cache_dir = tempfile.mkdtemp ()
+
+        try:
+            geometry.compute_extents_of_downloaded_tiles ()
+            (first, x, y, width, height) = chart_renderer.make_map_layer ()
+
+            map_layout.draw_ticks = False
+            map_layout.scale_xpos_mm += 10
+            map_layout.map_to_left_margin_mm += 5
+
+            provider.west_tile_requested_limit = -1
+            (second, x, y, width, height) = chart_renderer.make_map_layer ()
+
+            self.assertEqual (provider.west_tile_requested_limit, -1)
+            self.assertEqual (bytes (first.get_data ()), bytes (second.get_data ()))
+
+            # A different scale needs a different layer
+            map_layout.map_scale_denom = 40000
+            geometry.compute_extents_of_downloaded_tiles ()
+            chart_renderer.make_map_layer ()
+
+            self.assertNotEqual (provider.west_tile_requested_limit, -1)
+        finally:
+            shutil.rmtree (chart_renderer.mosaic_cache_dir)
+
+    def test_overlay_points_share_one_pdf_form (self):
+        path = tempfile.mkdtemp ()
+
+        try:
+            map_layout = self.make_test_map_layout ()
+            (lat, lon) = (map_layout.center_lat, map_layout.center_lon)
+
+            num_points = 50
+            filename = os.path.join (path, "points.geojson")
+
+            with open (filename, "w") as f:
+                json.dump ({ "type" : "FeatureCollection",
+                             "features" : [{ "type" : "Feature", "properties" : {},
+                                             "geometry" : { "type" : "Point", "coordinates" : [lon + i * 0.001, lat] } }
+                                           for i in range (-num_points // 2, num_points // 2)] }, f)
+
+            map_layout.load_from_json ({ "overlays" : [{ "geojson" : filename, "point-symbol" : "cross" }] })
+
+            geometry = chartgeometry.ChartGeometry (map_layout, tile_provider.NullTileProvider ())
+            geometry.compute_extents_of_downloaded_tiles ()
+
+            chart_renderer = ChartRenderer (geometry)
+
+            output = io.BytesIO ()
+            surface = cairo.PDFSurface (output, mm_to_pt (map_layout.paper_width_mm), mm_to_pt (map_layout.paper_height_mm))
+            cr = cairo.Context (surface)
+            cr.scale (mm_to_pt (1), mm_to_pt (1))
+
+            chart_renderer.render_overlays (cr)
+
+            del cr
+            surface.finish ()
+
+            pdf = output.getvalue ()
+
+            # One form for the recorded overlays, and one for the symbol
+            # that every point refers to
+            self.assertEqual (pdf.count (b"/Subtype /Form"), 2)
+            self.assertEqual (len (set (re.findall (rb"/x\d+ \d+ 0 R", pdf))), 2)
+        finally:
+            overlayrenderer.clear_cached_shapes ()
+            shutil.rmtree (path)
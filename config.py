@@ -8,6 +8,12 @@ def config_get_configuration_path ():
 def config_get_configuration_filename ():
     return os.path.join (config_get_configuration_path (), "config.json")
 
+def config_get_cache_path ():
+    return os.path.join (GLib.get_user_cache_dir (), "lamaperia")
+
+def config_get_tile_cache_path ():
+    return os.path.join (config_get_cache_path (), "tiles")
+
 def config_open_configuration_file_for_writing ():
     os.makedirs (config_get_configuration_path (), exist_ok = True)
     return open (config_get_configuration_filename (), 'w')
@@ -102,16 +102,14 @@ class FrameRenderer:
         end = max (start_coord, end_coord)
 
         ticks = self.generate_ticks (start, end, every_arc_minutes)
-        ticks_mm = []
+        along_edge = [along_edge_coord] * len (ticks)
 
-        for i in range (len (ticks)):
-            c = ticks[i]
-            if is_horizontal:
-                (mm, dummy) = self.geometry.transform_lat_lon_to_page_mm (along_edge_coord, c)
-            else:
-                (dummy, mm) = self.geometry.transform_lat_lon_to_page_mm (c, along_edge_coord)
+        if is_horizontal:
+            (ticks_mm, dummy) = self.geometry.transform_lat_lon_to_page_mm_array (along_edge, ticks)
+        else:
+            (dummy, ticks_mm) = self.geometry.transform_lat_lon_to_page_mm_array (ticks, along_edge)
 
-            ticks_mm.append (mm)
+        ticks_mm = ticks_mm.tolist ()
 
         for i in range (len (ticks_mm) - 1):
             start = ticks_mm[i]
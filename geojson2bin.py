@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+# Converts GeoJSON files to the binary format of overlaystore, which maps
+# can use as "overlays" just like the GeoJSON files, but which load much
+# faster and with much less memory.  By default FILENAME.geojson becomes
+# FILENAME.lmoverlay next to it.
+
+import os
+import argparse
+import overlaystore
+
+def make_store_filename (geojson_filename):
+    (base, ext) = os.path.splitext (geojson_filename)
+    return base + overlaystore.store_suffix
+
+def main ():
+    parser = argparse.ArgumentParser (description = "Converts GeoJSON files into La Mapería's binary overlay format.")
+
+    parser.add_argument ("geojson", nargs = "+", metavar = "GEOJSON-FILENAME")
+    parser.add_argument ("--output", metavar = "FILENAME",
+                         help = "output filename, if there is a single input file")
+    parser.add_argument ("--benchmark", action = "store_true",
+                         help = "compare loading times and memory use with json.load()")
+
+    args = parser.parse_args ()
+
+    if args.output is not None and len (args.geojson) > 1:
+        parser.error ("--output can only be used with a single GeoJSON file")
+
+    for geojson_filename in args.geojson:
+        store_filename = args.output or make_store_filename (geojson_filename)
+
+        num_features = overlaystore.convert_geojson (geojson_filename, store_filename)
+        print ("{0}: {1} features written to {2}".format (geojson_filename, num_features, store_filename))
+
+        if args.benchmark:
+            overlaystore.benchmark (geojson_filename)
+
+if __name__ == "__main__":
+    main ()
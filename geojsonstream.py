@@ -0,0 +1,286 @@
+import io
+import re
+import json
+import unittest
+import numpy
+
+# Reads the features of a GeoJSON FeatureCollection one at a time, so
+# that memory use depends on the size of the largest feature, not on the
+# size of the file.  OSM extracts can be hundreds of megabytes, and
+# json.load() would build the whole object graph at once.
+
+default_chunk_size = 64 * 1024
+
+SHAPE_POINT   = "point"
+SHAPE_LINE    = "line"
+SHAPE_POLYGON = "polygon"
+
+whitespace_re = re.compile (r"\s*")
+
+class JSONStream:
+    def __init__ (self, file, chunk_size):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder ()
+
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+        # Byte offset in the file of self.buf[self.mark], for tell()
+        self.offset = 0
+        self.mark = 0
+
+    # Appends up to amount characters to the buffer, dropping the part
+    # that was already consumed.  Returns False at the end of the file.
+    def read_more (self, amount):
+        data = self.file.read (amount)
+
+        if len (data) == 0:
+            self.eof = True
+            return False
+
+        self.advance_offset ()
+
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        self.mark = 0
+
+        return True
+
+    def advance_offset (self):
+        self.offset += len (self.buf[self.mark : self.pos].encode ("utf-8"))
+        self.mark = self.pos
+
+    # Returns the byte offset in the file of the current position.  The
+    # file must have been opened with newline="", so that the characters
+    # match the bytes on disk.
+    def tell (self):
+        self.advance_offset ()
+        return self.offset
+
+    def skip_whitespace (self):
+        while True:
+            self.pos = whitespace_re.match (self.buf, self.pos).end ()
+
+            if self.pos < len (self.buf) or not self.read_more (self.chunk_size):
+                return
+
+    # Returns the next non-whitespace character without consuming it, or
+    # "" at the end of the file.
+    def peek (self):
+        self.skip_whitespace ()
+        return self.buf[self.pos : self.pos + 1]
+
+    def expect (self, char):
+        found = self.peek ()
+
+        if found != char:
+            raise ValueError ("GeoJSON: expected '{0}' but found '{1}'".format (char, found))
+
+        self.pos += 1
+
+    def decode_value (self):
+        self.skip_whitespace ()
+
+        while True:
+            try:
+                (value, end) = self.decoder.raw_decode (self.buf, self.pos)
+
+                # A number at the very end of the buffer may continue in
+                # the next chunk
+                if end < len (self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+            # Read as much again as is pending, so that a value that spans
+            # many chunks doesn't get re-parsed once per chunk.
+            self.read_more (max (self.chunk_size, len (self.buf) - self.pos))
+
+# Yields the features of a GeoJSON FeatureCollection in file, which must
+# be opened in text mode.  The other members of the FeatureCollection
+# are skipped.
+#
+def iter_features (file, chunk_size = default_chunk_size):
+    for (start, end, feature) in iter_features_and_offsets (file, chunk_size):
+        yield feature
+
+# Like iter_features(), but yields (start, end, feature), where start and
+# end are the byte offsets of the feature's text in the file; see
+# read_feature_at().
+#
+def iter_features_and_offsets (file, chunk_size = default_chunk_size):
+    stream = JSONStream (file, chunk_size)
+
+    stream.expect ("{")
+    if stream.peek () == "}":
+        return
+
+    while True:
+        key = stream.decode_value ()
+        stream.expect (":")
+
+        if key == "features":
+            stream.expect ("[")
+
+            if stream.peek () == "]":
+                stream.pos += 1
+            else:
+                while True:
+                    stream.skip_whitespace ()
+                    start = stream.tell ()
+                    feature = stream.decode_value ()
+
+                    yield (start, stream.tell (), feature)
+
+                    separator = stream.peek ()
+                    stream.pos += 1
+
+                    if separator == "]":
+                        break
+                    elif separator != ",":
+                        raise ValueError ("GeoJSON: expected ',' or ']' after a feature but found '{0}'".format (separator))
+        else:
+            stream.decode_value ()
+
+        separator = stream.peek ()
+        stream.pos += 1
+
+        if separator == "}":
+            return
+        elif separator != ",":
+            raise ValueError ("GeoJSON: expected ',' or '}}' but found '{0}'".format (separator))
+
+def open_geojson (filename):
+    return open (filename, encoding = "utf-8", newline = "")
+
+def iter_features_in_file (filename, chunk_size = default_chunk_size):
+    with open_geojson (filename) as f:
+        yield from iter_features (f, chunk_size)
+
+# Reads a single feature from a file opened in binary mode, given the
+# offsets from iter_features_and_offsets()
+def read_feature_at (file, start, end):
+    file.seek (start)
+    return json.loads (file.read (end - start).decode ("utf-8"))
+
+# Yields (shape_type, rings) for a GeoJSON geometry, where rings is a
+# list of lists of [lon, lat] positions.  Points have a single ring with
+# a single position, lines a single ring, and polygons their outer ring
+# followed by their holes.  Multi-geometries and geometry collections get
+# split into their parts.
+#
+def iter_shapes (geometry):
+    if geometry is None:
+        return
+
+    geometry_type = geometry.get ("type")
+    coordinates = geometry.get ("coordinates")
+
+    if geometry_type == "Point":
+        yield (SHAPE_POINT, [[coordinates]])
+    elif geometry_type == "MultiPoint":
+        for position in coordinates:
+            yield (SHAPE_POINT, [[position]])
+    elif geometry_type == "LineString":
+        yield (SHAPE_LINE, [coordinates])
+    elif geometry_type == "MultiLineString":
+        for line in coordinates:
+            yield (SHAPE_LINE, [line])
+    elif geometry_type == "Polygon":
+        yield (SHAPE_POLYGON, coordinates)
+    elif geometry_type == "MultiPolygon":
+        for polygon in coordinates:
+            yield (SHAPE_POLYGON, polygon)
+    elif geometry_type == "GeometryCollection":
+        for part in geometry.get ("geometries", []):
+            yield from iter_shapes (part)
+
+# Like iter_shapes(), but returns a list of (shape_type, rings) with each
+# ring as an (n, 2) NumPy array of [lon, lat] positions.  Altitudes and
+# empty rings get dropped.
+#
+def make_shape_arrays (geometry):
+    shapes = []
+
+    for (shape_type, rings) in iter_shapes (geometry):
+        arrays = [numpy.array (ring, dtype = numpy.float64)[:, 0:2]
+                  for ring in rings if len (ring) > 0 and ring[0] is not None]
+
+        if len (arrays) > 0:
+            shapes.append ((shape_type, arrays))
+
+    return shapes
+
+
+#################### tests ####################
+
+class TestGeoJSONStream (unittest.TestCase):
+    def make_collection (self, num_features):
+        features = [{ "type" : "Feature",
+                      "properties" : { "name" : "feature {0}".format (i) },
+                      "geometry" : { "type" : "LineString",
+                                     "coordinates" : [[-96.9 + i * 0.001, 19.4 + j * 0.001] for j in range (20)] } }
+                    for i in range (num_features)]
+
+        return { "type" : "FeatureCollection",
+                 "generator" : "test",
+                 "features" : features,
+                 "bbox" : [-97, 19, -96, 20] }
+
+    def test_yields_the_same_features_as_json_load (self):
+        collection = self.make_collection (30)
+        text = json.dumps (collection, indent = 2)
+
+        # Chunks much smaller than a feature
+        for chunk_size in (7, 100, default_chunk_size):
+            features = list (iter_features (io.StringIO (text), chunk_size))
+            self.assertEqual (features, collection["features"])
+
+    def test_handles_empty_collections (self):
+        self.assertEqual (list (iter_features (io.StringIO ('{ "type" : "FeatureCollection", "features" : [ ] }'))), [])
+        self.assertEqual (list (iter_features (io.StringIO ('{}'))), [])
+
+    def test_numbers_split_across_chunks (self):
+        text = '{"features":[{"id":12345678}]}'
+
+        for chunk_size in range (1, len (text)):
+            self.assertEqual (list (iter_features (io.StringIO (text), chunk_size)), [{ "id" : 12345678 }])
+
+    def test_rejects_truncated_files (self):
+        text = json.dumps (self.make_collection (3))
+
+        with self.assertRaises (ValueError):
+            list (iter_features (io.StringIO (text[:len (text) // 2]), 16))
+
+    def test_offsets_point_at_the_features (self):
+        collection = self.make_collection (5)
+        collection["features"][2]["properties"]["name"] = "Cañada de Ñandúes"
+        text = json.dumps (collection, indent = 2, ensure_ascii = False)
+
+        data = io.BytesIO (text.encode ("utf-8"))
+
+        for chunk_size in (7, 100, default_chunk_size):
+            for (start, end, feature) in iter_features_and_offsets (io.StringIO (text), chunk_size):
+                self.assertEqual (read_feature_at (data, start, end), feature)
+
+    def test_splits_geometries_into_shapes (self):
+        geometry = { "type" : "GeometryCollection",
+                     "geometries" : [{ "type" : "MultiPoint", "coordinates" : [[1, 2, 100], [3, 4]] },
+                                     { "type" : "Polygon", "coordinates" : [[[0, 0], [1, 0], [0, 1], [0, 0]], []] }] }
+
+        shapes = make_shape_arrays (geometry)
+
+        self.assertEqual ([shape_type for (shape_type, rings) in shapes], [SHAPE_POINT, SHAPE_POINT, SHAPE_POLYGON])
+        self.assertEqual (shapes[0][1][0].tolist (), [[1, 2]])
+        self.assertEqual (len (shapes[2][1]), 1)
+        self.assertEqual (shapes[2][1][0].shape, (4, 2))
+
+    def test_reads_external_data (self):
+        features = list (iter_features_in_file ("external-data/wayside-shrines-crosses.geojson"))
+
+        with open ("external-data/wayside-shrines-crosses.geojson", encoding = "utf-8") as f:
+            self.assertEqual (features, json.load (f)["features"])
@@ -0,0 +1,142 @@
+import math
+import json
+import numpy
+import unittest
+import geojsonstream
+from tilecoords import *
+
+# Douglas-Peucker simplification of overlay geometries, with a tolerance
+# given in millimeters on paper.  At 1:50,000 a dense OpenStreetMap line
+# has many vertices within a fraction of a printed line width of each
+# other; dropping them gives much smaller paths in the PDF and SVG files
+# without a visible difference.
+
+# Never simplify more finely than this; it is about one printer dot at
+# 600 DPI.
+min_tolerance_mm = 0.04
+
+# Vertices closer than this fraction of the line width to the simplified
+# line get dropped.
+tolerance_per_line_width = 0.5
+
+def compute_tolerance_mm (line_width_mm):
+    return max (line_width_mm * tolerance_per_line_width, min_tolerance_mm)
+
+# Returns a boolean array of the points to keep, for an (n, 2) array of
+# points.  The first and last points are always kept.
+def douglas_peucker (points, tolerance):
+    n = len (points)
+    keep = numpy.zeros (n, dtype = bool)
+
+    if n == 0:
+        return keep
+
+    keep[0] = True
+    keep[n - 1] = True
+
+    stack = [(0, n - 1)]
+
+    while len (stack) > 0:
+        (first, last) = stack.pop ()
+
+        if last - first < 2:
+            continue
+
+        start = points[first]
+        end = points[last]
+        between = points[first + 1 : last]
+
+        (dx, dy) = end - start
+        length = math.hypot (dx, dy)
+
+        if length == 0:
+            # Closed rings start and end at the same point
+            distances = numpy.hypot (between[:, 0] - start[0], between[:, 1] - start[1])
+        else:
+            distances = numpy.abs (dx * (between[:, 1] - start[1]) - dy * (between[:, 0] - start[0])) / length
+
+        farthest = int (numpy.argmax (distances))
+
+        if distances[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+
+            stack.append ((first, middle))
+            stack.append ((middle, last))
+
+    return keep
+
+# Simplifies an (n, 2) array of [lon, lat] positions for a map at
+# 1:scale_denom centered on center_lat, so that no dropped vertex would
+# have been more than tolerance_mm away from the simplified line on
+# paper.  Returns an array with the kept positions.
+#
+# The work happens in Web Mercator coordinates, like the map tiles'.
+# The map's scale is only true at center_lat, and the whole map gets the
+# same Mercator units per paper millimeter as there, so the tolerance
+# gets converted with center_lat and not with the feature's latitude.
+#
+def simplify_lon_lat (positions, tolerance_mm, scale_denom, center_lat):
+    if len (positions) < 3:
+        return positions
+
+    (x, y) = coordinates_to_tile_and_fraction_array (0, positions[:, 1], positions[:, 0])
+
+    # At zoom 0 the whole world is one tile
+    mm_per_unit = compute_real_world_mm_per_tile (center_lat, 0)
+    tolerance = tolerance_mm * scale_denom / mm_per_unit
+
+    keep = douglas_peucker (numpy.column_stack ((x, y)), tolerance)
+
+    return positions[keep]
+
+#################### tests ####################
+
+class TestGeomSimplify (unittest.TestCase):
+    def test_collapses_straight_lines (self):
+        points = numpy.array ([[i, 0.0] for i in range (10)])
+        keep = douglas_peucker (points, 0.01)
+
+        self.assertEqual (keep.tolist (), [True] + [False] * 8 + [True])
+
+    def test_keeps_corners_beyond_the_tolerance (self):
+        points = numpy.array ([[0.0, 0.0], [1.0, 0.05], [2.0, 0.0], [3.0, 1.0], [4.0, 0.0]])
+
+        self.assertEqual (douglas_peucker (points, 0.1).tolist (), [True, False, True, True, True])
+        self.assertEqual (douglas_peucker (points, 0.01).tolist (), [True] * 5)
+
+    def test_keeps_closed_rings_closed (self):
+        ring = numpy.array ([[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.5, 1.0001], [0.0, 1.0], [0.0, 0.0]])
+        keep = douglas_peucker (ring, 0.01)
+
+        self.assertEqual (keep.tolist (), [True, True, True, False, True, True])
+
+    def test_tolerance_depends_on_the_scale (self):
+        # 1 km along the equator, with a 10 m bump in the middle
+        positions = numpy.array ([[0.0, 0.0], [0.0045, 0.00009], [0.009, 0.0]])
+
+        # At 1:10,000 the bump is 1 mm on paper; at 1:1,000,000 it is 0.01 mm
+        self.assertEqual (len (simplify_lon_lat (positions, 0.1, 10000, 0.0)), 3)
+        self.assertEqual (len (simplify_lon_lat (positions, 0.1, 1000000, 0.0)), 2)
+
+    def test_tolerance_depends_on_the_map_center (self):
+        # The 10 m bump is 1 mm on paper on a 1:10,000 map centered on the
+        # equator, but just under 0.1 mm on a 1:10,000 map centered at 84.3
+        # degrees, whose scale is only true up there
+        positions = numpy.array ([[0.0, 0.0], [0.0045, 0.00009], [0.009, 0.0]])
+
+        self.assertEqual (len (simplify_lon_lat (positions, 0.1, 10000, 0.0)), 3)
+        self.assertEqual (len (simplify_lon_lat (positions, 0.1, 10000, 84.3)), 2)
+
+    def test_reduces_external_data (self):
+        original = 0
+        simplified = 0
+
+        for feature in geojsonstream.iter_features_in_file ("external-data/power.geojson"):
+            if feature["geometry"]["type"] == "LineString":
+                positions = numpy.array (feature["geometry"]["coordinates"], dtype = numpy.float64)[:, 0:2]
+
+                original += len (positions)
+                simplified += len (simplify_lon_lat (positions, compute_tolerance_mm (0.25), 50000, 45.0))
+
+        self.assertTrue (simplified < original)
@@ -0,0 +1,267 @@
+import email.utils
+import random
+import threading
+import time
+import unittest
+
+# What to do with an HTTP response, depending on its status code
+RESPONSE_OK    = "ok"
+RESPONSE_RETRY = "retry"
+RESPONSE_FAIL  = "fail"
+
+# Statuses that mean "try again later"; everything else that is not a
+# success is permanent, like a 404 for a tile outside the style's bounds.
+retryable_statuses = { 408, 429, 500, 502, 503, 504 }
+
+# Statuses that mean the server is overloaded or throttling us
+congestion_statuses = { 429, 500, 502, 503, 504 }
+
+# Parses the value of a Retry-After header, which can be a number of
+# seconds or an HTTP date.  Returns the number of seconds to wait, or
+# None if the value is missing or invalid.
+#
+def parse_retry_after (value, now = None):
+    if value is None:
+        return None
+
+    value = value.strip ()
+
+    if value.isdigit ():
+        return float (value)
+
+    try:
+        date = email.utils.parsedate_to_datetime (value)
+    except (TypeError, ValueError):
+        return None
+
+    if now is None:
+        now = time.time ()
+
+    return max (0.0, date.timestamp () - now)
+
+class RetryPolicy:
+    def __init__ (self, max_retries = 5, base_delay_s = 0.5, max_delay_s = 60.0):
+        self.max_retries = max_retries
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+
+    def classify (self, status_code):
+        if status_code == 200 or status_code == 304:
+            return RESPONSE_OK
+        elif status_code in retryable_statuses:
+            return RESPONSE_RETRY
+        else:
+            return RESPONSE_FAIL
+
+    def should_retry (self, status_code, attempt):
+        return self.classify (status_code) == RESPONSE_RETRY and attempt < self.max_retries
+
+    # Returns how many seconds to wait before retry number attempt (starting
+    # at 0).  This is exponential backoff with "full jitter", so that
+    # threads that failed at the same time don't all retry at the same
+    # time.  If the server sent a Retry-After header, that wins.
+    #
+    def compute_delay (self, attempt, retry_after = None):
+        server_delay = parse_retry_after (retry_after)
+        if server_delay is not None:
+            return min (server_delay, self.max_delay_s)
+
+        ceiling = min (self.max_delay_s, self.base_delay_s * (2 ** attempt))
+        return random.uniform (0, ceiling)
+
+# Limits requests to rate per second on average, allowing bursts of up
+# to burst requests.  A rate of 0 means no limit.  acquire() is safe to
+# call from many threads at once.
+#
+class TokenBucket:
+    def __init__ (self, rate, burst = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max (1.0, rate)
+
+        self.lock = threading.Lock ()
+        self.tokens = self.burst
+        self.last_refill = time.monotonic ()
+
+    def acquire (self):
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic ()
+                self.tokens = min (self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+
+                wait = (1.0 - self.tokens) / self.rate
+
+            time.sleep (wait)
+
+# Limits the number of concurrent requests with an additive-increase,
+# multiplicative-decrease scheme, like TCP congestion control.  When the
+# server throttles us or fails, the limit gets halved; while responses
+# come back faster than healthy_latency_s, the limit grows by about one
+# for every "limit" successful requests, up to maximum.
+#
+# Use acquire()/release() around each request, and report the outcome
+# with on_success() or on_congestion().
+#
+class AimdController:
+    def __init__ (self, maximum, minimum = 1, healthy_latency_s = 1.0):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.healthy_latency_s = healthy_latency_s
+
+        self.condition = threading.Condition ()
+        self.limit = float (maximum)
+        self.in_flight = 0
+        self.last_decrease = float ("-inf")
+
+    def get_limit (self):
+        return max (self.minimum, int (self.limit))
+
+    def acquire (self):
+        with self.condition:
+            while self.in_flight >= self.get_limit ():
+                self.condition.wait ()
+
+            self.in_flight += 1
+
+    def release (self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all ()
+
+    def on_success (self, latency_s):
+        with self.condition:
+            if latency_s < self.healthy_latency_s:
+                self.limit = min (float (self.maximum), self.limit + 1.0 / self.limit)
+                self.condition.notify_all ()
+
+    def on_congestion (self):
+        with self.condition:
+            # Requests that were already in flight when the server started
+            # throttling us will fail too; only back off once for them.
+            now = time.monotonic ()
+            if now - self.last_decrease < self.healthy_latency_s:
+                return
+
+            self.last_decrease = now
+            self.limit = max (float (self.minimum), self.limit / 2.0)
+
+#################### tests ####################
+
+class TestRetryPolicy (unittest.TestCase):
+    def test_classifies_statuses (self):
+        policy = RetryPolicy ()
+
+        self.assertEqual (policy.classify (200), RESPONSE_OK)
+        self.assertEqual (policy.classify (304), RESPONSE_OK)
+        self.assertEqual (policy.classify (429), RESPONSE_RETRY)
+        self.assertEqual (policy.classify (503), RESPONSE_RETRY)
+        self.assertEqual (policy.classify (404), RESPONSE_FAIL)
+        self.assertEqual (policy.classify (401), RESPONSE_FAIL)
+
+    def test_gives_up_after_max_retries (self):
+        policy = RetryPolicy (max_retries = 2)
+
+        self.assertTrue (policy.should_retry (503, 0))
+        self.assertTrue (policy.should_retry (503, 1))
+        self.assertFalse (policy.should_retry (503, 2))
+        self.assertFalse (policy.should_retry (404, 0))
+
+    def test_backoff_is_bounded_and_grows (self):
+        policy = RetryPolicy (base_delay_s = 1.0, max_delay_s = 10.0)
+
+        for i in range (100):
+            self.assertLessEqual (policy.compute_delay (0), 1.0)
+            self.assertLessEqual (policy.compute_delay (2), 4.0)
+            self.assertLessEqual (policy.compute_delay (20), 10.0)
+
+        self.assertGreater (max (policy.compute_delay (3) for i in range (100)), 1.0)
+
+    def test_honors_retry_after (self):
+        policy = RetryPolicy (max_delay_s = 10.0)
+
+        self.assertEqual (policy.compute_delay (0, "7"), 7.0)
+        self.assertEqual (policy.compute_delay (0, "120"), 10.0)
+
+    def test_parses_retry_after_dates (self):
+        now = email.utils.parsedate_to_datetime ("Wed, 21 Oct 2015 07:28:00 GMT").timestamp ()
+
+        self.assertEqual (parse_retry_after ("Wed, 21 Oct 2015 07:28:30 GMT", now), 30.0)
+        self.assertEqual (parse_retry_after ("Wed, 21 Oct 2015 07:27:00 GMT", now), 0.0)
+        self.assertIsNone (parse_retry_after ("soon", now))
+        self.assertIsNone (parse_retry_after (None, now))
+
+class TestTokenBucket (unittest.TestCase):
+    def test_unlimited_rate_does_not_block (self):
+        bucket = TokenBucket (0)
+
+        start = time.monotonic ()
+        for i in range (1000):
+            bucket.acquire ()
+
+        self.assertLess (time.monotonic () - start, 0.5)
+
+    def test_limits_rate_after_burst (self):
+        bucket = TokenBucket (100, burst = 5)
+
+        start = time.monotonic ()
+        for i in range (15):
+            bucket.acquire ()
+
+        # 5 tokens come from the burst, the other 10 take 10 ms each
+        self.assertGreaterEqual (time.monotonic () - start, 0.09)
+
+class TestAimdController (unittest.TestCase):
+    def test_halves_limit_on_congestion (self):
+        controller = AimdController (16, healthy_latency_s = 0.0)
+
+        controller.on_congestion ()
+        self.assertEqual (controller.get_limit (), 8)
+
+        controller.on_congestion ()
+        self.assertEqual (controller.get_limit (), 4)
+
+    def test_never_goes_below_minimum (self):
+        controller = AimdController (4, minimum = 2, healthy_latency_s = 0.0)
+
+        for i in range (10):
+            controller.on_congestion ()
+
+        self.assertEqual (controller.get_limit (), 2)
+
+    def test_backs_off_once_per_burst_of_failures (self):
+        controller = AimdController (16, healthy_latency_s = 60.0)
+
+        for i in range (5):
+            controller.on_congestion ()
+
+        self.assertEqual (controller.get_limit (), 8)
+
+    def test_ramps_up_with_healthy_latency (self):
+        controller = AimdController (8, healthy_latency_s = 1.0)
+        controller.limit = 2.0
+
+        for i in range (17):
+            controller.on_success (0.1)
+
+        self.assertEqual (controller.get_limit (), 6)
+
+        for i in range (100):
+            controller.on_success (0.1)
+
+        self.assertEqual (controller.get_limit (), 8)
+
+    def test_slow_responses_do_not_ramp_up (self):
+        controller = AimdController (8, healthy_latency_s = 1.0)
+        controller.limit = 2.0
+
+        for i in range (20):
+            controller.on_success (5.0)
+
+        self.assertEqual (controller.get_limit (), 2)
@@ -7,6 +7,8 @@ import chartrenderer
 import tile_provider
 import argparse
 import math
+import time
+import concurrent.futures
 import cairo
 import json
 import config
@@ -32,36 +34,235 @@ def jsonfile (filename):
 
     return data
 
+# format can be a comma-separated list like "pdf,svg,png", to render the
+# same map to several files at once; then each file gets the extension
+# for its format.  Returns a list of (format, filename).
+#
+def make_outputs (format, output):
+    formats = format.split (",")
+
+    if len (formats) == 1:
+        return [(format, output)]
+
+    return [(f, paperrenderer.make_output_filename (output, f)) for f in formats]
+
+# Maps in a batch keep this many decoded tiles in memory, so that maps
+# of overlapping regions don't decode the same tiles again.  Each one
+# takes 1 MB for 512-pixel tiles.  The "decoded_tile_cache_size" in the
+# configuration can change it.
+default_batch_decoded_tiles = 64
+
+# Renders maps one after the other with a single tile provider, so that
+# they share its HTTP connections and tile cache, the tiles that are
+# already decoded, and the tile decoding processes.
+#
+class BatchRenderer:
+    def __init__ (self, config_data, dpi, decoded_tiles = None, provider = None):
+        self.config_data = config_data
+        self.dpi = dpi
+
+        # A chartrenderer.DecodedTileCache, which other BatchRenderers
+        # can share
+        if decoded_tiles is None:
+            decoded_tiles = chartrenderer.DecodedTileCache ()
+
+        self.decoded_tiles = decoded_tiles
+
+        # A provider from the caller is shared with other BatchRenderers,
+        # and the caller closes it
+        if provider is None:
+            self.provider = tile_provider.make_tile_provider (config_data)
+            self.owns_provider = True
+        else:
+            self.provider = provider
+            self.owns_provider = False
+
+        self.chart_renderer = None
+
+        # Passed on to each ChartRenderer, to cancel a render from another thread
+        self.cancel_event = None
+
+    def render_map (self, json_config, format, output):
+        map_layout = maplayout.MapLayout ()
+        map_layout.load_from_json (json_config)
+
+        geometry = chartgeometry.ChartGeometry (map_layout, self.provider)
+
+        paper_renderer = paperrenderer.PaperRenderer (map_layout)
+        chart_renderer = chartrenderer.ChartRenderer (geometry)
+        chart_renderer.load_config (self.config_data)
+
+        previous = self.chart_renderer
+        if previous is not None:
+            chart_renderer.tile_decoder = previous.tile_decoder
+
+        chart_renderer.decoded_tiles = self.decoded_tiles
+        chart_renderer.cancel_event = self.cancel_event
+
+        geometry.compute_extents_of_downloaded_tiles ()
+
+        (lat1, lon1) = geometry.transform_page_mm_to_lat_lon (map_layout.map_to_left_margin_mm, map_layout.map_to_top_margin_mm + map_layout.map_height_mm)
+        (lat2, lon2) = geometry.transform_page_mm_to_lat_lon (map_layout.map_to_left_margin_mm + map_layout.map_width_mm, map_layout.map_to_top_margin_mm)
+
+        print ("Map bounds: {0} {1} {2} {3}".format (lat1, lon1, lat2, lon2))
+
+        self.chart_renderer = chart_renderer
+        paper_renderer.render_formats (make_outputs (format, output), chart_renderer, self.dpi)
+
+    # Renders one map of a batch.  Returns (output, seconds, error), where
+    # error is None if the map got rendered fine; a map that fails does
+    # not stop the rest of the batch.
+    #
+    def render_job (self, config_filename, format, output):
+        start = time.monotonic ()
+
+        try:
+            self.render_map (jsonfile (config_filename), format, output)
+            error = None
+        except Exception as e:
+            error = "{0}: {1}".format (type (e).__name__, e)
+            print ("Could not render {0}: {1}".format (output, error))
+
+        return (output, time.monotonic () - start, error)
+
+    def close (self):
+        if self.chart_renderer is not None:
+            self.chart_renderer.close ()
+
+        if self.owns_provider:
+            self.provider.close ()
+
+# For process-level parallelism: each worker process has its own
+# BatchRenderer, and renders the jobs it gets with it.
+worker_batch_renderer = None
+
+def start_batch_worker (config_data, dpi, max_decoded_tiles):
+    global worker_batch_renderer
+
+    # The batch already keeps all the cores busy
+    config_data = dict (config_data, decode_processes = 0)
+    worker_batch_renderer = BatchRenderer (config_data, dpi, chartrenderer.DecodedTileCache (max_decoded_tiles))
+
+def render_job_in_worker (config_filename, format, output):
+    result = worker_batch_renderer.render_job (config_filename, format, output)
+
+    # Worker processes get killed without notice when the pool shuts down
+    worker_batch_renderer.provider.flush ()
+
+    return result
+
+# Renders a list of (config_filename, format, output).  Returns a list
+# of (output, seconds, error) in the same order.
+#
+def render_batch (config_data, jobs, dpi, num_processes = 1):
+    if len (jobs) > 1:
+        max_decoded_tiles = config_data.get ("decoded_tile_cache_size", default_batch_decoded_tiles)
+    else:
+        max_decoded_tiles = 0
+
+    if num_processes <= 1:
+        batch_renderer = BatchRenderer (config_data, dpi, chartrenderer.DecodedTileCache (max_decoded_tiles))
+
+        try:
+            return [batch_renderer.render_job (*job) for job in jobs]
+        finally:
+            batch_renderer.close ()
+
+    # The processes share the request limits
+    worker_config = tile_provider.split_request_limits (config_data, num_processes)
+    tile_provider.warn_about_directory_cache (config_data, num_processes)
+
+    with concurrent.futures.ProcessPoolExecutor (max_workers = num_processes,
+                                                 initializer = start_batch_worker,
+                                                 initargs = (worker_config, dpi, max_decoded_tiles)) as executor:
+        futures = [executor.submit (render_job_in_worker, *job) for job in jobs]
+        return [future.result () for future in futures]
+
+def print_batch_summary (results):
+    print ("")
+    print ("{0:>8}  {1}".format ("Seconds", "Output"))
+
+    for (output, seconds, error) in results:
+        print ("{0:8.1f}  {1}{2}".format (seconds, output, "" if error is None else "  FAILED: " + error))
+
+    num_failed = len ([r for r in results if r[2] is not None])
+    print ("{0} maps rendered, {1} failed".format (len (results) - num_failed, num_failed))
+
+# Reads a manifest for batch rendering.  It is a JSON list of objects
+# like { "config" : "mymap.json", "output" : "mymap.pdf", "format" :
+# "pdf" }, where "format" is optional.  Relative filenames are relative
+# to the manifest.  Returns a list of (config_filename, format, output).
+#
+def load_manifest (filename, default_format):
+    dirname = os.path.dirname (filename)
+    jobs = []
+
+    for entry in jsonfile (filename):
+        jobs.append ((os.path.join (dirname, entry["config"]),
+                      entry.get ("format", default_format),
+                      os.path.join (dirname, entry["output"])))
+
+    return jobs
+
 def main (config_data):
-    parser = argparse.ArgumentParser (description = "Makes a PDF or SVG map from Mapbox tiles.")
+    parser = argparse.ArgumentParser (description = "Makes a PDF, SVG, PNG or TIFF map from Mapbox tiles.")
 
-    parser.add_argument ("--config", type = jsonfile, required = True, metavar = "JSON-FILENAME")
-    parser.add_argument ("--format", type = str,      required = True, metavar = "STRING")
-    parser.add_argument ("--output", type = str,      required = True, metavar = "FILENAME")
+    parser.add_argument ("--config",   type = str,      action = "append", default = [], metavar = "JSON-FILENAME",
+                         help = "can be given more than once, with one --output for each")
+    parser.add_argument ("--format",   type = str,      metavar = "STRING",
+                         help = "pdf, svg, png, tiff or tiff-tiled; several of them separated by commas render the map once and write all of them")
+    parser.add_argument ("--output",   type = str,      action = "append", default = [], metavar = "FILENAME")
+    parser.add_argument ("--dpi",      type = float,    default = paperrenderer.default_raster_dpi, metavar = "DPI",
+                         help = "resolution for raster formats")
+    parser.add_argument ("--manifest", type = str,      metavar = "JSON-FILENAME",
+                         help = "list of maps to render")
+    parser.add_argument ("--jobs",     type = int,      default = 1,
+                         help = "how many processes render the maps of a batch")
 
     args = parser.parse_args ()
 
-    json_config = args.config
-    map_layout = maplayout.MapLayout ()
-    map_layout.load_from_json (json_config)
+    if len (args.config) == 0 and args.manifest is None:
+        parser.error ("the following arguments are required: --config, --format, --output")
 
-    provider_classname = '{}TileProvider'.format (config_data['provider'])
-    provider_class = getattr (tile_provider, provider_classname)
-    provider = provider_class (config_data)
+    if len (args.config) != len (args.output):
+        parser.error ("each --config needs its own --output")
 
-    geometry = chartgeometry.ChartGeometry (map_layout, provider)
+    jobs = [(config_filename, args.format, output) for (config_filename, output) in zip (args.config, args.output)]
 
-    paper_renderer = paperrenderer.PaperRenderer (map_layout)
-    chart_renderer = chartrenderer.ChartRenderer (geometry)
+    if args.manifest is not None:
+        try:
+            jobs += load_manifest (args.manifest, args.format)
+        except (KeyError, TypeError, AttributeError) as e:
+            parser.error ("the manifest {0} must be a list of objects with \"config\" and \"output\"".format (args.manifest))
+        except argparse.ArgumentTypeError as e:
+            parser.error (str (e))
 
-    geometry.compute_extents_of_downloaded_tiles ()
+    if any (format is None for (config_filename, format, output) in jobs):
+        parser.error ("the following arguments are required: --format")
 
-    (lat1, lon1) = geometry.transform_page_mm_to_lat_lon (map_layout.map_to_left_margin_mm, map_layout.map_to_top_margin_mm + map_layout.map_height_mm)
-    (lat2, lon2) = geometry.transform_page_mm_to_lat_lon (map_layout.map_to_left_margin_mm + map_layout.map_width_mm, map_layout.map_to_top_margin_mm)
+    if len (jobs) == 1:
+        # Errors in a single map go straight to the user
+        (config_filename, format, output) = jobs[0]
 
-    print ("Map bounds: {0} {1} {2} {3}".format (lat1, lon1, lat2, lon2))
+        try:
+            json_config = jsonfile (config_filename)
+        except argparse.ArgumentTypeError as e:
+            parser.error (str (e))
 
-    paper_renderer.render (args.format, args.output, chart_renderer)
+        batch_renderer = BatchRenderer (config_data, args.dpi)
+
+        try:
+            batch_renderer.render_map (json_config, format, output)
+        finally:
+            batch_renderer.close ()
+
+        return
+
+    results = render_batch (config_data, jobs, args.dpi, args.jobs)
+    print_batch_summary (results)
+
+    if any (error is not None for (output, seconds, error) in results):
+        exit (1)
 
 if __name__ == "__main__":
     try:
@@ -18,6 +18,9 @@ default_draw_ticks     = True
 default_draw_map       = True
 default_draw_scale     = True
 
+default_map_mosaic     = False
+default_target_dpi     = None
+
 default_paper_width_mm  = inch_to_mm (11)
 default_paper_height_mm = inch_to_mm (8.5)
 default_zoom            = 15
@@ -35,6 +38,89 @@ default_map_to_top_margin_mm  = inch_to_mm (0.375)
 default_scale_xpos_mm = inch_to_mm (5.5)
 default_scale_ypos_mm = inch_to_mm (8.125)
 
+# Defaults for the GeoJSON overlays in "overlays"
+default_overlay_line_color      = (0.8, 0.0, 0.0)
+default_overlay_line_width_mm   = 0.25
+default_overlay_fill_color      = None
+default_overlay_fill_opacity    = 0.3
+default_overlay_point_radius_mm = 0.5
+default_overlay_simplify        = True
+default_overlay_point_symbol    = "dot"
+
+overlay_point_symbols = ("dot", "square", "cross")
+
+# Parses "#rrggbb" into an (r, g, b) tuple of floats in [0, 1]
+def parse_color (value):
+    if not (isinstance (value, str) and len (value) == 7 and value[0] == "#"):
+        raise ValueError ("colors must look like \"#rrggbb\", not {0}".format (value))
+
+    return tuple (int (value[i : i + 2], 16) / 255.0 for i in (1, 3, 5))
+
+# A GeoJSON file to draw on top of the map, and how to draw it
+class OverlayLayer:
+    def __init__ (self):
+        self.filename = None
+
+        self.line_color      = default_overlay_line_color
+        self.line_width_mm   = default_overlay_line_width_mm
+        self.fill_color      = default_overlay_fill_color
+        self.fill_opacity    = default_overlay_fill_opacity
+        self.point_radius_mm = default_overlay_point_radius_mm
+        self.point_symbol    = default_overlay_point_symbol
+
+        # Whether to drop the vertices of lines and polygons that are too
+        # close together to make a difference at the map's scale
+        self.simplify = default_overlay_simplify
+
+        # Only draw the features whose properties have these values.  Each
+        # value can be a string or a list of strings.
+        self.filter = {}
+
+    def load_from_json (self, json_obj):
+        if "geojson" not in json_obj:
+            raise ValueError ("overlays need a \"geojson\" filename")
+
+        self.filename = json_obj["geojson"]
+
+        if "line-color" in json_obj:
+            self.line_color = parse_color (json_obj["line-color"])
+
+        if "line-width" in json_obj:
+            self.line_width_mm = parse_units_value (json_obj["line-width"])
+
+        if "fill-color" in json_obj:
+            self.fill_color = parse_color (json_obj["fill-color"])
+
+        if "fill-opacity" in json_obj:
+            self.fill_opacity = json_obj["fill-opacity"]
+
+        if "point-radius" in json_obj:
+            self.point_radius_mm = parse_units_value (json_obj["point-radius"])
+
+        if "point-symbol" in json_obj:
+            if json_obj["point-symbol"] not in overlay_point_symbols:
+                raise ValueError ("point-symbol must be one of {0}".format (", ".join (overlay_point_symbols)))
+
+            self.point_symbol = json_obj["point-symbol"]
+
+        if "simplify" in json_obj:
+            self.simplify = json_obj["simplify"]
+
+        if "filter" in json_obj:
+            self.filter = json_obj["filter"]
+
+    def matches (self, properties):
+        for (key, wanted) in self.filter.items ():
+            value = properties.get (key) if properties is not None else None
+
+            if isinstance (wanted, list):
+                if value not in wanted:
+                    return False
+            elif value != wanted:
+                return False
+
+        return True
+
 class MapLayout:
     def __init__ (self):
         # Sane defaults for if a config file is not specified
@@ -44,6 +130,11 @@ class MapLayout:
         self.draw_map       = default_draw_map
         self.draw_scale     = default_draw_scale
 
+        self.map_mosaic     = default_map_mosaic
+        self.target_dpi     = default_target_dpi
+
+        self.overlays = []
+
         self.paper_width_mm  = default_paper_width_mm
         self.paper_height_mm = default_paper_height_mm
         self.zoom            = default_zoom
@@ -94,6 +185,20 @@ class MapLayout:
         if "draw-scale" in json_obj:
             self.draw_scale = json_obj["draw-scale"]
 
+        if "map-mosaic" in json_obj:
+            self.map_mosaic = json_obj["map-mosaic"]
+
+        if "target-dpi" in json_obj:
+            self.target_dpi = json_obj["target-dpi"]
+
+        if "overlays" in json_obj:
+            self.overlays = []
+
+            for overlay_json in json_obj["overlays"]:
+                overlay = OverlayLayer ()
+                overlay.load_from_json (overlay_json)
+                self.overlays.append (overlay)
+
         if "paper-width" in json_obj:
             self.paper_width_mm = parse_units_value (json_obj["paper-width"])
 
@@ -173,6 +278,71 @@ class TestMapLayout (testutils.TestCaseHelper):
         self.assertEqual (layout.draw_map, False)
         self.assertEqual (layout.draw_scale, False)
 
+    def test_map_layout_parses_map_mosaic (self):
+        layout = MapLayout ()
+        self.assertEqual (layout.map_mosaic, default_map_mosaic)
+
+        layout.load_from_json (json.loads ("""
+          { "map-mosaic" : true }
+        """))
+
+        self.assertEqual (layout.map_mosaic, True)
+
+    def test_map_layout_parses_target_dpi (self):
+        layout = MapLayout ()
+        self.assertEqual (layout.target_dpi, default_target_dpi)
+
+        layout.load_from_json (json.loads ("""
+          { "target-dpi" : 564 }
+        """))
+
+        self.assertEqual (layout.target_dpi, 564)
+
+    def test_map_layout_parses_overlays (self):
+        layout = MapLayout ()
+        self.assertEqual (layout.overlays, [])
+
+        layout.load_from_json (json.loads ("""
+          { "overlays" : [ { "geojson" : "external-data/power.geojson",
+                             "line-color" : "#ff8000",
+                             "line-width" : "0.5 mm",
+                             "filter" : { "power" : [ "line", "minor_line" ] } },
+                           { "geojson" : "external-data/landuse-industrial.geojson",
+                             "fill-color" : "#000000",
+                             "fill-opacity" : 0.5,
+                             "simplify" : false,
+                             "point-symbol" : "cross" } ] }
+        """))
+
+        (power, industrial) = layout.overlays
+
+        self.assertEqual (power.filename, "external-data/power.geojson")
+        self.assertEqual (power.line_color, (1.0, 128 / 255.0, 0.0))
+        self.assertFloatEquals (power.line_width_mm, 0.5)
+        self.assertEqual (power.fill_color, default_overlay_fill_color)
+
+        self.assertEqual (industrial.fill_color, (0.0, 0.0, 0.0))
+        self.assertEqual (industrial.fill_opacity, 0.5)
+        self.assertEqual (industrial.line_color, default_overlay_line_color)
+
+        self.assertTrue (power.simplify)
+        self.assertFalse (industrial.simplify)
+
+        self.assertEqual (power.point_symbol, default_overlay_point_symbol)
+        self.assertEqual (industrial.point_symbol, "cross")
+
+        with self.assertRaises (ValueError):
+            OverlayLayer ().load_from_json ({ "geojson" : "x.geojson", "point-symbol" : "star" })
+
+    def test_overlay_filters_features_by_properties (self):
+        overlay = OverlayLayer ()
+        overlay.load_from_json ({ "geojson" : "x.geojson", "filter" : { "power" : [ "line", "minor_line" ], "voltage" : "115000" } })
+
+        self.assertTrue (overlay.matches ({ "power" : "line", "voltage" : "115000" }))
+        self.assertFalse (overlay.matches ({ "power" : "tower", "voltage" : "115000" }))
+        self.assertFalse (overlay.matches ({ "power" : "line" }))
+        self.assertFalse (overlay.matches (None))
+
     def test_map_layout_has_us_letter_default_paper_size (self):
         layout = MapLayout ()
 
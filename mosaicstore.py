@@ -0,0 +1,235 @@
+import os
+import time
+import mmap
+import struct
+import tempfile
+import shutil
+import unittest
+
+# Keeps composited map mosaics in memory-mapped files, so that the OS can
+# page out gigapixel mosaics instead of keeping them in RAM, and so that
+# re-rendering the same map can reuse a mosaic that was already
+# composited.
+#
+# A mosaic file has a small header followed by the raw pixels, starting
+# at a page boundary:
+#
+#   magic       8 bytes, "LMMOSAIC"
+#   version     uint32
+#   width       uint32
+#   height      uint32
+#   stride      uint32
+
+magic = b"LMMOSAIC"
+version = 1
+header_format = "<8sIIII"
+
+pixels_offset = mmap.ALLOCATIONGRANULARITY
+
+# Temporary files from create_mosaic() older than this are left over from
+# renders that crashed, and evict_mosaics() removes them.
+stale_tmp_age_s = 24 * 60 * 60
+
+class MappedMosaic:
+    def __init__ (self, file, width, height, stride, filename = None, tmp_filename = None):
+        self.file = file
+        self.width = width
+        self.height = height
+        self.stride = stride
+
+        # For mosaics from create_mosaic(), which get renamed from
+        # tmp_filename to filename by commit_mosaic()
+        self.filename = filename
+        self.tmp_filename = tmp_filename
+
+        self.map = mmap.mmap (file.fileno (), pixels_offset + stride * height)
+
+    # Returns a writable buffer with the pixels, suitable for
+    # cairo.ImageSurface.create_for_data().  The mapping stays alive for
+    # as long as someone holds a reference to the buffer.
+    def get_pixels (self):
+        return memoryview (self.map)[pixels_offset : pixels_offset + self.stride * self.height]
+
+def compute_file_size (height, stride):
+    return pixels_offset + stride * height
+
+# Opens a complete mosaic that was stored earlier.  Returns None if there
+# is no such file, or if it does not have the expected size.
+#
+def open_mosaic (filename, width, height, stride):
+    try:
+        f = open (filename, "r+b")
+    except FileNotFoundError:
+        return None
+
+    header = f.read (struct.calcsize (header_format))
+
+    try:
+        fields = struct.unpack (header_format, header)
+    except struct.error:
+        f.close ()
+        return None
+
+    if (fields != (magic, version, width, height, stride)
+        or os.fstat (f.fileno ()).st_size != compute_file_size (height, stride)):
+        f.close ()
+        return None
+
+    mosaic = MappedMosaic (f, width, height, stride)
+
+    # Update the modification time, so that evict_mosaics() knows it was used
+    os.utime (filename)
+
+    return mosaic
+
+# Creates a mosaic for filling in.  Call commit_mosaic() once its pixels
+# are complete; until then it lives in a temporary file, so an
+# interrupted render never leaves a half-composited mosaic behind.
+#
+def create_mosaic (filename, width, height, stride):
+    dirname = os.path.dirname (filename)
+    os.makedirs (dirname, exist_ok = True)
+
+    (fd, tmp_filename) = tempfile.mkstemp (dir = dirname, suffix = ".tmp")
+    f = os.fdopen (fd, "r+b")
+
+    f.write (struct.pack (header_format, magic, version, width, height, stride))
+    f.truncate (compute_file_size (height, stride))
+
+    return MappedMosaic (f, width, height, stride, filename, tmp_filename)
+
+def commit_mosaic (mosaic):
+    mosaic.map.flush ()
+    os.replace (mosaic.tmp_filename, mosaic.filename)
+
+# Throws away a mosaic from create_mosaic() that could not be filled in.
+# If a surface still uses the pixels, the mapping stays alive until the
+# surface is freed, but the file is gone.
+def discard_mosaic (mosaic):
+    try:
+        os.unlink (mosaic.tmp_filename)
+    except FileNotFoundError:
+        pass
+
+    try:
+        mosaic.map.close ()
+    except BufferError:
+        pass
+
+    mosaic.file.close ()
+
+# Removes the least recently used mosaics in a directory until their
+# total size is under max_size_bytes.
+#
+def evict_mosaics (dirname, max_size_bytes):
+    try:
+        names = os.listdir (dirname)
+    except FileNotFoundError:
+        return
+
+    now = time.time ()
+
+    found = []
+    for name in names:
+        path = os.path.join (dirname, name)
+
+        if name.endswith (".tmp"):
+            try:
+                if now - os.stat (path).st_mtime > stale_tmp_age_s:
+                    os.unlink (path)
+            except OSError:
+                pass
+
+            continue
+
+        if not name.endswith (".mosaic"):
+            continue
+
+        try:
+            st = os.stat (path)
+        except OSError:
+            continue
+
+        found.append ((st.st_mtime, path, st.st_size))
+
+    found.sort ()
+    total_size = sum (size for (mtime, path, size) in found)
+
+    for (mtime, path, size) in found:
+        if total_size <= max_size_bytes:
+            break
+
+        try:
+            os.unlink (path)
+        except FileNotFoundError:
+            pass
+
+        total_size -= size
+
+#################### tests ####################
+
+class TestMosaicStore (unittest.TestCase):
+    def setUp (self):
+        self.path = tempfile.mkdtemp ()
+        self.filename = os.path.join (self.path, "test.mosaic")
+
+    def tearDown (self):
+        shutil.rmtree (self.path)
+
+    def test_missing_mosaic_returns_none (self):
+        self.assertIsNone (open_mosaic (self.filename, 10, 10, 40))
+
+    def test_mosaic_only_appears_after_commit (self):
+        mosaic = create_mosaic (self.filename, 10, 5, 40)
+        pixels = mosaic.get_pixels ()
+        self.assertEqual (len (pixels), 200)
+
+        pixels[0:4] = b"abcd"
+        self.assertIsNone (open_mosaic (self.filename, 10, 5, 40))
+
+        commit_mosaic (mosaic)
+
+        reopened = open_mosaic (self.filename, 10, 5, 40)
+        self.assertIsNotNone (reopened)
+        self.assertEqual (bytes (reopened.get_pixels ()[0:4]), b"abcd")
+
+    def test_rejects_mosaic_with_different_size (self):
+        mosaic = create_mosaic (self.filename, 10, 5, 40)
+        commit_mosaic (mosaic)
+
+        self.assertIsNone (open_mosaic (self.filename, 10, 6, 40))
+        self.assertIsNone (open_mosaic (self.filename, 11, 5, 44))
+
+    def test_evicts_least_recently_used_mosaics (self):
+        for (i, age) in enumerate ([30, 10, 20]):
+            mosaic = create_mosaic (os.path.join (self.path, "{0}.mosaic".format (i)), 10, 5, 40)
+            commit_mosaic (mosaic)
+
+            mtime = 1000000 - age
+            os.utime (os.path.join (self.path, "{0}.mosaic".format (i)), (mtime, mtime))
+
+        size = compute_file_size (5, 40)
+        evict_mosaics (self.path, size * 2)
+
+        self.assertEqual (sorted (os.listdir (self.path)), ["1.mosaic", "2.mosaic"])
+
+    def test_discarded_mosaic_leaves_no_files (self):
+        mosaic = create_mosaic (self.filename, 10, 5, 40)
+        pixels = mosaic.get_pixels ()
+        pixels[0:4] = b"abcd"
+
+        discard_mosaic (mosaic)
+
+        self.assertEqual (os.listdir (self.path), [])
+        self.assertIsNone (open_mosaic (self.filename, 10, 5, 40))
+
+    def test_evicts_stale_temporary_files (self):
+        stale = create_mosaic (os.path.join (self.path, "stale.mosaic"), 10, 5, 40)
+        fresh = create_mosaic (os.path.join (self.path, "fresh.mosaic"), 10, 5, 40)
+
+        mtime = time.time () - stale_tmp_age_s - 60
+        os.utime (stale.tmp_filename, (mtime, mtime))
+
+        evict_mosaics (self.path, 0)
+
+        self.assertEqual (os.listdir (self.path), [os.path.basename (fresh.tmp_filename)])
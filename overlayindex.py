@@ -0,0 +1,399 @@
+import os
+import math
+import json
+import shutil
+import hashlib
+import tempfile
+import unittest
+import geojsonstream
+
+# A uniform grid over the bounding boxes of the features in a GeoJSON
+# file, so that drawing an overlay only has to read the features that
+# can be visible on the map, instead of parsing the whole file.
+#
+# The index gets saved next to the GeoJSON file, in FILENAME.index.json,
+# with the byte offset of each feature in the file.  It is reused as long
+# as the GeoJSON file keeps the same size and modification time, or if
+# those change, the same SHA-256 hash.
+
+index_version = 1
+
+index_suffix = ".index.json"
+
+# The grid has about this many features per cell, on average
+features_per_cell = 4
+
+max_grid_size = 256
+
+def compute_file_sha256 (filename):
+    h = hashlib.sha256 ()
+
+    with open (filename, "rb") as f:
+        while True:
+            data = f.read (1024 * 1024)
+            if len (data) == 0:
+                break
+
+            h.update (data)
+
+    return h.hexdigest ()
+
+def extend_bbox (bbox, coordinates):
+    if len (coordinates) == 0:
+        return
+
+    if isinstance (coordinates[0], (int, float)):
+        (lon, lat) = (coordinates[0], coordinates[1])
+
+        bbox[0] = min (bbox[0], lon)
+        bbox[1] = min (bbox[1], lat)
+        bbox[2] = max (bbox[2], lon)
+        bbox[3] = max (bbox[3], lat)
+    else:
+        for c in coordinates:
+            extend_bbox (bbox, c)
+
+def extend_bbox_with_geometry (bbox, geometry):
+    if geometry is None:
+        return
+
+    if geometry.get ("type") == "GeometryCollection":
+        for part in geometry.get ("geometries", []):
+            extend_bbox_with_geometry (bbox, part)
+    else:
+        extend_bbox (bbox, geometry.get ("coordinates", []))
+
+# Returns [west, south, east, north] for a GeoJSON feature, or None if it
+# has no coordinates.
+def compute_feature_bbox (feature):
+    bbox = [math.inf, math.inf, -math.inf, -math.inf]
+    extend_bbox_with_geometry (bbox, feature.get ("geometry"))
+
+    if bbox[0] > bbox[2]:
+        return None
+
+    return bbox
+
+# Returns (bbox, columns, rows, cells) for a uniform grid over a list of
+# [west, south, east, north] bounding boxes.  The grid covers bbox with
+# columns x rows cells, and cells[row * columns + column] is the list of
+# the numbers of the boxes that overlap that cell.  bbox is None if there
+# are no boxes.
+def build_grid (bboxes):
+    if len (bboxes) == 0:
+        return (None, 0, 0, [])
+
+    bbox = [min (b[0] for b in bboxes),
+            min (b[1] for b in bboxes),
+            max (b[2] for b in bboxes),
+            max (b[3] for b in bboxes)]
+
+    grid_size = int (math.sqrt (len (bboxes) / features_per_cell))
+    grid_size = max (1, min (grid_size, max_grid_size))
+
+    cells = [[] for i in range (grid_size * grid_size)]
+
+    for (i, b) in enumerate (bboxes):
+        (col1, row1, col2, row2) = compute_cell_range (bbox, grid_size, grid_size, b[0], b[1], b[2], b[3])
+
+        for row in range (row1, row2 + 1):
+            for col in range (col1, col2 + 1):
+                cells[row * grid_size + col].append (i)
+
+    return (bbox, grid_size, grid_size, cells)
+
+# Returns the (col1, row1, col2, row2) range of cells of a grid from
+# build_grid() that a bbox overlaps, clamped to the grid.
+def compute_cell_range (grid_bbox, columns, rows, west, south, east, north):
+    (grid_west, grid_south, grid_east, grid_north) = grid_bbox
+
+    cell_width = (grid_east - grid_west) / columns
+    cell_height = (grid_north - grid_south) / rows
+
+    def clamp_column (lon):
+        if cell_width == 0:
+            return 0
+        return max (0, min (columns - 1, int ((lon - grid_west) / cell_width)))
+
+    def clamp_row (lat):
+        if cell_height == 0:
+            return 0
+        return max (0, min (rows - 1, int ((lat - grid_south) / cell_height)))
+
+    return (clamp_column (west), clamp_row (south), clamp_column (east), clamp_row (north))
+
+class OverlayIndex:
+    def __init__ (self, filename):
+        self.filename = filename
+
+        # (size, mtime_ns, sha256) of the GeoJSON file when it was indexed
+        self.source_size = None
+        self.source_mtime_ns = None
+        self.source_sha256 = None
+
+        # [start, end, west, south, east, north] for each feature
+        self.features = []
+
+        # The grid covers bbox with columns x rows cells.  cells[row *
+        # columns + column] is the list of the features that overlap that
+        # cell.
+        self.bbox = None
+        self.columns = 0
+        self.rows = 0
+        self.cells = []
+
+    def build (self):
+        st = os.stat (self.filename)
+
+        self.source_size = st.st_size
+        self.source_mtime_ns = st.st_mtime_ns
+        self.source_sha256 = compute_file_sha256 (self.filename)
+
+        self.features = []
+
+        with geojsonstream.open_geojson (self.filename) as f:
+            for (start, end, feature) in geojsonstream.iter_features_and_offsets (f):
+                bbox = compute_feature_bbox (feature)
+
+                if bbox is not None:
+                    self.features.append ([start, end] + bbox)
+
+        self.build_grid ()
+
+    def build_grid (self):
+        (self.bbox, self.columns, self.rows, self.cells) = build_grid ([f[2:6] for f in self.features])
+
+    def compute_cell_range (self, west, south, east, north):
+        return compute_cell_range (self.bbox, self.columns, self.rows, west, south, east, north)
+
+    # Returns the sorted numbers of the features whose bounding boxes
+    # overlap the given one.
+    def query (self, west, south, east, north):
+        if self.bbox is None:
+            return []
+
+        (grid_west, grid_south, grid_east, grid_north) = self.bbox
+
+        if west > grid_east or east < grid_west or south > grid_north or north < grid_south:
+            return []
+
+        (col1, row1, col2, row2) = self.compute_cell_range (west, south, east, north)
+
+        found = set ()
+
+        for row in range (row1, row2 + 1):
+            for col in range (col1, col2 + 1):
+                for i in self.cells[row * self.columns + col]:
+                    f = self.features[i]
+
+                    if f[2] <= east and f[4] >= west and f[3] <= north and f[5] >= south:
+                        found.add (i)
+
+        return sorted (found)
+
+    # Yields the features whose bounding boxes overlap the given one, in
+    # file order, reading only those from the GeoJSON file.
+    def iter_features_in_bbox (self, west, south, east, north):
+        for (i, feature) in self.read_features (self.query (west, south, east, north)):
+            yield feature
+
+    # Yields (number, feature) for the given feature numbers, reading only
+    # those from the GeoJSON file.
+    def read_features (self, numbers):
+        if len (numbers) == 0:
+            return
+
+        with open (self.filename, "rb") as f:
+            for i in numbers:
+                (start, end) = self.features[i][0:2]
+                yield (i, geojsonstream.read_feature_at (f, start, end))
+
+    # Yields (number, properties, shapes) for the given feature numbers,
+    # with the shapes from geojsonstream.make_shape_arrays(), like
+    # overlaystore.OverlayStore.read_feature_shapes().
+    def read_feature_shapes (self, numbers):
+        for (i, feature) in self.read_features (numbers):
+            yield (i, feature.get ("properties"), geojsonstream.make_shape_arrays (feature.get ("geometry")))
+
+    # Changes when the GeoJSON file's contents change
+    def get_cache_key (self):
+        return self.source_sha256
+
+    def to_json (self):
+        return {
+            "version"         : index_version,
+            "source_size"     : self.source_size,
+            "source_mtime_ns" : self.source_mtime_ns,
+            "source_sha256"   : self.source_sha256,
+            "bbox"            : self.bbox,
+            "columns"         : self.columns,
+            "rows"            : self.rows,
+            "features"        : self.features,
+            "cells"           : self.cells
+        }
+
+    def load_from_json (self, json_obj):
+        self.source_size = json_obj["source_size"]
+        self.source_mtime_ns = json_obj["source_mtime_ns"]
+        self.source_sha256 = json_obj["source_sha256"]
+        self.bbox = json_obj["bbox"]
+        self.columns = json_obj["columns"]
+        self.rows = json_obj["rows"]
+        self.features = json_obj["features"]
+        self.cells = json_obj["cells"]
+
+    # Writes the sidecar file atomically, so that concurrent renders never
+    # see a partial one.  Failing to write it, for example because the
+    # GeoJSON file is in a read-only directory, is not an error; the
+    # index just gets rebuilt next time.
+    def save (self):
+        sidecar = self.filename + index_suffix
+
+        try:
+            (fd, tmp_filename) = tempfile.mkstemp (dir = os.path.dirname (os.path.abspath (sidecar)),
+                                                   prefix = ".index-")
+        except OSError:
+            return
+
+        try:
+            with os.fdopen (fd, "w") as f:
+                json.dump (self.to_json (), f)
+
+            os.replace (tmp_filename, sidecar)
+        except OSError:
+            os.unlink (tmp_filename)
+
+# Returns True if the sidecar index still describes the GeoJSON file.
+# Updates the index's saved modification time if only that changed.
+def check_index (index):
+    st = os.stat (index.filename)
+
+    if st.st_size != index.source_size:
+        return False
+
+    if st.st_mtime_ns == index.source_mtime_ns:
+        return True
+
+    if compute_file_sha256 (index.filename) != index.source_sha256:
+        return False
+
+    index.source_mtime_ns = st.st_mtime_ns
+    index.save ()
+
+    return True
+
+def read_sidecar (filename):
+    try:
+        with open (filename + index_suffix) as f:
+            json_obj = json.load (f)
+    except (OSError, ValueError):
+        return None
+
+    if json_obj.get ("version") != index_version:
+        return None
+
+    index = OverlayIndex (filename)
+    index.load_from_json (json_obj)
+
+    return index
+
+# Indexes that were already loaded in this process, by absolute filename,
+# so that rendering many sheets doesn't read the sidecar each time.
+loaded_indexes = {}
+
+# Returns the OverlayIndex for a GeoJSON file, from memory, from its
+# sidecar file, or by indexing the file and writing the sidecar.
+def load_index (filename):
+    key = os.path.abspath (filename)
+
+    index = loaded_indexes.get (key)
+
+    if index is None or not check_index (index):
+        index = read_sidecar (filename)
+
+        if index is None or not check_index (index):
+            index = OverlayIndex (filename)
+            index.build ()
+            index.save ()
+
+        loaded_indexes[key] = index
+
+    return index
+
+#################### tests ####################
+
+class TestOverlayIndex (unittest.TestCase):
+    def setUp (self):
+        self.path = tempfile.mkdtemp ()
+        self.filename = os.path.join (self.path, "power.geojson")
+        shutil.copyfile ("external-data/power.geojson", self.filename)
+
+        loaded_indexes.clear ()
+
+    def tearDown (self):
+        loaded_indexes.clear ()
+        shutil.rmtree (self.path)
+
+    def brute_force_query (self, west, south, east, north):
+        found = []
+
+        for feature in geojsonstream.iter_features_in_file (self.filename):
+            bbox = compute_feature_bbox (feature)
+
+            if bbox is not None and bbox[0] <= east and bbox[2] >= west and bbox[1] <= north and bbox[3] >= south:
+                found.append (feature)
+
+        return found
+
+    def test_finds_the_same_features_as_a_full_scan (self):
+        index = load_index (self.filename)
+
+        for bbox in ((-96.95, 19.45, -96.85, 19.55),
+                     (-98.0, 19.0, -97.0, 20.0),
+                     (-97.5, 19.3, -97.4, 19.4),
+                     (0.0, 0.0, 1.0, 1.0)):
+            self.assertEqual (list (index.iter_features_in_bbox (*bbox)), self.brute_force_query (*bbox))
+
+    def test_reuses_the_sidecar (self):
+        load_index (self.filename)
+        self.assertTrue (os.path.exists (self.filename + index_suffix))
+
+        loaded_indexes.clear ()
+
+        # Rebuilding would fail on a file that doesn't parse
+        def fail (index):
+            raise AssertionError ("index was rebuilt")
+
+        build = OverlayIndex.build
+        OverlayIndex.build = fail
+
+        try:
+            # Only the modification time changes; the hash still matches
+            st = os.stat (self.filename)
+            os.utime (self.filename, ns = (st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+            index = load_index (self.filename)
+            self.assertEqual (index.source_mtime_ns, st.st_mtime_ns + 10**9)
+        finally:
+            OverlayIndex.build = build
+
+    def test_rebuilds_when_the_file_changes (self):
+        index = load_index (self.filename)
+        self.assertTrue (len (index.features) > 1)
+
+        with open (self.filename, "w") as f:
+            json.dump ({ "type" : "FeatureCollection",
+                         "features" : [{ "type" : "Feature", "properties" : {},
+                                         "geometry" : { "type" : "Point", "coordinates" : [-96.9, 19.5] } }] }, f)
+
+        index = load_index (self.filename)
+        self.assertEqual (len (index.features), 1)
+        self.assertEqual (len (list (index.iter_features_in_bbox (-97, 19, -96, 20))), 1)
+
+    def test_computes_bboxes_of_collections (self):
+        feature = { "geometry" : { "type" : "GeometryCollection",
+                                   "geometries" : [{ "type" : "Point", "coordinates" : [1, 2] },
+                                                   { "type" : "LineString", "coordinates" : [[3, -4], [0, 1]] }] } }
+
+        self.assertEqual (compute_feature_bbox (feature), [0, -4, 3, 2])
+        self.assertIsNone (compute_feature_bbox ({ "geometry" : None }))
@@ -0,0 +1,521 @@
+import os
+import io
+import math
+import json
+import shutil
+import tempfile
+import cairo
+import threading
+import collections
+import numpy
+import geojsonstream
+import overlayindex
+import overlaystore
+import geomsimplify
+import maplayout
+import chartgeometry
+import tile_provider
+import testutils
+from cairoutils import *
+
+# Draws the GeoJSON files from a MapLayout's "overlays" on top of the map.
+#
+# Only the features whose bounding boxes overlap the map get read, through
+# an overlayindex.OverlayIndex, or an overlaystore.OverlayStore for files
+# converted with geojson2bin.py, and their coordinates get transformed to
+# the page in batches of about batch_points points with ChartGeometry's
+# array transforms.  So memory use depends on the batch size, not on the
+# size of the GeoJSON file.
+#
+# Lines and polygons get simplified for the map's scale with geomsimplify.
+# The filtered and simplified shapes are kept in memory, so drawing the
+# same overlay at the same scale and latitude again, like the sheets in a
+# row of an atlas, reads each feature only once.
+
+default_batch_points = 8192
+
+# The cached shapes of all the overlays together hold at most this many
+# positions, at 16 bytes each, so about 64 MB.  The least recently drawn
+# overlays get dropped first; an overlay with more than this in a single
+# map only keeps that map's features.
+max_cached_points = 4 * 1024 * 1024
+
+# Shapes of the features of the overlays drawn most recently, keyed by
+# compute_shapes_key(), from least to most recently used.  Each value maps
+# the feature numbers in the source from load_overlay_source() to lists of
+# (shape_type, rings), or to None for the features that the overlay's
+# filter rejects.  cached_points has the number of positions in each.
+cached_shapes = collections.OrderedDict ()
+cached_points = {}
+cached_shapes_lock = threading.Lock ()
+
+def compute_shapes_key (overlay, source, scale_denom, center_lat):
+    if overlay.simplify:
+        tolerance_mm = geomsimplify.compute_tolerance_mm (overlay.line_width_mm)
+    else:
+        (tolerance_mm, scale_denom, center_lat) = (None, None, None)
+
+    return (os.path.abspath (overlay.filename), source.get_cache_key (),
+            json.dumps (overlay.filter, sort_keys = True), tolerance_mm, scale_denom, center_lat)
+
+def count_points (feature_shapes):
+    if feature_shapes is None:
+        return 0
+
+    return sum (len (ring) for (shape_type, rings) in feature_shapes for ring in rings)
+
+# Returns a dict with the cached shapes of the given feature numbers, for
+# the ones that are in the cache.
+def get_cached_shapes (key, numbers):
+    with cached_shapes_lock:
+        shapes = cached_shapes.get (key)
+
+        if shapes is None:
+            return {}
+
+        cached_shapes.move_to_end (key)
+
+        return { i : shapes[i] for i in numbers if i in shapes }
+
+# Adds the shapes of newly read features to the cache, and evicts shapes
+# until the cache is within max_cached_points.  numbers are the features
+# on the current map, which get evicted last.
+def add_cached_shapes (key, new_shapes, numbers):
+    with cached_shapes_lock:
+        shapes = cached_shapes.get (key)
+
+        if shapes is None:
+            shapes = {}
+            cached_shapes[key] = shapes
+            cached_points[key] = 0
+        else:
+            cached_shapes.move_to_end (key)
+
+        for (i, feature_shapes) in new_shapes.items ():
+            if i not in shapes:
+                shapes[i] = feature_shapes
+                cached_points[key] += count_points (feature_shapes)
+
+        while sum (cached_points.values ()) > max_cached_points and len (cached_shapes) > 1:
+            (old_key, old_shapes) = cached_shapes.popitem (last = False)
+            del cached_points[old_key]
+
+        if cached_points[key] > max_cached_points:
+            visible = set (numbers)
+
+            for i in [i for i in shapes if i not in visible]:
+                cached_points[key] -= count_points (shapes.pop (i))
+
+        if cached_points[key] > max_cached_points:
+            del cached_shapes[key]
+            del cached_points[key]
+
+def clear_cached_shapes ():
+    with cached_shapes_lock:
+        cached_shapes.clear ()
+        cached_points.clear ()
+
+# Draws the overlay's point symbol centered on (0, 0) into a recording
+# surface that is just big enough for it.
+def make_symbol (overlay):
+    r = overlay.point_radius_mm
+    pad = r + overlay.line_width_mm
+
+    symbol = cairo.RecordingSurface (cairo.CONTENT_COLOR_ALPHA, cairo.Rectangle (-pad, -pad, 2 * pad, 2 * pad))
+    cr = cairo.Context (symbol)
+
+    set_source_rgb (cr, overlay.line_color)
+
+    if overlay.point_symbol == "square":
+        cr.rectangle (-r, -r, 2 * r, 2 * r)
+        cr.fill ()
+    elif overlay.point_symbol == "cross":
+        cr.set_line_width (overlay.line_width_mm)
+        cr.set_line_cap (cairo.LINE_CAP_BUTT)
+        cr.move_to (0, -r)
+        cr.line_to (0, r)
+        cr.move_to (-r * 0.6, -r * 0.4)
+        cr.line_to (r * 0.6, -r * 0.4)
+        cr.stroke ()
+    else:
+        cr.arc (0, 0, r, 0, 2 * math.pi)
+        cr.fill ()
+
+    del cr
+    return symbol
+
+# Returns an OverlayStore for the binary files from geojson2bin.py, or an
+# OverlayIndex for GeoJSON files.  Both have query() and
+# read_feature_shapes().
+def load_overlay_source (filename):
+    if overlaystore.is_store_filename (filename):
+        return overlaystore.load_store (filename)
+    else:
+        return overlayindex.load_index (filename)
+
+class OverlayRenderer:
+    def __init__ (self, geometry):
+        self.geometry = geometry
+        self.batch_points = default_batch_points
+
+        # Point symbols by their style, from get_symbol()
+        self.symbols = {}
+
+    # cr must be set up in page millimeters, and preferably clipped to the map
+    def render (self, cr):
+        for overlay in self.geometry.map_layout.overlays:
+            self.render_overlay (cr, overlay)
+
+    def render_overlay (self, cr, overlay):
+        # Features just outside the map can still reach into it with their
+        # strokes or dots.
+        margin_mm = max (overlay.line_width_mm, overlay.point_radius_mm)
+        bounds = self.geometry.compute_map_lat_lon_bounds (margin_mm)
+
+        source = load_overlay_source (overlay.filename)
+        numbers = source.query (*bounds)
+
+        map_layout = self.geometry.map_layout
+        key = compute_shapes_key (overlay, source, map_layout.map_scale_denom, map_layout.center_lat)
+        shapes = get_cached_shapes (key, numbers)
+
+        missing = [i for i in numbers if i not in shapes]
+        new_shapes = { i : self.make_shapes (overlay, properties, feature_shapes)
+                       for (i, properties, feature_shapes) in source.read_feature_shapes (missing) }
+
+        add_cached_shapes (key, new_shapes, numbers)
+        shapes.update (new_shapes)
+
+        visible = [shape for i in numbers if shapes[i] is not None for shape in shapes[i]]
+
+        # Each kind of drawing is a separate pass over all the shapes, so
+        # that polygon fills never cover lines or points from an earlier
+        # batch, and the result doesn't depend on the batch size.
+        cr.save ()
+
+        cr.set_line_width (overlay.line_width_mm)
+        cr.set_line_join (cairo.LINE_JOIN_ROUND)
+        cr.set_line_cap (cairo.LINE_CAP_ROUND)
+
+        if overlay.fill_color is not None:
+            for batch in self.iter_batches (visible, (geojsonstream.SHAPE_POLYGON,)):
+                self.fill_batch (cr, overlay, batch)
+
+        for batch in self.iter_batches (visible, (geojsonstream.SHAPE_POLYGON, geojsonstream.SHAPE_LINE)):
+            self.stroke_batch (cr, overlay, batch)
+
+        for batch in self.iter_batches (visible, (geojsonstream.SHAPE_POINT,)):
+            self.draw_points_batch (cr, overlay, batch)
+
+        cr.restore ()
+
+    # Yields lists of the shapes of the given types, with about
+    # self.batch_points points in each list.
+    def iter_batches (self, shapes, shape_types):
+        batch = []
+        num_points = 0
+
+        for shape in shapes:
+            if shape[0] not in shape_types:
+                continue
+
+            batch.append (shape)
+            num_points += sum (len (ring) for ring in shape[1])
+
+            if num_points >= self.batch_points:
+                yield batch
+
+                batch = []
+                num_points = 0
+
+        if len (batch) > 0:
+            yield batch
+
+    # Returns the list of (shape_type, rings) to draw for a feature, with
+    # each ring as an (n, 2) array of [lon, lat] positions, or None if the
+    # overlay's filter rejects the feature.
+    def make_shapes (self, overlay, properties, shapes):
+        if not overlay.matches (properties):
+            return None
+
+        if not overlay.simplify:
+            return shapes
+
+        tolerance_mm = geomsimplify.compute_tolerance_mm (overlay.line_width_mm)
+        map_layout = self.geometry.map_layout
+
+        return [(shape_type, [ring if shape_type == geojsonstream.SHAPE_POINT
+                              else geomsimplify.simplify_lon_lat (ring, tolerance_mm, map_layout.map_scale_denom, map_layout.center_lat)
+                              for ring in rings])
+                for (shape_type, rings) in shapes]
+
+    # Transforms all the positions in a batch of shapes at once.  Returns
+    # a list of (shape_type, page_rings) with each ring as lists of page x
+    # and y coordinates.
+    def transform_batch (self, batch):
+        positions = numpy.concatenate ([ring for (shape_type, rings) in batch for ring in rings])
+
+        (xs, ys) = self.geometry.transform_lat_lon_to_page_mm_array (positions[:, 1], positions[:, 0])
+        (xs, ys) = (xs.tolist (), ys.tolist ())
+
+        page_shapes = []
+
+        i = 0
+        for (shape_type, rings) in batch:
+            page_rings = []
+
+            for ring in rings:
+                page_rings.append ((xs[i : i + len (ring)], ys[i : i + len (ring)]))
+                i += len (ring)
+
+            page_shapes.append ((shape_type, page_rings))
+
+        return page_shapes
+
+    # Each polygon gets filled by itself, so that overlapping polygons
+    # don't punch holes in each other.
+    def fill_batch (self, cr, overlay, batch):
+        (r, g, b) = overlay.fill_color
+        cr.set_source_rgba (r, g, b, overlay.fill_opacity)
+        cr.set_fill_rule (cairo.FILL_RULE_EVEN_ODD)
+
+        for (shape_type, page_rings) in self.transform_batch (batch):
+            self.append_rings (cr, page_rings, True)
+            cr.fill ()
+
+    # Strokes the outlines of the polygons and the lines with a single
+    # cairo operation.
+    def stroke_batch (self, cr, overlay, batch):
+        set_source_rgb (cr, overlay.line_color)
+
+        for (shape_type, page_rings) in self.transform_batch (batch):
+            self.append_rings (cr, page_rings, shape_type == geojsonstream.SHAPE_POLYGON)
+
+        cr.stroke ()
+
+    # Every point paints the same symbol surface, which PDF output turns
+    # into a single form XObject and SVG output into a single element
+    # referenced with <use>, instead of a new path per point.
+    def draw_points_batch (self, cr, overlay, batch):
+        symbol = self.get_symbol (overlay)
+
+        for (shape_type, page_rings) in self.transform_batch (batch):
+            for (x, y) in page_rings:
+                cr.set_source_surface (symbol, x[0], y[0])
+                cr.paint ()
+
+    # Returns a cairo.RecordingSurface with the overlay's point symbol
+    # centered on (0, 0), in millimeters.  The symbols get created once per
+    # renderer, so that all the points share the same surface.
+    def get_symbol (self, overlay):
+        key = (overlay.point_symbol, overlay.point_radius_mm, overlay.line_width_mm, overlay.line_color)
+
+        symbol = self.symbols.get (key)
+
+        if symbol is None:
+            symbol = make_symbol (overlay)
+            self.symbols[key] = symbol
+
+        return symbol
+
+    def append_rings (self, cr, rings, close):
+        for (x, y) in rings:
+            if len (x) == 0:
+                continue
+
+            cr.move_to (x[0], y[0])
+
+            for j in range (1, len (x)):
+                cr.line_to (x[j], y[j])
+
+            if close:
+                cr.close_path ()
+
+#################### tests ####################
+
+class TestOverlayRenderer (testutils.TestCaseHelper):
+    def setUp (self):
+        self.path = tempfile.mkdtemp ()
+        clear_cached_shapes ()
+
+    def tearDown (self):
+        clear_cached_shapes ()
+        shutil.rmtree (self.path)
+
+    def make_geometry (self, overlays_json):
+        layout = maplayout.MapLayout ()
+        layout.load_from_json ({
+            "paper-width"        : 100.0,
+            "paper-height"       : 100.0,
+            "map-width"          : 80.0,
+            "map-height"         : 80.0,
+            "map-to-left-margin" : 10.0,
+            "map-to-top-margin"  : 10.0,
+            "overlays"           : overlays_json
+        })
+
+        geometry = chartgeometry.ChartGeometry (layout, tile_provider.NullTileProvider ())
+        geometry.compute_extents_of_downloaded_tiles ()
+
+        return geometry
+
+    def write_geojson (self, features):
+        filename = os.path.join (self.path, "test.geojson")
+
+        with open (filename, "w") as f:
+            json.dump ({ "type" : "FeatureCollection", "features" : features }, f)
+
+        return filename
+
+    # Renders at 1 pixel per millimeter and returns the surface
+    def render (self, geometry, batch_points = default_batch_points):
+        surface = cairo.ImageSurface (cairo.FORMAT_RGB24, 100, 100)
+        cr = cairo.Context (surface)
+        cr.set_source_rgb (1, 1, 1)
+        cr.paint ()
+
+        renderer = OverlayRenderer (geometry)
+        renderer.batch_points = batch_points
+        renderer.render (cr)
+
+        surface.flush ()
+        return surface
+
+    def get_pixel (self, surface, x, y):
+        data = surface.get_data ()
+        offset = y * surface.get_stride () + x * 4
+
+        return bytes (data[offset : offset + 4])
+
+    def test_draws_lines_through_the_map_center (self):
+        layout = maplayout.MapLayout ()
+        (lat, lon) = (layout.center_lat, layout.center_lon)
+
+        filename = self.write_geojson ([
+            { "type" : "Feature", "properties" : { "power" : "line" },
+              "geometry" : { "type" : "LineString", "coordinates" : [[lon - 0.1, lat], [lon + 0.1, lat]] } },
+            { "type" : "Feature", "properties" : { "power" : "tower" },
+              "geometry" : { "type" : "LineString", "coordinates" : [[lon, lat - 0.1], [lon, lat + 0.1]] } }
+        ])
+
+        geometry = self.make_geometry ([{ "geojson" : filename, "line-color" : "#000000", "line-width" : 2.0,
+                                          "filter" : { "power" : "line" } }])
+
+        surface = self.render (geometry)
+
+        # The horizontal line is there, the filtered-out vertical one isn't
+        self.assertEqual (self.get_pixel (surface, 30, 50)[0:3], b"\x00\x00\x00")
+        self.assertEqual (self.get_pixel (surface, 50, 30)[0:3], b"\xff\xff\xff")
+
+    def test_batch_size_does_not_change_the_output (self):
+        layout = maplayout.MapLayout ()
+        (lat, lon) = (layout.center_lat, layout.center_lon)
+
+        features = [{ "type" : "Feature", "properties" : {},
+                      "geometry" : { "type" : "Point", "coordinates" : [lon + i * 0.002, lat + i * 0.002] } }
+                    for i in range (-10, 10)]
+        features.append ({ "type" : "Feature", "properties" : {},
+                           "geometry" : { "type" : "Polygon",
+                                          "coordinates" : [[[lon, lat], [lon + 0.01, lat], [lon + 0.01, lat + 0.01], [lon, lat]]] } })
+
+        geometry = self.make_geometry ([{ "geojson" : self.write_geojson (features), "fill-color" : "#0000ff" }])
+
+        one_batch = self.render (geometry)
+        many_batches = self.render (geometry, batch_points = 3)
+
+        self.assertEqual (bytes (one_batch.get_data ()), bytes (many_batches.get_data ()))
+
+    def test_reads_features_once_per_scale (self):
+        layout = maplayout.MapLayout ()
+        (lat, lon) = (layout.center_lat, layout.center_lon)
+
+        filename = self.write_geojson ([
+            { "type" : "Feature", "properties" : {},
+              "geometry" : { "type" : "LineString",
+                             "coordinates" : [[lon - 0.1 + i * 0.001, lat + (i % 2) * 0.00001] for i in range (200)] } }
+        ])
+
+        geometry = self.make_geometry ([{ "geojson" : filename }])
+        first = self.render (geometry)
+
+        # The vertices a few centimeters apart on the ground all got dropped
+        (shapes,) = cached_shapes.values ()
+        self.assertEqual (len (shapes[0][0][1][0]), 2)
+
+        read_features = overlayindex.OverlayIndex.read_features
+
+        def fail (index, numbers):
+            self.assertEqual (numbers, [])
+            return read_features (index, numbers)
+
+        overlayindex.OverlayIndex.read_features = fail
+
+        try:
+            second = self.render (geometry)
+        finally:
+            overlayindex.OverlayIndex.read_features = read_features
+
+        self.assertEqual (bytes (first.get_data ()), bytes (second.get_data ()))
+
+    def test_cached_shapes_are_bounded (self):
+        global max_cached_points
+
+        layout = maplayout.MapLayout ()
+        (lat, lon) = (layout.center_lat, layout.center_lon)
+
+        features = [{ "type" : "Feature", "properties" : {},
+                      "geometry" : { "type" : "LineString",
+                                     "coordinates" : [[lon - 0.1, lat + i * 0.001], [lon + 0.1, lat + i * 0.001]] } }
+                    for i in range (10)]
+
+        filename = self.write_geojson (features)
+
+        saved_max_cached_points = max_cached_points
+        max_cached_points = 25
+
+        try:
+            # Each scale is a separate entry in the cache, with 20 points
+            self.render (self.make_geometry ([{ "geojson" : filename }]))
+
+            geometry = self.make_geometry ([{ "geojson" : filename }])
+            geometry.map_layout.map_scale_denom = 40000
+            geometry.compute_extents_of_downloaded_tiles ()
+            self.render (geometry)
+
+            self.assertEqual (len (cached_shapes), 1)
+            self.assertEqual (list (cached_points.values ()), [20])
+
+            # A map with more than the limit keeps nothing
+            max_cached_points = 10
+            self.render (geometry)
+
+            self.assertEqual (len (cached_shapes), 0)
+            self.assertEqual (len (cached_points), 0)
+        finally:
+            max_cached_points = saved_max_cached_points
+
+    def test_places_point_symbols_by_reference (self):
+        layout = maplayout.MapLayout ()
+        (lat, lon) = (layout.center_lat, layout.center_lon)
+
+        num_points = 50
+        features = [{ "type" : "Feature", "properties" : {},
+                      "geometry" : { "type" : "Point", "coordinates" : [lon + i * 0.0005, lat] } }
+                    for i in range (-num_points // 2, num_points // 2)]
+
+        geometry = self.make_geometry ([{ "geojson" : self.write_geojson (features), "point-symbol" : "cross" }])
+
+        output = io.BytesIO ()
+        surface = cairo.SVGSurface (output, 100, 100)
+        cr = cairo.Context (surface)
+
+        OverlayRenderer (geometry).render (cr)
+
+        del cr
+        surface.finish ()
+
+        svg = output.getvalue ()
+
+        # The cross's two strokes are written once; the points only refer to them
+        self.assertTrue (svg.count (b"<use") >= num_points)
+        self.assertTrue (svg.count (b"<path") < num_points)
@@ -0,0 +1,394 @@
+import os
+import io
+import mmap
+import json
+import time
+import array
+import shutil
+import struct
+import tempfile
+import tracemalloc
+import unittest
+import numpy
+import geojsonstream
+import overlayindex
+
+# A compact binary format for the overlay GeoJSON files, which loads by
+# memory-mapping the file, with no Python objects per vertex.
+#
+# The file starts with an 8-byte magic and the length of a JSON header,
+# as a little-endian uint64.  The header lists the arrays that follow,
+# each one aligned to 8 bytes:
+#
+#   coordinates       float64 (points, 2)  [lon, lat] of all the positions
+#   ring_offsets      int64 (rings + 1)    first position of each ring
+#   part_offsets      int64 (parts + 1)    first ring of each part
+#   part_types        uint8 (parts)        PART_* type of each part
+#   feature_offsets   int64 (features + 1) first part of each feature
+#   feature_bboxes    float64 (features, 4) [west, south, east, north]
+#   property_offsets  int64 (features + 1) start of each feature's properties
+#   properties        uint8                the properties as UTF-8 JSON texts
+#   grid_cell_offsets int64 (cells + 1)    start of each cell's features
+#   grid_features     int64                the features that overlap each cell
+#
+# A part is a point, a line, or a polygon with its outer ring followed by
+# its holes, like the shapes from geojsonstream.iter_shapes().
+#
+# The grid is the uniform grid from overlayindex.build_grid() over the
+# features' bounding boxes; the header has its "bbox", "columns" and
+# "rows" under "grid".
+
+magic = b"LMOVRLY1"
+
+# Files with another version need to be converted again
+store_version = 2
+
+store_suffix = ".lmoverlay"
+
+PART_POINT   = 0
+PART_LINE    = 1
+PART_POLYGON = 2
+
+part_types_by_shape_type = {
+    geojsonstream.SHAPE_POINT   : PART_POINT,
+    geojsonstream.SHAPE_LINE    : PART_LINE,
+    geojsonstream.SHAPE_POLYGON : PART_POLYGON
+}
+
+shape_types_by_part_type = { v : k for (k, v) in part_types_by_shape_type.items () }
+
+array_dtypes = {
+    "coordinates"      : "<f8",
+    "ring_offsets"     : "<i8",
+    "part_offsets"     : "<i8",
+    "part_types"       : "u1",
+    "feature_offsets"  : "<i8",
+    "feature_bboxes"   : "<f8",
+    "property_offsets" : "<i8",
+    "properties"       : "u1",
+    "grid_cell_offsets": "<i8",
+    "grid_features"    : "<i8"
+}
+
+def is_store_filename (filename):
+    return filename.endswith (store_suffix)
+
+# Reads a GeoJSON FeatureCollection with geojsonstream and writes it as a
+# store.  Features without coordinates get skipped.  Returns the number
+# of features written.
+#
+def convert_geojson (geojson_filename, store_filename):
+    coordinates = array.array ("d")
+    ring_offsets = array.array ("q", [0])
+    part_offsets = array.array ("q", [0])
+    part_types = array.array ("B")
+    feature_offsets = array.array ("q", [0])
+    feature_bboxes = array.array ("d")
+    property_offsets = array.array ("q", [0])
+    properties = io.BytesIO ()
+
+    for feature in geojsonstream.iter_features_in_file (geojson_filename):
+        shapes = geojsonstream.make_shape_arrays (feature.get ("geometry"))
+
+        if len (shapes) == 0:
+            continue
+
+        bbox = [float ("inf"), float ("inf"), float ("-inf"), float ("-inf")]
+
+        for (shape_type, rings) in shapes:
+            for ring in rings:
+                coordinates.frombytes (ring.astype ("<f8").tobytes ())
+                ring_offsets.append (len (coordinates) // 2)
+
+                bbox = [min (bbox[0], ring[:, 0].min ()), min (bbox[1], ring[:, 1].min ()),
+                        max (bbox[2], ring[:, 0].max ()), max (bbox[3], ring[:, 1].max ())]
+
+            part_offsets.append (len (ring_offsets) - 1)
+            part_types.append (part_types_by_shape_type[shape_type])
+
+        feature_offsets.append (len (part_types))
+        feature_bboxes.extend (float (v) for v in bbox)
+
+        properties.write (json.dumps (feature.get ("properties"), ensure_ascii = False,
+                                      separators = (",", ":")).encode ("utf-8"))
+        property_offsets.append (properties.tell ())
+
+    (grid_bbox, columns, rows, cells) = overlayindex.build_grid (numpy.frombuffer (feature_bboxes, dtype = "<f8").reshape (-1, 4).tolist ())
+
+    grid_cell_offsets = numpy.zeros (len (cells) + 1, dtype = "<i8")
+    grid_cell_offsets[1:] = numpy.cumsum ([len (cell) for cell in cells])
+
+    arrays = {
+        "coordinates"      : numpy.frombuffer (coordinates, dtype = "<f8").reshape (-1, 2),
+        "ring_offsets"     : numpy.frombuffer (ring_offsets, dtype = "<i8"),
+        "part_offsets"     : numpy.frombuffer (part_offsets, dtype = "<i8"),
+        "part_types"       : numpy.frombuffer (part_types, dtype = "u1"),
+        "feature_offsets"  : numpy.frombuffer (feature_offsets, dtype = "<i8"),
+        "feature_bboxes"   : numpy.frombuffer (feature_bboxes, dtype = "<f8").reshape (-1, 4),
+        "property_offsets" : numpy.frombuffer (property_offsets, dtype = "<i8"),
+        "properties"       : numpy.frombuffer (properties.getbuffer (), dtype = "u1"),
+        "grid_cell_offsets": grid_cell_offsets,
+        "grid_features"    : numpy.array ([i for cell in cells for i in cell], dtype = "<i8")
+    }
+
+    grid = { "bbox" : grid_bbox, "columns" : columns, "rows" : rows }
+
+    write_arrays (store_filename, arrays, grid)
+
+    return len (feature_offsets) - 1
+
+def align8 (n):
+    return (n + 7) & ~7
+
+# Writes the arrays atomically, so that a render never maps a partial file
+def write_arrays (filename, arrays, grid):
+    header = { "version" : store_version, "grid" : grid, "arrays" : {} }
+
+    # The header's size depends on the offsets in it, so compute them
+    # relative to the end of the header first.
+    offset = 0
+    for (name, a) in arrays.items ():
+        header["arrays"][name] = { "offset" : offset, "shape" : list (a.shape) }
+        offset = align8 (offset + a.nbytes)
+
+    header_size = align8 (len (magic) + 8 + len (json.dumps (header)) + 64)
+    for entry in header["arrays"].values ():
+        entry["offset"] += header_size
+
+    header_bytes = json.dumps (header).encode ("utf-8")
+    assert len (magic) + 8 + len (header_bytes) <= header_size
+
+    (fd, tmp_filename) = tempfile.mkstemp (dir = os.path.dirname (os.path.abspath (filename)), prefix = ".overlay-")
+
+    try:
+        with os.fdopen (fd, "wb") as f:
+            f.write (magic)
+            f.write (struct.pack ("<Q", len (header_bytes)))
+            f.write (header_bytes)
+
+            for (name, a) in arrays.items ():
+                f.seek (header["arrays"][name]["offset"])
+                f.write (a.tobytes ())
+
+            # Pad the file so the last array can be mapped in full
+            f.truncate (align8 (f.tell ()))
+
+        os.replace (tmp_filename, filename)
+    except:
+        os.unlink (tmp_filename)
+        raise
+
+class OverlayStore:
+    def __init__ (self, filename):
+        self.filename = filename
+
+        st = os.stat (filename)
+        self.file_key = (os.path.abspath (filename), st.st_size, st.st_mtime_ns)
+
+        with open (filename, "rb") as f:
+            self.map = mmap.mmap (f.fileno (), 0, access = mmap.ACCESS_READ)
+
+        if self.map[0 : len (magic)] != magic:
+            raise ValueError ("{0} is not an overlay file".format (filename))
+
+        (header_length,) = struct.unpack ("<Q", self.map[len (magic) : len (magic) + 8])
+        header = json.loads (self.map[len (magic) + 8 : len (magic) + 8 + header_length].decode ("utf-8"))
+
+        if header.get ("version") != store_version:
+            raise ValueError ("{0} is from another version of La Mapería; convert it again with geojson2bin.py".format (filename))
+
+        self.grid_bbox = header["grid"]["bbox"]
+        self.grid_columns = header["grid"]["columns"]
+        self.grid_rows = header["grid"]["rows"]
+
+        for (name, dtype) in array_dtypes.items ():
+            entry = header["arrays"][name]
+            count = 1
+            for n in entry["shape"]:
+                count *= n
+
+            a = numpy.frombuffer (self.map, dtype = dtype, count = count, offset = entry["offset"])
+            setattr (self, name, a.reshape (entry["shape"]))
+
+        self.num_features = len (self.feature_offsets) - 1
+
+    # Changes when the file changes, like OverlayIndex.get_cache_key()
+    def get_cache_key (self):
+        return self.file_key
+
+    # Returns the sorted numbers of the features whose bounding boxes
+    # overlap the given one, like OverlayIndex.query().  Only the
+    # features in the grid cells that the bbox overlaps get checked.
+    def query (self, west, south, east, north):
+        if self.grid_bbox is None:
+            return []
+
+        (grid_west, grid_south, grid_east, grid_north) = self.grid_bbox
+
+        if west > grid_east or east < grid_west or south > grid_north or north < grid_south:
+            return []
+
+        (col1, row1, col2, row2) = overlayindex.compute_cell_range (self.grid_bbox, self.grid_columns, self.grid_rows,
+                                                                    west, south, east, north)
+
+        # The cells of each row in the range are consecutive, and so are
+        # their features.
+        candidates = numpy.unique (numpy.concatenate ([
+            self.grid_features[self.grid_cell_offsets[row * self.grid_columns + col1]
+                               : self.grid_cell_offsets[row * self.grid_columns + col2 + 1]]
+            for row in range (row1, row2 + 1)]))
+
+        b = self.feature_bboxes[candidates]
+        mask = (b[:, 0] <= east) & (b[:, 2] >= west) & (b[:, 1] <= north) & (b[:, 3] >= south)
+
+        return candidates[mask].tolist ()
+
+    def get_properties (self, i):
+        (start, end) = self.property_offsets[i : i + 2]
+        return json.loads (self.properties[start : end].tobytes ().decode ("utf-8"))
+
+    # Returns the list of (shape_type, rings) for a feature, like
+    # geojsonstream.make_shape_arrays(); the rings are views of the file.
+    def get_shapes (self, i):
+        shapes = []
+
+        for part in range (self.feature_offsets[i], self.feature_offsets[i + 1]):
+            rings = [self.coordinates[self.ring_offsets[r] : self.ring_offsets[r + 1]]
+                     for r in range (self.part_offsets[part], self.part_offsets[part + 1])]
+
+            shapes.append ((shape_types_by_part_type[int (self.part_types[part])], rings))
+
+        return shapes
+
+    # Yields (number, properties, shapes) for the given feature numbers
+    def read_feature_shapes (self, numbers):
+        for i in numbers:
+            yield (i, self.get_properties (i), self.get_shapes (i))
+
+# Stores that were already mapped in this process, by absolute filename
+loaded_stores = {}
+
+def load_store (filename):
+    key = os.path.abspath (filename)
+    st = os.stat (filename)
+
+    store = loaded_stores.get (key)
+
+    if store is None or store.file_key != (key, st.st_size, st.st_mtime_ns):
+        store = OverlayStore (filename)
+        loaded_stores[key] = store
+
+    return store
+
+# Compares loading a GeoJSON file with json.load() and with OverlayStore
+def benchmark (geojson_filename):
+    store_filename = os.path.join (tempfile.mkdtemp (), "benchmark" + store_suffix)
+
+    try:
+        convert_geojson (geojson_filename, store_filename)
+
+        # Best of a few runs, timed without tracemalloc since it slows
+        # down allocations
+        def measure (load):
+            elapsed = float ("inf")
+
+            for i in range (5):
+                start = time.perf_counter ()
+                load ()
+                elapsed = min (elapsed, time.perf_counter () - start)
+
+            tracemalloc.start ()
+            result = load ()
+            (current, peak) = tracemalloc.get_traced_memory ()
+            tracemalloc.stop ()
+
+            return (result, elapsed, peak)
+
+        def load_json ():
+            with open (geojson_filename, encoding = "utf-8") as f:
+                return json.load (f)
+
+        (unused, json_time, json_peak) = measure (load_json)
+        (unused, store_time, store_peak) = measure (lambda: OverlayStore (store_filename))
+
+        print ("{0}: {1} bytes of GeoJSON, {2} bytes in the store".format (geojson_filename,
+                                                                          os.path.getsize (geojson_filename),
+                                                                          os.path.getsize (store_filename)))
+        print ("json.load:    {0:8.3f} ms, {1:10} bytes peak".format (json_time * 1000, json_peak))
+        print ("OverlayStore: {0:8.3f} ms, {1:10} bytes peak".format (store_time * 1000, store_peak))
+    finally:
+        shutil.rmtree (os.path.dirname (store_filename))
+
+#################### tests ####################
+
+class TestOverlayStore (unittest.TestCase):
+    def setUp (self):
+        self.path = tempfile.mkdtemp ()
+        loaded_stores.clear ()
+
+    def tearDown (self):
+        loaded_stores.clear ()
+        shutil.rmtree (self.path)
+
+    def convert (self, geojson_filename):
+        store_filename = os.path.join (self.path, "test" + store_suffix)
+        convert_geojson (geojson_filename, store_filename)
+
+        return load_store (store_filename)
+
+    def test_has_the_same_features_as_the_geojson (self):
+        for name in ("power", "wayside-shrines-crosses"):
+            geojson_filename = "external-data/{0}.geojson".format (name)
+            store = self.convert (geojson_filename)
+
+            features = [f for f in geojsonstream.iter_features_in_file (geojson_filename)
+                        if len (geojsonstream.make_shape_arrays (f.get ("geometry"))) > 0]
+
+            self.assertEqual (store.num_features, len (features))
+
+            for (i, properties, shapes) in store.read_feature_shapes (range (store.num_features)):
+                self.assertEqual (properties, features[i].get ("properties"))
+
+                expected = geojsonstream.make_shape_arrays (features[i]["geometry"])
+                self.assertEqual ([(t, [r.tolist () for r in rings]) for (t, rings) in shapes],
+                                  [(t, [r.tolist () for r in rings]) for (t, rings) in expected])
+
+            loaded_stores.clear ()
+
+    def test_query_matches_bounding_boxes (self):
+        filename = os.path.join (self.path, "test.geojson")
+
+        with open (filename, "w") as f:
+            json.dump ({ "type" : "FeatureCollection",
+                         "features" : [{ "type" : "Feature", "properties" : { "n" : 0 },
+                                         "geometry" : { "type" : "Point", "coordinates" : [-96.9, 19.5] } },
+                                       { "type" : "Feature", "properties" : None,
+                                         "geometry" : None },
+                                       { "type" : "Feature", "properties" : { "n" : 2 },
+                                         "geometry" : { "type" : "LineString", "coordinates" : [[-98, 19], [-97, 20]] } }] }, f)
+
+        store = self.convert (filename)
+
+        self.assertEqual (store.num_features, 2)
+        self.assertEqual (store.query (-97.0, 19.4, -96.8, 19.6), [0, 1])
+        self.assertEqual (store.query (-97.6, 19.4, -97.5, 19.6), [1])
+        self.assertEqual (store.query (0, 0, 1, 1), [])
+        self.assertEqual (store.get_properties (1), { "n" : 2 })
+
+    def test_query_matches_a_full_scan (self):
+        store = self.convert ("external-data/power.geojson")
+        self.assertTrue (store.grid_columns > 1)
+
+        b = store.feature_bboxes
+
+        for (west, south, east, north) in ((-96.95, 19.45, -96.85, 19.55),
+                                           (-98.0, 19.0, -97.0, 20.0),
+                                           (-97.5, 19.3, -97.4, 19.4),
+                                           (-180.0, -90.0, 180.0, 90.0),
+                                           (0.0, 0.0, 1.0, 1.0)):
+            mask = (b[:, 0] <= east) & (b[:, 2] >= west) & (b[:, 1] <= north) & (b[:, 3] >= south)
+            self.assertEqual (store.query (west, south, east, north), numpy.flatnonzero (mask).tolist ())
+
+    def test_rejects_other_files (self):
+        with self.assertRaises (ValueError):
+            OverlayStore ("null-tile-512.png")
@@ -1,21 +1,50 @@
+import os
 from units import *
 import cairo
 import chartrenderer
+import rasterwriter
+
+default_raster_dpi = 300
+
+# Raster output gets rendered in horizontal bands of this many pixels,
+# so memory use depends on the band height and not on the paper size.
+default_band_height_px = 512
+
+vector_formats = [ "pdf", "svg" ]
+raster_formats = [ "png", "tiff", "tiff-tiled" ]
+
+# For making filenames when rendering to several formats at once
+format_extensions = {
+    "pdf"        : ".pdf",
+    "svg"        : ".svg",
+    "png"        : ".png",
+    "tiff"       : ".tiff",
+    "tiff-tiled" : "-tiled.tiff",
+}
+
+# Tile size for "tiff-tiled" output
+tiff_tile_size = 256
+
+def format_names ():
+    return ", ".join ("'{0}'".format (format) for format in vector_formats + raster_formats)
+
+# "mymap.pdf" -> "mymap.svg" for format "svg"
+def make_output_filename (filename, format):
+    (base, ext) = os.path.splitext (filename)
+    return base + format_extensions[format]
 
 class PaperRenderer:
     def __init__ (self, layout):
         self.layout = layout
+        self.band_height_px = default_band_height_px
 
-    def render (self, format, filename, chart_renderer):
-        width_pt = mm_to_pt (self.layout.paper_width_mm)
-        height_pt = mm_to_pt (self.layout.paper_height_mm)
+    def render (self, format, filename, chart_renderer, dpi = default_raster_dpi):
+        if format in raster_formats:
+            writer = self.make_raster_writer (format, filename, dpi)
+            self.render_raster_bands ([writer], dpi, chart_renderer)
+            return
 
-        if format == "svg":
-            surface = cairo.SVGSurface (filename, width_pt, height_pt)
-        elif format == "pdf":
-            surface = cairo.PDFSurface (filename, width_pt, height_pt)
-        else:
-            raise ValueError ("rendering format was specified as '{0}'; it must be one of 'svg', 'pdf'".format (format))
+        surface = self.make_vector_surface (format, filename)
 
         # These surfaces are created in points, but we want to render everything in millimeters.
         # Set up a scaling transformation and render everything based on that.
@@ -27,3 +56,164 @@ class PaperRenderer:
         chart_renderer.render_to_cairo (cr)
 
         surface.show_page ()
+
+    def make_vector_surface (self, format, filename):
+        width_pt = mm_to_pt (self.layout.paper_width_mm)
+        height_pt = mm_to_pt (self.layout.paper_height_mm)
+
+        if format == "svg":
+            return cairo.SVGSurface (filename, width_pt, height_pt)
+        elif format == "pdf":
+            return cairo.PDFSurface (filename, width_pt, height_pt)
+        else:
+            raise ValueError ("rendering format was specified as '{0}'; it must be one of {1}".format (format, format_names ()))
+
+    # Renders the same map to several files.  outputs is a list of (format,
+    # filename).  The raster files get written together from one banded
+    # render, so each band gets drawn only once.  For the vector files,
+    # the chart gets rendered once into a recording surface that is then
+    # replayed to each file.  The recording keeps all the decoded tiles
+    # in memory, though; for a single format, render() is better.
+    #
+    def render_formats (self, outputs, chart_renderer, dpi = default_raster_dpi):
+        for (format, filename) in outputs:
+            if format not in vector_formats and format not in raster_formats:
+                raise ValueError ("rendering format was specified as '{0}'; it must be one of {1}".format (format, format_names ()))
+
+        if len (outputs) == 1:
+            (format, filename) = outputs[0]
+            self.render (format, filename, chart_renderer, dpi)
+            return
+
+        raster_outputs = [(format, filename) for (format, filename) in outputs if format in raster_formats]
+        vector_outputs = [(format, filename) for (format, filename) in outputs if format in vector_formats]
+
+        if len (raster_outputs) > 0:
+            writers = []
+
+            try:
+                for (format, filename) in raster_outputs:
+                    writers.append (self.make_raster_writer (format, filename, dpi))
+            except:
+                for writer in writers:
+                    writer.discard ()
+                raise
+
+            self.render_raster_bands (writers, dpi, chart_renderer)
+
+        if len (vector_outputs) == 1:
+            (format, filename) = vector_outputs[0]
+            self.render (format, filename, chart_renderer, dpi)
+        elif len (vector_outputs) > 1:
+            recording = cairo.RecordingSurface (cairo.CONTENT_COLOR_ALPHA,
+                                                cairo.Rectangle (0, 0, self.layout.paper_width_mm, self.layout.paper_height_mm))
+            cr = cairo.Context (recording)
+            chart_renderer.render_to_cairo (cr)
+            del cr
+
+            for (format, filename) in vector_outputs:
+                surface = self.make_vector_surface (format, filename)
+
+                cr = cairo.Context (surface)
+                factor = mm_to_pt (1.0)
+                cr.scale (factor, factor)
+
+                cr.set_source_surface (recording, 0, 0)
+                cr.paint ()
+
+                del cr
+                surface.show_page ()
+                surface.finish ()
+
+    # Renders several maps as the pages of a single PDF file, all of them
+    # on this renderer's paper size.
+    def render_pdf_pages (self, filename, chart_renderers):
+        width_pt = mm_to_pt (self.layout.paper_width_mm)
+        height_pt = mm_to_pt (self.layout.paper_height_mm)
+
+        surface = cairo.PDFSurface (filename, width_pt, height_pt)
+
+        for chart_renderer in chart_renderers:
+            cr = cairo.Context (surface)
+            factor = mm_to_pt (1.0)
+            cr.scale (factor, factor)
+
+            chart_renderer.render_to_cairo (cr)
+
+            del cr
+            surface.show_page ()
+
+        surface.finish ()
+
+    def compute_raster_size (self, dpi):
+        width_px = int (round (mm_to_inch (self.layout.paper_width_mm) * dpi))
+        height_px = int (round (mm_to_inch (self.layout.paper_height_mm) * dpi))
+
+        return (width_px, height_px)
+
+    def make_raster_writer (self, format, filename, dpi):
+        (width_px, height_px) = self.compute_raster_size (dpi)
+
+        if format == "png":
+            return rasterwriter.PNGWriter (filename, width_px, height_px, dpi)
+        elif format == "tiff":
+            return rasterwriter.TIFFWriter (filename, width_px, height_px, dpi)
+        elif format == "tiff-tiled":
+            return rasterwriter.TIFFWriter (filename, width_px, height_px, dpi, tiff_tile_size)
+        else:
+            raise ValueError ("unknown raster format '{0}'".format (format))
+
+    # Renders the page in horizontal bands, and passes each band's pixels
+    # to the writers from the rasterwriter module as soon as it is done.
+    # If the render fails, the writers get discarded.
+    def render_raster_bands (self, writers, dpi, chart_renderer):
+        try:
+            chart_renderer.start_banded_render (dpi)
+
+            try:
+                self.write_raster_bands (writers, dpi, chart_renderer.render_to_cairo)
+            finally:
+                chart_renderer.end_banded_render ()
+        except:
+            for writer in writers:
+                writer.discard ()
+            raise
+
+    # Calls render_band (cr, band_rect_mm) for each band, with cr set up in
+    # page millimeters, and writes the band's pixels to each of writers.
+    def write_raster_bands (self, writers, dpi, render_band):
+        (width_px, height_px) = self.compute_raster_size (dpi)
+
+        px_per_mm = dpi / 25.4
+        mm_per_px = 25.4 / dpi
+
+        band_top_px = 0
+
+        while band_top_px < height_px:
+            band_height_px = min (self.band_height_px, height_px - band_top_px)
+
+            surface = cairo.ImageSurface (cairo.FORMAT_RGB24, width_px, band_height_px)
+            cr = cairo.Context (surface)
+
+            cr.set_source_rgb (1, 1, 1)
+            cr.paint ()
+
+            cr.scale (px_per_mm, px_per_mm)
+            cr.translate (0, -band_top_px * mm_per_px)
+
+            band_rect_mm = (0, band_top_px * mm_per_px, self.layout.paper_width_mm, band_height_px * mm_per_px)
+            render_band (cr, band_rect_mm)
+
+            del cr
+            surface.flush ()
+
+            rgb = rasterwriter.cairo_rgb24_to_rgb (surface.get_data (), width_px, band_height_px, surface.get_stride ())
+            for writer in writers:
+                writer.write_rows (rgb, band_height_px)
+
+            del surface
+
+            band_top_px += band_height_px
+
+        for writer in writers:
+            writer.close ()
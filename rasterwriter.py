@@ -0,0 +1,443 @@
+import os
+import struct
+import sys
+import tempfile
+import shutil
+import zlib
+import unittest
+
+# Converts rows of cairo FORMAT_RGB24 pixels to packed 8-bit RGB.  Cairo
+# stores each pixel as a native-endian 32-bit 0xXXRRGGBB value, so the
+# byte order in memory depends on the machine.
+#
+def cairo_rgb24_to_rgb (data, width, height, stride):
+    if sys.byteorder == "little":
+        (r, g, b) = (2, 1, 0)
+    else:
+        (r, g, b) = (1, 2, 3)
+
+    data = bytes (data)
+    rgb = bytearray (width * height * 3)
+
+    for y in range (height):
+        row = data[y * stride : y * stride + width * 4]
+        out = y * width * 3
+
+        rgb[out     : out + width * 3 : 3] = row[r::4]
+        rgb[out + 1 : out + width * 3 : 3] = row[g::4]
+        rgb[out + 2 : out + width * 3 : 3] = row[b::4]
+
+    return bytes (rgb)
+
+def dpi_to_pixels_per_meter (dpi):
+    return int (round (dpi / 0.0254))
+
+# The writers below put the image in a temporary file next to filename,
+# and only rename it to filename once it is complete, so a render that
+# fails or gets cancelled partway never leaves a truncated image behind.
+def open_output (filename):
+    tmp_filename = "{0}.{1}.tmp".format (filename, os.getpid ())
+    return (open (tmp_filename, "wb"), tmp_filename)
+
+def discard_output (file, tmp_filename):
+    file.close ()
+
+    try:
+        os.unlink (tmp_filename)
+    except FileNotFoundError:
+        pass
+
+# Writes an RGB PNG file incrementally: rows can be added a few at a
+# time with write_rows(), and they get compressed and written right
+# away, so the whole image never needs to be in memory.
+#
+class PNGWriter:
+    # Write an IDAT chunk whenever this much compressed data accumulates
+    chunk_size = 256 * 1024
+
+    def __init__ (self, filename, width, height, dpi):
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+
+        self.filename = filename
+        (self.file, self.tmp_filename) = open_output (filename)
+        self.compressor = zlib.compressobj (6)
+        self.pending = bytearray ()
+
+        self.file.write (b"\x89PNG\r\n\x1a\n")
+
+        # 8 bits per sample, color type 2 (RGB), default compression/filter, no interlace
+        self.write_chunk (b"IHDR", struct.pack (">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+        ppm = dpi_to_pixels_per_meter (dpi)
+        self.write_chunk (b"pHYs", struct.pack (">IIB", ppm, ppm, 1))
+
+    def write_chunk (self, chunk_type, data):
+        self.file.write (struct.pack (">I", len (data)))
+        self.file.write (chunk_type)
+        self.file.write (data)
+        self.file.write (struct.pack (">I", zlib.crc32 (chunk_type + data) & 0xffffffff))
+
+    # rgb is num_rows rows of packed RGB pixels
+    def write_rows (self, rgb, num_rows):
+        assert len (rgb) == num_rows * self.width * 3
+        assert self.rows_written + num_rows <= self.height
+
+        row_size = self.width * 3
+        for y in range (num_rows):
+            # Filter type 0 (none) for each row
+            self.pending += self.compressor.compress (b"\x00")
+            self.pending += self.compressor.compress (rgb[y * row_size : (y + 1) * row_size])
+
+        self.rows_written += num_rows
+
+        if len (self.pending) >= self.chunk_size:
+            self.write_chunk (b"IDAT", bytes (self.pending))
+            self.pending = bytearray ()
+
+    def close (self):
+        assert self.rows_written == self.height
+
+        self.pending += self.compressor.flush ()
+        self.write_chunk (b"IDAT", bytes (self.pending))
+        self.write_chunk (b"IEND", b"")
+
+        self.file.close ()
+        os.replace (self.tmp_filename, self.filename)
+
+    # Gives up on the image, for when the render fails
+    def discard (self):
+        discard_output (self.file, self.tmp_filename)
+
+# TIFF field types
+TIFF_SHORT    = 3
+TIFF_LONG     = 4
+TIFF_RATIONAL = 5
+
+tiff_type_sizes = { TIFF_SHORT : 2, TIFF_LONG : 4, TIFF_RATIONAL : 8 }
+tiff_type_formats = { TIFF_SHORT : "H", TIFF_LONG : "I", TIFF_RATIONAL : "II" }
+
+# Writes an RGB, Deflate-compressed TIFF file incrementally.  Rows come in
+# with write_rows(), like for PNGWriter, and get written out as soon as a
+# whole strip (or a whole row of tiles, if tile_size is given) is
+# available.  The image directory goes at the end of the file, once the
+# offsets of all the strips or tiles are known.
+#
+# This writes classic TIFF, so the compressed image must stay under 4 GB.
+#
+class TIFFWriter:
+    default_rows_per_strip = 64
+
+    def __init__ (self, filename, width, height, dpi, tile_size = None):
+        self.width = width
+        self.height = height
+        self.dpi = dpi
+        self.tile_size = tile_size
+        self.rows_written = 0
+
+        if tile_size is not None:
+            assert tile_size % 16 == 0
+            self.rows_per_block = tile_size
+        else:
+            self.rows_per_block = min (self.default_rows_per_strip, height)
+
+        self.pending = bytearray ()
+        self.pending_rows = 0
+
+        self.offsets = []
+        self.byte_counts = []
+
+        self.filename = filename
+        (self.file, self.tmp_filename) = open_output (filename)
+
+        # Little-endian header; the offset of the image directory gets filled in by close()
+        self.file.write (b"II*\x00\x00\x00\x00\x00")
+
+    def write_rows (self, rgb, num_rows):
+        assert len (rgb) == num_rows * self.width * 3
+        assert self.rows_written + num_rows <= self.height
+
+        self.pending += rgb
+        self.pending_rows += num_rows
+        self.rows_written += num_rows
+
+        row_size = self.width * 3
+        while self.pending_rows >= self.rows_per_block:
+            self.write_block (self.pending[: self.rows_per_block * row_size], self.rows_per_block)
+            del self.pending[: self.rows_per_block * row_size]
+            self.pending_rows -= self.rows_per_block
+
+    def write_compressed (self, data):
+        compressed = zlib.compress (bytes (data), 6)
+
+        self.offsets.append (self.file.tell ())
+        self.byte_counts.append (len (compressed))
+        self.file.write (compressed)
+
+    # Writes a strip, or a row of tiles, with num_rows rows of pixels
+    def write_block (self, rgb, num_rows):
+        if self.tile_size is None:
+            self.write_compressed (rgb)
+            return
+
+        # Tiles are always complete; pad the ones at the right and bottom edges
+        row_size = self.width * 3
+        tile_row_size = self.tile_size * 3
+
+        for tile_x in range (0, self.width, self.tile_size):
+            tile = bytearray (self.tile_size * tile_row_size)
+            used = min (self.tile_size, self.width - tile_x) * 3
+
+            for y in range (num_rows):
+                start = y * row_size + tile_x * 3
+                tile[y * tile_row_size : y * tile_row_size + used] = rgb[start : start + used]
+
+            self.write_compressed (tile)
+
+    def close (self):
+        assert self.rows_written == self.height
+
+        if self.pending_rows > 0:
+            self.write_block (self.pending, self.pending_rows)
+
+        entries = [ (256, TIFF_LONG, [self.width]),        # ImageWidth
+                    (257, TIFF_LONG, [self.height]),       # ImageLength
+                    (258, TIFF_SHORT, [8, 8, 8]),          # BitsPerSample
+                    (259, TIFF_SHORT, [8]),                # Compression = Deflate
+                    (262, TIFF_SHORT, [2]),                # PhotometricInterpretation = RGB
+                    (277, TIFF_SHORT, [3]),                # SamplesPerPixel
+                    (282, TIFF_RATIONAL, [(int (round (self.dpi * 100)), 100)]), # XResolution
+                    (283, TIFF_RATIONAL, [(int (round (self.dpi * 100)), 100)]), # YResolution
+                    (284, TIFF_SHORT, [1]),                # PlanarConfiguration = chunky
+                    (296, TIFF_SHORT, [2]) ]               # ResolutionUnit = inch
+
+        if self.tile_size is None:
+            entries += [ (273, TIFF_LONG, self.offsets),       # StripOffsets
+                         (278, TIFF_LONG, [self.rows_per_block]), # RowsPerStrip
+                         (279, TIFF_LONG, self.byte_counts) ]  # StripByteCounts
+        else:
+            entries += [ (322, TIFF_LONG, [self.tile_size]),   # TileWidth
+                         (323, TIFF_LONG, [self.tile_size]),   # TileLength
+                         (324, TIFF_LONG, self.offsets),       # TileOffsets
+                         (325, TIFF_LONG, self.byte_counts) ]  # TileByteCounts
+
+        entries.sort ()
+
+        self.write_ifd (entries)
+
+        self.file.close ()
+        os.replace (self.tmp_filename, self.filename)
+
+    # Gives up on the image, for when the render fails
+    def discard (self):
+        discard_output (self.file, self.tmp_filename)
+
+    def write_ifd (self, entries):
+        # The image directory must start on a word boundary
+        if self.file.tell () % 2 == 1:
+            self.file.write (b"\x00")
+
+        ifd_offset = self.file.tell ()
+        extra_offset = ifd_offset + 2 + 12 * len (entries) + 4
+
+        ifd = bytearray (struct.pack ("<H", len (entries)))
+        extra = bytearray ()
+
+        for (tag, field_type, values) in entries:
+            fmt = "<" + tiff_type_formats[field_type] * len (values)
+            if field_type == TIFF_RATIONAL:
+                data = struct.pack (fmt, *[v for pair in values for v in pair])
+            else:
+                data = struct.pack (fmt, *values)
+
+            if len (data) <= 4:
+                value = data.ljust (4, b"\x00")
+            else:
+                value = struct.pack ("<I", extra_offset + len (extra))
+                extra += data
+                if len (extra) % 2 == 1:
+                    extra += b"\x00"
+
+            ifd += struct.pack ("<HHI", tag, field_type, len (values)) + value
+
+        # No more image directories
+        ifd += struct.pack ("<I", 0)
+
+        self.file.write (ifd)
+        self.file.write (extra)
+
+        self.file.seek (4)
+        self.file.write (struct.pack ("<I", ifd_offset))
+
+#################### tests ####################
+
+# Returns a list of (chunk_type, data) from PNG data
+def read_png_chunks (data):
+    chunks = []
+    pos = 8
+
+    while pos < len (data):
+        (length,) = struct.unpack (">I", data[pos : pos + 4])
+        chunk_type = data[pos + 4 : pos + 8]
+        chunk_data = data[pos + 8 : pos + 8 + length]
+        (crc,) = struct.unpack (">I", data[pos + 8 + length : pos + 12 + length])
+
+        assert crc == zlib.crc32 (chunk_type + chunk_data) & 0xffffffff
+
+        chunks.append ((chunk_type, chunk_data))
+        pos += 12 + length
+
+    return chunks
+
+# Returns a dict of tag -> list of values from a little-endian TIFF file
+def read_tiff_tags (data):
+    (ifd_offset,) = struct.unpack ("<I", data[4:8])
+    (num_entries,) = struct.unpack ("<H", data[ifd_offset : ifd_offset + 2])
+
+    tags = {}
+    for i in range (num_entries):
+        entry = data[ifd_offset + 2 + 12 * i : ifd_offset + 14 + 12 * i]
+        (tag, field_type, count) = struct.unpack ("<HHI", entry[0:8])
+
+        size = tiff_type_sizes[field_type] * count
+        if size <= 4:
+            value_data = entry[8 : 8 + size]
+        else:
+            (offset,) = struct.unpack ("<I", entry[8:12])
+            value_data = data[offset : offset + size]
+
+        values = struct.unpack ("<" + tiff_type_formats[field_type] * count, value_data)
+        tags[tag] = list (values)
+
+    return tags
+
+class TestRasterWriter (unittest.TestCase):
+    def test_converts_cairo_pixels_to_rgb (self):
+        if sys.byteorder == "little":
+            pixel = bytes ([0x30, 0x20, 0x10, 0xff])
+        else:
+            pixel = bytes ([0xff, 0x10, 0x20, 0x30])
+
+        # 2x2 image with some padding at the end of each row
+        stride = 12
+        data = (pixel * 2 + b"\x00" * 4) * 2
+
+        self.assertEqual (cairo_rgb24_to_rgb (data, 2, 2, stride), bytes ([0x10, 0x20, 0x30]) * 4)
+
+    def test_writes_png_in_bands (self):
+        (fd, filename) = tempfile.mkstemp (suffix = ".png")
+        os.close (fd)
+
+        try:
+            width = 3
+            height = 5
+            rows = [bytes ([y, y, y]) * width for y in range (height)]
+
+            writer = PNGWriter (filename, width, height, 300)
+            writer.write_rows (b"".join (rows[0:2]), 2)
+            writer.write_rows (b"".join (rows[2:5]), 3)
+            writer.close ()
+
+            with open (filename, "rb") as f:
+                data = f.read ()
+        finally:
+            os.unlink (filename)
+
+        self.assertEqual (data[0:8], b"\x89PNG\r\n\x1a\n")
+
+        chunks = read_png_chunks (data)
+        self.assertEqual ([c[0] for c in chunks], [b"IHDR", b"pHYs", b"IDAT", b"IEND"])
+        self.assertEqual (struct.unpack (">II", chunks[0][1][0:8]), (width, height))
+        self.assertEqual (struct.unpack (">IIB", chunks[1][1]), (11811, 11811, 1))
+
+        pixels = zlib.decompress (b"".join (c[1] for c in chunks if c[0] == b"IDAT"))
+        self.assertEqual (pixels, b"".join (b"\x00" + row for row in rows))
+
+    def test_only_complete_images_get_the_filename (self):
+        dirname = tempfile.mkdtemp ()
+        filename = os.path.join (dirname, "map.png")
+
+        try:
+            for make_writer in [PNGWriter, TIFFWriter]:
+                writer = make_writer (filename, 3, 2, 300)
+                writer.write_rows (bytes (9), 1)
+                self.assertFalse (os.path.exists (filename))
+
+                writer.discard ()
+                self.assertEqual (os.listdir (dirname), [])
+
+                writer = make_writer (filename, 3, 2, 300)
+                writer.write_rows (bytes (18), 2)
+                writer.close ()
+                self.assertEqual (os.listdir (dirname), ["map.png"])
+
+                os.unlink (filename)
+        finally:
+            shutil.rmtree (dirname)
+
+    def make_test_rows (self, width, height):
+        return [bytes ((x * 7 + y * 13 + c) % 256 for x in range (width) for c in range (3)) for y in range (height)]
+
+    def write_test_tiff (self, width, height, tile_size):
+        (fd, filename) = tempfile.mkstemp (suffix = ".tif")
+        os.close (fd)
+
+        rows = self.make_test_rows (width, height)
+
+        try:
+            writer = TIFFWriter (filename, width, height, 300, tile_size)
+            writer.rows_per_block = tile_size or 16
+
+            # Bands that don't line up with the strips
+            for start in range (0, height, 10):
+                end = min (start + 10, height)
+                writer.write_rows (b"".join (rows[start:end]), end - start)
+
+            writer.close ()
+
+            with open (filename, "rb") as f:
+                data = f.read ()
+        finally:
+            os.unlink (filename)
+
+        return (data, rows)
+
+    def test_writes_striped_tiff (self):
+        (width, height) = (5, 37)
+        (data, rows) = self.write_test_tiff (width, height, None)
+
+        self.assertEqual (data[0:4], b"II*\x00")
+
+        tags = read_tiff_tags (data)
+        self.assertEqual (tags[256], [width])
+        self.assertEqual (tags[257], [height])
+        self.assertEqual (tags[258], [8, 8, 8])
+        self.assertEqual (tags[278], [16])
+        self.assertEqual (tags[282], [30000, 100])
+
+        pixels = b"".join (zlib.decompress (data[offset : offset + count])
+                           for (offset, count) in zip (tags[273], tags[279]))
+        self.assertEqual (pixels, b"".join (rows))
+
+    def test_writes_tiled_tiff (self):
+        (width, height) = (40, 37)
+        tile_size = 16
+        (data, rows) = self.write_test_tiff (width, height, tile_size)
+
+        tags = read_tiff_tags (data)
+        self.assertEqual (tags[322], [tile_size])
+        self.assertEqual (tags[323], [tile_size])
+
+        tiles_across = 3
+        tiles_down = 3
+        self.assertEqual (len (tags[324]), tiles_across * tiles_down)
+
+        tiles = [zlib.decompress (data[offset : offset + count]) for (offset, count) in zip (tags[324], tags[325])]
+
+        for y in range (height):
+            for x in range (width):
+                tile = tiles[(y // tile_size) * tiles_across + x // tile_size]
+                pos = ((y % tile_size) * tile_size + x % tile_size) * 3
+
+                self.assertEqual (tile[pos : pos + 3], rows[y][x * 3 : x * 3 + 3])
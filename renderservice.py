@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+
+# A long-running render service for web front ends.  It listens for HTTP
+# requests on localhost, takes a La Mapería JSON map layout, and sends
+# back the rendered PDF, SVG, PNG or TIFF.  Since the process stays
+# alive, the tile provider's HTTP connections and the decoded tiles stay
+# warm from one request to the next.
+#
+# Endpoints:
+#
+#   POST /render?format=pdf&dpi=300   Renders the layout in the request
+#                                     body, and sends back the result
+#                                     when it is ready.
+#
+#   POST /jobs?format=pdf&dpi=300     Queues the layout in the request
+#                                     body, and sends back its job as
+#                                     JSON right away.
+#
+#   GET /jobs/ID                      The job's status as JSON.
+#
+#   GET /jobs/ID/result               Waits for the job, and sends back
+#                                     the result.
+#
+#   DELETE /jobs/ID                   Cancels the job.
+#
+# Identical requests that arrive while a job for them is queued or
+# running share that job.  When the queue is full, requests get a 503.
+
+import os
+import json
+import time
+import queue
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import collections
+import unittest
+import urllib.parse
+import http.server
+import config
+import maplayout
+import tile_provider
+import chartrenderer
+import paperrenderer
+import lamaperia
+
+default_port = 8642
+default_num_workers = 2
+default_max_queued_jobs = 16
+
+# How many finished jobs keep their results around for GET /jobs/ID/result
+default_max_finished_jobs = 32
+
+# Decoded tiles that the workers keep in memory between jobs, all of them
+# together, unless the configuration has a "decoded_tile_cache_size"
+default_decoded_tiles = 64
+
+JOB_QUEUED    = "queued"
+JOB_RUNNING   = "running"
+JOB_DONE      = "done"
+JOB_FAILED    = "failed"
+JOB_CANCELLED = "cancelled"
+
+content_types = {
+    "pdf"        : "application/pdf",
+    "svg"        : "image/svg+xml",
+    "png"        : "image/png",
+    "tiff"       : "image/tiff",
+    "tiff-tiled" : "image/tiff",
+}
+
+class QueueFullError (Exception):
+    pass
+
+class RenderJob:
+    def __init__ (self, job_id, key, json_config, format, dpi):
+        self.id = job_id
+        self.key = key
+        self.json_config = json_config
+        self.format = format
+        self.dpi = dpi
+
+        self.state = JOB_QUEUED
+        self.filename = None
+        self.error = None
+        self.seconds = None
+
+        self.cancel_event = threading.Event ()
+        self.finished = threading.Event ()
+
+    def to_json (self):
+        return { "id"      : self.id,
+                 "state"   : self.state,
+                 "format"  : self.format,
+                 "error"   : self.error,
+                 "seconds" : self.seconds }
+
+# Identifies a job by everything that affects its output
+def compute_job_key (json_config, format, dpi):
+    key = json.dumps ([json_config, format, dpi], sort_keys = True)
+    return hashlib.sha1 (key.encode ("utf-8")).hexdigest ()
+
+class RenderService:
+    def __init__ (self, config_data,
+                  num_workers = default_num_workers,
+                  max_queued_jobs = default_max_queued_jobs,
+                  max_finished_jobs = default_max_finished_jobs):
+        self.config_data = config_data
+        self.max_finished_jobs = max_finished_jobs
+
+        self.lock = threading.Lock ()
+
+        # Cancelled jobs stay in the queue until a worker drops them, so
+        # the limit is on num_queued_jobs instead of on the queue's size
+        self.queue = queue.Queue ()
+        self.max_queued_jobs = max_queued_jobs
+        self.num_queued_jobs = 0
+
+        self.jobs = {}                                # id -> RenderJob
+        self.in_flight = {}                           # key -> RenderJob, for queued or running jobs
+        self.finished_jobs = collections.deque ()     # oldest first
+        self.num_submitted_jobs = 0
+
+        self.result_dir = tempfile.mkdtemp (prefix = "lamaperia-")
+
+        # The workers share the tile provider, and so its tile cache and
+        # request limits, and the decoded tiles
+        self.provider = self.make_provider ()
+        self.decoded_tiles = chartrenderer.DecodedTileCache (config_data.get ("decoded_tile_cache_size",
+                                                                              default_decoded_tiles))
+
+        self.workers = [threading.Thread (target = self.run_worker, daemon = True) for i in range (num_workers)]
+        for worker in self.workers:
+            worker.start ()
+
+    # Returns the RenderJob for a layout, which may be one that is already
+    # queued or running.  Raises QueueFullError if there is no room for it.
+    #
+    def submit (self, json_config, format, dpi):
+        key = compute_job_key (json_config, format, dpi)
+
+        with self.lock:
+            job = self.in_flight.get (key)
+            if job is not None:
+                return job
+
+            if self.num_queued_jobs >= self.max_queued_jobs:
+                raise QueueFullError ()
+
+            job_id = "{0}-{1}".format (key[:12], self.num_submitted_jobs + 1)
+            job = RenderJob (job_id, key, json_config, format, dpi)
+
+            self.queue.put (job)
+
+            self.num_queued_jobs += 1
+            self.num_submitted_jobs += 1
+            self.jobs[job.id] = job
+            self.in_flight[key] = job
+
+        return job
+
+    def get_job (self, job_id):
+        with self.lock:
+            return self.jobs.get (job_id)
+
+    # A queued job gets dropped when a worker picks it up; a running job
+    # stops at the next tile.
+    def cancel (self, job_id):
+        with self.lock:
+            job = self.jobs.get (job_id)
+            if job is None:
+                return None
+
+            if job.state in (JOB_QUEUED, JOB_RUNNING):
+                job.cancel_event.set ()
+
+                # Identical requests from now on get a new job
+                if self.in_flight.get (job.key) is job:
+                    del self.in_flight[job.key]
+
+            if job.state == JOB_QUEUED:
+                self.num_queued_jobs -= 1
+                self.finish_job_locked (job, JOB_CANCELLED)
+
+        return job
+
+    def make_provider (self):
+        return tile_provider.make_tile_provider (self.config_data)
+
+    # Overlays in the layouts from clients can only use the files under
+    # the "overlay_dir" of the configuration, with filenames relative to
+    # it, so that clients can't make the service read any other file.
+    # Returns a copy of the layout with the overlays' full filenames.
+    # Raises ValueError for other filenames, or if there is no overlay_dir.
+    #
+    def resolve_overlay_paths (self, json_config):
+        overlays = json_config.get ("overlays", [])
+        if len (overlays) == 0:
+            return json_config
+
+        overlay_dir = self.config_data.get ("overlay_dir")
+        if overlay_dir is None:
+            raise ValueError ("overlays are turned off; set overlay_dir in the service's configuration")
+
+        root = os.path.realpath (overlay_dir)
+        resolved = []
+
+        for overlay in overlays:
+            filename = os.path.realpath (os.path.join (root, overlay["geojson"]))
+
+            if os.path.commonpath ([root, filename]) != root:
+                raise ValueError ("overlay {0} is not in the overlay directory".format (overlay["geojson"]))
+
+            resolved.append (dict (overlay, geojson = filename))
+
+        return dict (json_config, overlays = resolved)
+
+    # The tile provider and the decoded tiles stay warm across jobs
+    def make_batch_renderer (self):
+        return lamaperia.BatchRenderer (self.config_data, paperrenderer.default_raster_dpi,
+                                        self.decoded_tiles, self.provider)
+
+    def run_worker (self):
+        batch_renderer = self.make_batch_renderer ()
+
+        while True:
+            job = self.queue.get ()
+            if job is None:
+                break
+
+            with self.lock:
+                # Cancelled jobs were already taken off num_queued_jobs
+                if job.cancel_event.is_set ():
+                    continue
+
+                self.num_queued_jobs -= 1
+                job.state = JOB_RUNNING
+
+            start = time.monotonic ()
+            filename = os.path.join (self.result_dir, job.id + paperrenderer.format_extensions[job.format])
+
+            try:
+                self.render_job (batch_renderer, job, filename)
+                (state, error) = (JOB_DONE, None)
+            except chartrenderer.RenderCancelled:
+                (state, error) = (JOB_CANCELLED, None)
+            except Exception as e:
+                (state, error) = (JOB_FAILED, "{0}: {1}".format (type (e).__name__, e))
+
+            with self.lock:
+                job.seconds = time.monotonic () - start
+
+                if state == JOB_DONE:
+                    job.filename = filename
+                else:
+                    job.error = error
+                    remove_file (filename)
+
+                if self.in_flight.get (job.key) is job:
+                    del self.in_flight[job.key]
+
+                self.finish_job_locked (job, state)
+
+        batch_renderer.close ()
+
+    def render_job (self, batch_renderer, job, filename):
+        batch_renderer.dpi = job.dpi
+        batch_renderer.cancel_event = job.cancel_event
+
+        batch_renderer.render_map (job.json_config, job.format, filename)
+
+    def finish_job_locked (self, job, state):
+        job.state = state
+        job.finished.set ()
+
+        self.finished_jobs.append (job)
+
+        while len (self.finished_jobs) > self.max_finished_jobs:
+            old_job = self.finished_jobs.popleft ()
+            del self.jobs[old_job.id]
+
+            if old_job.filename is not None:
+                remove_file (old_job.filename)
+                old_job.filename = None
+
+    def shutdown (self):
+        with self.lock:
+            for job in self.in_flight.values ():
+                job.cancel_event.set ()
+
+        for worker in self.workers:
+            self.queue.put (None)
+
+        for worker in self.workers:
+            worker.join ()
+
+        self.provider.close ()
+        shutil.rmtree (self.result_dir)
+
+def remove_file (filename):
+    try:
+        os.unlink (filename)
+    except FileNotFoundError:
+        pass
+
+class RenderRequestHandler (http.server.BaseHTTPRequestHandler):
+    chunk_size = 64 * 1024
+
+    def do_POST (self):
+        url = urllib.parse.urlparse (self.path)
+
+        if url.path not in ("/render", "/jobs"):
+            self.send_json (404, { "error" : "no such endpoint" })
+            return
+
+        params = urllib.parse.parse_qs (url.query)
+        format = params.get ("format", ["pdf"])[0]
+
+        try:
+            dpi = float (params.get ("dpi", [str (paperrenderer.default_raster_dpi)])[0])
+        except ValueError:
+            self.send_json (400, { "error" : "dpi must be a number" })
+            return
+
+        if format not in content_types:
+            self.send_json (400, { "error" : "format must be one of {0}".format (paperrenderer.format_names ()) })
+            return
+
+        try:
+            length = int (self.headers.get ("Content-Length", 0))
+            json_config = json.loads (self.rfile.read (length))
+
+            map_layout = maplayout.MapLayout ()
+            map_layout.load_from_json (json_config)
+            map_layout.validate ()
+
+            json_config = self.server.render_service.resolve_overlay_paths (json_config)
+        except (ValueError, TypeError, AttributeError) as e:
+            self.send_json (400, { "error" : "invalid map layout: {0}".format (e) })
+            return
+
+        try:
+            job = self.server.render_service.submit (json_config, format, dpi)
+        except QueueFullError:
+            self.send_json (503, { "error" : "too many jobs; try again later" }, { "Retry-After" : "5" })
+            return
+
+        if url.path == "/jobs":
+            self.send_json (202, job.to_json ())
+        else:
+            self.send_result (job)
+
+    def do_GET (self):
+        parts = self.path.strip ("/").split ("/")
+
+        if len (parts) < 2 or parts[0] != "jobs":
+            self.send_json (404, { "error" : "no such endpoint" })
+            return
+
+        job = self.server.render_service.get_job (parts[1])
+        if job is None:
+            self.send_json (404, { "error" : "no such job" })
+        elif len (parts) == 2:
+            self.send_json (200, job.to_json ())
+        elif len (parts) == 3 and parts[2] == "result":
+            self.send_result (job)
+        else:
+            self.send_json (404, { "error" : "no such endpoint" })
+
+    def do_DELETE (self):
+        parts = self.path.strip ("/").split ("/")
+
+        if len (parts) != 2 or parts[0] != "jobs":
+            self.send_json (404, { "error" : "no such endpoint" })
+            return
+
+        job = self.server.render_service.cancel (parts[1])
+        if job is None:
+            self.send_json (404, { "error" : "no such job" })
+        else:
+            self.send_json (200, job.to_json ())
+
+    # Waits for the job to finish, and streams its result file
+    def send_result (self, job):
+        job.finished.wait ()
+
+        if job.state != JOB_DONE:
+            self.send_json (409 if job.state == JOB_CANCELLED else 500, job.to_json ())
+            return
+
+        try:
+            f = open (job.filename, "rb")
+        except (OSError, TypeError):
+            # The result was already removed to make room for newer jobs
+            self.send_json (410, { "error" : "the result is gone; submit the job again" })
+            return
+
+        with f:
+            self.send_response (200)
+            self.send_header ("Content-Type", content_types[job.format])
+            self.send_header ("Content-Length", str (os.fstat (f.fileno ()).st_size))
+            self.send_header ("X-Job-Id", job.id)
+            self.end_headers ()
+
+            shutil.copyfileobj (f, self.wfile, self.chunk_size)
+
+    def send_json (self, status, obj, headers = {}):
+        data = json.dumps (obj).encode ("utf-8")
+
+        self.send_response (status)
+        self.send_header ("Content-Type", "application/json")
+        self.send_header ("Content-Length", str (len (data)))
+        for (name, value) in headers.items ():
+            self.send_header (name, value)
+        self.end_headers ()
+
+        self.wfile.write (data)
+
+def make_server (render_service, port = default_port):
+    server = http.server.ThreadingHTTPServer (("127.0.0.1", port), RenderRequestHandler)
+    server.render_service = render_service
+
+    return server
+
+def main (config_data):
+    parser = argparse.ArgumentParser (description = "Runs La Mapería as a render service on localhost.")
+
+    parser.add_argument ("--port",       type = int, default = default_port)
+    parser.add_argument ("--workers",    type = int, default = default_num_workers,
+                         help = "how many maps to render at the same time")
+    parser.add_argument ("--queue-size", type = int, default = default_max_queued_jobs,
+                         help = "how many jobs can wait for a worker")
+
+    args = parser.parse_args ()
+
+    render_service = RenderService (config_data, args.workers, args.queue_size)
+    server = make_server (render_service, args.port)
+
+    print ("Listening on http://127.0.0.1:{0}/".format (args.port))
+
+    try:
+        server.serve_forever ()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close ()
+        render_service.shutdown ()
+
+#################### tests ####################
+
+class UnusedBatchRenderer:
+    def close (self):
+        pass
+
+# Doesn't render anything; each job just waits until the test lets it
+# finish, or until it gets cancelled.
+class BlockingRenderService (RenderService):
+    def __init__ (self, *args, **kwargs):
+        self.release = threading.Event ()
+        self.rendered = []
+
+        RenderService.__init__ (self, {}, *args, **kwargs)
+
+    def make_provider (self):
+        return tile_provider.NullTileProvider ()
+
+    def make_batch_renderer (self):
+        return UnusedBatchRenderer ()
+
+    def render_job (self, batch_renderer, job, filename):
+        while not self.release.wait (0.01):
+            if job.cancel_event.is_set ():
+                raise chartrenderer.RenderCancelled ()
+
+        self.rendered.append (job.id)
+
+        with open (filename, "wb") as f:
+            f.write (json.dumps (job.json_config).encode ("utf-8"))
+
+class TestRenderService (unittest.TestCase):
+    def make_service (self, **kwargs):
+        service = BlockingRenderService (**kwargs)
+        self.addCleanup (service.shutdown)
+        self.addCleanup (service.release.set)
+
+        return service
+
+    def test_identical_jobs_are_deduplicated (self):
+        service = self.make_service (num_workers = 1)
+
+        first = service.submit ({ "zoom" : 15 }, "pdf", 300)
+        second = service.submit ({ "zoom" : 15 }, "pdf", 300)
+        other = service.submit ({ "zoom" : 15 }, "svg", 300)
+
+        self.assertIs (first, second)
+        self.assertIsNot (first, other)
+
+        service.release.set ()
+        first.finished.wait ()
+        other.finished.wait ()
+
+        self.assertEqual (service.rendered.count (first.id), 1)
+        self.assertEqual (first.state, JOB_DONE)
+
+    def test_rejects_jobs_when_the_queue_is_full (self):
+        service = self.make_service (num_workers = 1, max_queued_jobs = 1)
+
+        running = service.submit ({ "zoom" : 1 }, "pdf", 300)
+        while running.state != JOB_RUNNING:
+            time.sleep (0.01)
+
+        service.submit ({ "zoom" : 2 }, "pdf", 300)
+
+        with self.assertRaises (QueueFullError):
+            service.submit ({ "zoom" : 3 }, "pdf", 300)
+
+    def test_cancelled_jobs_free_their_place_in_the_queue (self):
+        service = self.make_service (num_workers = 1, max_queued_jobs = 1)
+
+        running = service.submit ({ "zoom" : 1 }, "pdf", 300)
+        while running.state != JOB_RUNNING:
+            time.sleep (0.01)
+
+        queued = service.submit ({ "zoom" : 2 }, "pdf", 300)
+        service.cancel (queued.id)
+
+        again = service.submit ({ "zoom" : 3 }, "pdf", 300)
+
+        service.release.set ()
+        again.finished.wait ()
+
+        self.assertEqual (again.state, JOB_DONE)
+        self.assertNotIn (queued.id, service.rendered)
+
+    def test_cancels_queued_and_running_jobs (self):
+        service = self.make_service (num_workers = 1)
+
+        running = service.submit ({ "zoom" : 1 }, "pdf", 300)
+        queued = service.submit ({ "zoom" : 2 }, "pdf", 300)
+
+        while running.state != JOB_RUNNING:
+            time.sleep (0.01)
+
+        service.cancel (queued.id)
+        self.assertEqual (queued.state, JOB_CANCELLED)
+
+        service.cancel (running.id)
+        running.finished.wait ()
+        self.assertEqual (running.state, JOB_CANCELLED)
+
+        # After cancelling, the same layout gets a new job
+        again = service.submit ({ "zoom" : 1 }, "pdf", 300)
+        self.assertIsNot (again, running)
+
+    def test_only_allows_overlays_from_the_overlay_directory (self):
+        service = self.make_service (num_workers = 1)
+        layout = { "zoom" : 15, "overlays" : [{ "geojson" : "power.geojson" }] }
+
+        with self.assertRaises (ValueError):
+            service.resolve_overlay_paths (layout)
+
+        overlay_dir = tempfile.mkdtemp ()
+        self.addCleanup (shutil.rmtree, overlay_dir)
+        service.config_data = { "overlay_dir" : overlay_dir }
+
+        resolved = service.resolve_overlay_paths (layout)
+        self.assertEqual (resolved["overlays"][0]["geojson"],
+                          os.path.join (os.path.realpath (overlay_dir), "power.geojson"))
+        self.assertEqual (layout["overlays"][0]["geojson"], "power.geojson")
+
+        for filename in ("../power.geojson", "/etc/passwd", "sub/../../power.geojson"):
+            with self.assertRaises (ValueError):
+                service.resolve_overlay_paths ({ "overlays" : [{ "geojson" : filename }] })
+
+        self.assertIs (service.resolve_overlay_paths ({ "zoom" : 15 })["zoom"], 15)
+
+    def test_forgets_old_results (self):
+        service = self.make_service (num_workers = 1, max_finished_jobs = 2)
+        service.release.set ()
+
+        jobs = [service.submit ({ "zoom" : i }, "pdf", 300) for i in range (4)]
+        for job in jobs:
+            job.finished.wait ()
+
+        self.assertIsNone (service.get_job (jobs[0].id))
+        self.assertIsNotNone (service.get_job (jobs[3].id))
+        self.assertTrue (os.path.exists (jobs[3].filename))
+
+if __name__ == "__main__":
+    try:
+        config_data = config.config_load ()
+    except IOError as e:
+        print ("La Mapería is not configured yet.  Run ./lamaperia.py first to configure it.")
+        exit (1)
+    except ValueError as e:
+        print ("The configuration in {} is not valid: {}".format (config.config_get_configuration_filename (),
+                                                                  e.args[0]))
+        exit (1)
+
+    main (config_data)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# Downloads into the tile cache all the tiles that a set of maps need, so
+# that rendering them afterwards doesn't touch the network.  The maps can
+# be given as La Mapería JSON layouts, or as lat/lon bounding boxes.
+#
+# Tiles that are already in the cache are skipped, so if seeding gets
+# interrupted you can just run the same command again to resume it.
+
+import sys
+import argparse
+import json
+import shutil
+import tempfile
+import unittest
+import config
+import tilecache
+import maplayout
+import chartgeometry
+import tile_provider
+import tilefetcher
+from tilecoords import *
+from parsedegrees import *
+from lamaperia import jsonfile
+
+# Returns the set of (z, x, y) tiles that ChartRenderer will request for a map
+def compute_tiles_for_layout (map_layout, provider):
+    geometry = chartgeometry.ChartGeometry (map_layout, provider)
+    geometry.compute_extents_of_downloaded_tiles ()
+
+    return { (map_layout.zoom, x, y)
+             for y in range (geometry.north_tile_idx, geometry.south_tile_idx + 1)
+             for x in range (geometry.west_tile_idx, geometry.east_tile_idx + 1) }
+
+# Returns the set of (z, x, y) tiles that cover a bounding box
+def compute_tiles_for_bbox (z, lat1, lon1, lat2, lon2):
+    (x1, y1) = coordinates_to_tile_number (z, max (lat1, lat2), min (lon1, lon2))
+    (x2, y2) = coordinates_to_tile_number (z, min (lat1, lat2), max (lon1, lon2))
+
+    return { (z, x, y)
+             for y in range (y1, y2 + 1)
+             for x in range (x1, x2 + 1) }
+
+# Downloads the tiles that are not in the provider's cache yet.  Returns
+# how many tiles had to be downloaded.  The provider stays open; closing
+# it is up to the caller.
+#
+def seed_tiles (provider, tiles, max_in_flight = tilefetcher.default_max_tiles_in_flight):
+    missing = sorted (t for t in tiles if not provider.store.has_tile (*t))
+
+    print ("{0} tiles needed, {1} already cached, {2} to download".format (len (tiles),
+                                                                           len (tiles) - len (missing),
+                                                                           len (missing)))
+
+    zooms = sorted ({ z for (z, x, y) in missing })
+    downloaded = 0
+
+    try:
+        for z in zooms:
+            # Sorted by (y, x) so that the tiles for a map are close together
+            coords = sorted (((x, y) for (tz, x, y) in missing if tz == z), key = lambda c: (c[1], c[0]))
+
+            for (x, y, png_data) in tilefetcher.fetch_tiles (provider, z, coords, max_in_flight):
+                downloaded += 1
+                print ("Downloaded tile {0} of {1}".format (downloaded, len (missing)), end='\r', flush=True)
+    finally:
+        print ("")
+
+    return downloaded
+
+def main (config_data):
+    parser = argparse.ArgumentParser (description = "Downloads the tiles for a set of maps into La Mapería's tile cache.")
+
+    parser.add_argument ("configs", type = jsonfile, nargs = "*", metavar = "JSON-FILENAME")
+    parser.add_argument ("--bbox", type = parse_degrees, nargs = 4, action = "append", default = [],
+                         metavar = ("LAT1", "LON1", "LAT2", "LON2"))
+    parser.add_argument ("--zoom", type = int, action = "append", default = [],
+                         help = "zoom level for the --bbox areas; can be given more than once")
+
+    args = parser.parse_args ()
+
+    if len (args.configs) == 0 and len (args.bbox) == 0:
+        parser.error ("specify some JSON map layouts or --bbox areas")
+
+    if len (args.bbox) > 0 and len (args.zoom) == 0:
+        parser.error ("--bbox needs at least one --zoom")
+
+    provider = tile_provider.make_tile_provider (config_data)
+    if not isinstance (provider, tile_provider.CachingTileProvider):
+        print ("The tile cache is turned off in {0}; there is nothing to seed.".format (config.config_get_configuration_filename ()))
+        exit (1)
+
+    try:
+        tiles = set ()
+
+        for json_config in args.configs:
+            map_layout = maplayout.MapLayout ()
+            map_layout.load_from_json (json_config)
+            tiles |= compute_tiles_for_layout (map_layout, provider)
+
+        for (lat1, lon1, lat2, lon2) in args.bbox:
+            for z in args.zoom:
+                tiles |= compute_tiles_for_bbox (z, lat1, lon1, lat2, lon2)
+
+        seed_tiles (provider, tiles, config_data.get ("download_threads", tilefetcher.default_max_tiles_in_flight))
+    finally:
+        provider.close ()
+
+#################### tests ####################
+
+class TestSeedCache (unittest.TestCase):
+    def setUp (self):
+        self.path = tempfile.mkdtemp ()
+
+    def tearDown (self):
+        shutil.rmtree (self.path)
+
+    def make_layout (self, map_scale):
+        layout = maplayout.MapLayout ()
+        layout.load_from_json (json.loads ("""
+            {{
+                "zoom" : 15,
+                "center-lat" : 19.4621106,
+                "center-lon" : -96.9040473,
+                "map-scale"  : {0}
+            }}
+        """.format (map_scale)))
+
+        return layout
+
+    def test_dedupes_tiles_of_overlapping_maps (self):
+        provider = tile_provider.NullTileProvider ()
+
+        tiles_20000 = compute_tiles_for_layout (self.make_layout (20000), provider)
+        tiles_50000 = compute_tiles_for_layout (self.make_layout (50000), provider)
+
+        # Same center, so the smaller map's tiles are all part of the larger one's
+        self.assertTrue (tiles_20000 <= tiles_50000)
+        self.assertEqual (len (tiles_20000 | tiles_50000), len (tiles_50000))
+
+    def test_computes_tiles_for_bbox (self):
+        tiles = compute_tiles_for_bbox (15, 19.45, -96.92, 19.47, -96.89)
+
+        (x1, y1) = coordinates_to_tile_number (15, 19.47, -96.92)
+        (x2, y2) = coordinates_to_tile_number (15, 19.45, -96.89)
+
+        self.assertEqual (len (tiles), (x2 - x1 + 1) * (y2 - y1 + 1))
+        self.assertIn ((15, x1, y1), tiles)
+        self.assertIn ((15, x2, y2), tiles)
+
+    def test_only_downloads_missing_tiles (self):
+        null_provider = tile_provider.NullTileProvider ()
+        store = tilecache.DirectoryTileStore (self.path, 1024 * 1024 * 1024)
+        provider = tile_provider.CachingTileProvider (null_provider, store)
+
+        tiles = { (15, 20, 30), (15, 21, 30) }
+        self.assertEqual (seed_tiles (provider, tiles), 2)
+        self.assertEqual (seed_tiles (provider, tiles | { (15, 22, 30) }), 1)
+
+        provider.close ()
+
+if __name__ == "__main__":
+    try:
+        config_data = config.config_load ()
+    except IOError as e:
+        print ("La Mapería is not configured yet.  Run ./lamaperia.py first to configure it.")
+        exit (1)
+    except ValueError as e:
+        print ("The configuration in {} is not valid: {}".format (config.config_get_configuration_filename (),
+                                                                  e.args[0]))
+        exit (1)
+
+    main (config_data)
@@ -1,9 +1,100 @@
+import os
 import requests
+import requests.adapters
 import unittest
 import cairo
 import io
+import struct
+import tempfile
+import shutil
+import threading
+import time
+import concurrent.futures
+import config
+import httpretry
+import tilecache
+
+default_http_pool_size = 16
+
+shared_sessions_lock = threading.Lock ()
+shared_sessions = {}
+
+# Returns a requests.Session that keeps up to pool_size connections alive
+# per host.  All the HTTP-based providers share it, so downloading a map
+# pays for the TCP and TLS handshakes once per connection instead of
+# once per tile.
+#
+def get_shared_session (pool_size = default_http_pool_size):
+    with shared_sessions_lock:
+        session = shared_sessions.get (pool_size)
+
+        if session is None:
+            session = requests.Session ()
+            adapter = requests.adapters.HTTPAdapter (pool_connections = 4, pool_maxsize = pool_size)
+            session.mount ("http://", adapter)
+            session.mount ("https://", adapter)
+
+            shared_sessions[pool_size] = session
+
+        return session
+
+shared_limits_lock = threading.Lock ()
+shared_limits = {}
+
+# Returns (rate_limiter, concurrency) for the request limits in La
+# Mapería's configuration.  Like the sessions, they are shared by all the
+# providers in the process, so that the limits apply to the process as a
+# whole, and all of its providers back off together when the tile server
+# is overloaded.
+#
+def get_shared_limits (config):
+    pool_size = config.get ('http_pool_size', default_http_pool_size)
+
+    key = (config.get ('requests_per_second', 0),
+           config.get ('max_concurrent_requests', pool_size),
+           config.get ('healthy_latency_s', 1.0))
+
+    with shared_limits_lock:
+        limits = shared_limits.get (key)
+
+        if limits is None:
+            (requests_per_second, max_concurrent_requests, healthy_latency_s) = key
+
+            limits = (httpretry.TokenBucket (requests_per_second),
+                      httpretry.AimdController (max_concurrent_requests, healthy_latency_s = healthy_latency_s))
+
+            shared_limits[key] = limits
+
+        return limits
+
+# Returns a copy of the configuration for each of num_processes worker
+# processes, with the request limits divided among them, so that all
+# the processes together stay within the configured limits.
+#
+def split_request_limits (config, num_processes):
+    if num_processes <= 1:
+        return config
+
+    pool_size = config.get ('http_pool_size', default_http_pool_size)
+
+    return dict (config,
+                 requests_per_second = config.get ('requests_per_second', 0) / num_processes,
+                 max_concurrent_requests = max (1, config.get ('max_concurrent_requests', pool_size) // num_processes))
+
+# The "directory" tile cache keeps track of its size in each process,
+# so with several processes it can grow past tile_cache_max_mb.  Tells
+# the user about the "mbtiles" format, whose size is kept in the file.
+#
+def warn_about_directory_cache (config, num_processes):
+    if (num_processes > 1 and config.get ('tile_cache', True)
+        and config.get ('tile_cache_format', 'directory') == 'directory'):
+        print ("Note: with several processes the tile cache directory can grow past tile_cache_max_mb; "
+               "use \"tile_cache_format\" : \"mbtiles\" to keep it bounded")
 
 class TileProvider:
+    # Whether make_tile_provider() should put a tile cache in front of this provider
+    needs_cache = True
+
     def __init__ (self, config):
         self.config = config
 
@@ -13,7 +104,45 @@ class TileProvider:
     def get_tile_size (self):
         pass
 
+    # Returns a relative path that identifies the set of tiles that this
+    # provider serves, e.g. a particular style, so that caches can keep
+    # tiles from different providers apart.
+    def get_cache_namespace (self):
+        pass
+
+    # Called before requesting a range of tiles (inclusive) for a map, so
+    # that providers can fetch them in bulk.
+    def prefetch_tiles (self, z, west_x, north_y, east_x, south_y):
+        pass
+
+    # Called after all the tiles for a map have been requested.
+    def flush (self):
+        pass
+
+    # Called when the program is done with the provider.
+    def close (self):
+        self.flush ()
+
+    # Like get_tile_png(), but for revalidating a cached tile.  The
+    # validators dict can have 'etag' and 'last_modified' keys from an
+    # earlier call.  Returns (png_data, validators); png_data is None if
+    # the tile has not changed.  Providers that don't support
+    # revalidation just return the tile.
+    #
+    def get_tile_png_conditional (self, z, x, y, validators):
+        return (self.get_tile_png (z, x, y), {})
+
 class MapboxTileProvider (TileProvider):
+    def __init__ (self, config):
+        TileProvider.__init__ (self, config)
+
+        pool_size = config.get ('http_pool_size', default_http_pool_size)
+        self.session = get_shared_session (pool_size)
+
+        # The limits are shared by all the threads and providers in the process
+        self.retry_policy = httpretry.RetryPolicy (max_retries = config.get ('max_retries', 5))
+        (self.rate_limiter, self.concurrency) = get_shared_limits (config)
+
     def get_uri_for_tile (self, z, x, y):
         uri = "https://api.mapbox.com/styles/v1/{username}/{style_id}/tiles/{z}/{x}/{y}".format (
             username = self.config['mapbox_username'],
@@ -29,31 +158,88 @@ class MapboxTileProvider (TileProvider):
             'access_token' : self.config['mapbox_access_token']
         }
 
-    def make_request_for_tile (self, z, x, y):
-        retries = 5
+    def make_request_for_tile (self, z, x, y, headers = None):
+        url = self.get_uri_for_tile (z, x, y)
+        attempt = 0
+
+        while True:
+            self.rate_limiter.acquire ()
+            self.concurrency.acquire ()
+
+            start = time.monotonic ()
+            try:
+                r = self.session.get (url, params = self.get_request_params (), headers = headers)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retry_policy.max_retries:
+                    raise
+
+                r = None
+            finally:
+                self.concurrency.release ()
 
-        while retries > 0:
-            url = self.get_uri_for_tile (z, x, y)
-            r = requests.get (url, params = self.get_request_params ())
-            if r.status_code != 200:
-                print ("request for {0} returned {1}, retrying...".format (url, r.status_code))
-                retries -= 1
-                continue
+            latency = time.monotonic () - start
+
+            if r is not None:
+                if self.retry_policy.classify (r.status_code) == httpretry.RESPONSE_OK:
+                    self.concurrency.on_success (latency)
+                    return r
+
+                if r.status_code in httpretry.congestion_statuses:
+                    self.concurrency.on_congestion ()
+
+                if not self.retry_policy.should_retry (r.status_code, attempt):
+                    # Statuses like 204 are not errors for requests, but
+                    # they are not tiles either
+                    r.raise_for_status ()
+                    raise requests.HTTPError ("unexpected status {0} for {1}".format (r.status_code, url), response = r)
+
+                status = r.status_code
+                retry_after = r.headers.get ('Retry-After')
             else:
-                break
+                self.concurrency.on_congestion ()
+                status = "a connection error"
+                retry_after = None
 
-        if retries == 0:
-            r.raise_for_status ()
+            delay = self.retry_policy.compute_delay (attempt, retry_after)
+            print ("request for {0} returned {1}, retrying in {2:.1f} s...".format (url, status, delay))
 
-        return r
+            time.sleep (delay)
+            attempt += 1
 
     def get_tile_png (self, z, x, y):
         r = self.make_request_for_tile (z, x, y)
         return r.content
 
+    def get_tile_png_conditional (self, z, x, y, validators):
+        headers = {}
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last_modified' in validators:
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        r = self.make_request_for_tile (z, x, y, headers)
+
+        if r.status_code == 304:
+            new_validators = dict (validators)
+        else:
+            new_validators = {}
+
+        if 'ETag' in r.headers:
+            new_validators['etag'] = r.headers['ETag']
+        if 'Last-Modified' in r.headers:
+            new_validators['last_modified'] = r.headers['Last-Modified']
+
+        if r.status_code == 304:
+            return (None, new_validators)
+        else:
+            return (r.content, new_validators)
+
     def get_tile_size (self):
         return 512
 
+    def get_cache_namespace (self):
+        return os.path.join ("mapbox", self.config['mapbox_username'], self.config['mapbox_style_id'])
+
 class TileStacheTileProvider (MapboxTileProvider):
 
     def get_uri_for_tile (self, z, x, y):
@@ -69,8 +255,59 @@ class TileStacheTileProvider (MapboxTileProvider):
     def get_request_params (self):
         return {}
 
+    def get_cache_namespace (self):
+        return os.path.join ("tilestache",
+                             "{0}-{1}".format (self.config['tilestache_host'], self.config['tilestache_port']),
+                             "fmq-mapbox")
+
+# Reads tiles from an MBTiles file, which is an SQLite database with a
+# standard schema.  The filename comes from the 'mbtiles_filename'
+# configuration key.
+#
+class MBTilesTileProvider (TileProvider):
+    needs_cache = False
+
+    def __init__ (self, config):
+        TileProvider.__init__ (self, config)
+
+        self.store = tilecache.MBTilesTileStore (config['mbtiles_filename'], None)
+        self.tile_size = None
+
+    def get_tile_png (self, z, x, y):
+        data = self.store.get_tile (z, x, y)
+        if data is None:
+            raise KeyError ("tile {0}/{1}/{2} is not in {3}".format (z, x, y, self.config['mbtiles_filename']))
+
+        return data
+
+    # MBTiles files don't say how big their tiles are, so look at the
+    # IHDR chunk of the first tile's PNG data.
+    def get_tile_size (self):
+        if self.tile_size is None:
+            row = self.store.db.execute ("SELECT tile_data FROM tiles LIMIT 1").fetchone ()
+            if row is None:
+                raise ValueError ("{0} does not contain any tiles".format (self.config['mbtiles_filename']))
+
+            (self.tile_size,) = struct.unpack (">I", bytes (row[0])[16:20])
+
+        return self.tile_size
+
+    def get_cache_namespace (self):
+        return os.path.join ("mbtiles", os.path.splitext (os.path.basename (self.config['mbtiles_filename']))[0])
+
+    def prefetch_tiles (self, z, west_x, north_y, east_x, south_y):
+        self.store.prefetch_tiles (z, west_x, north_y, east_x, south_y)
+
+    def flush (self):
+        self.store.flush ()
+
 class NullTileProvider (TileProvider):
+    needs_cache = False
+
     def __init__ (self):
+        # Tiles may be requested from several download threads at once
+        self.lock = threading.Lock ()
+
         self.north_tile_requested_limit = -1
         self.south_tile_requested_limit = -1
         self.east_tile_requested_limit = -1
@@ -85,6 +322,12 @@ class NullTileProvider (TileProvider):
         data = f.read ()
         f.close ()
 
+        with self.lock:
+            self.update_requested_limits (x, y)
+
+        return data
+
+    def update_requested_limits (self, x, y):
         if self.west_tile_requested_limit < 0:
             self.west_tile_requested_limit = x
         elif x < self.west_tile_requested_limit:
@@ -105,10 +348,148 @@ class NullTileProvider (TileProvider):
         elif y > self.south_tile_requested_limit:
             self.south_tile_requested_limit = y
 
+    def get_tile_size (self):
+        return 512
+
+    def get_cache_namespace (self):
+        return "null"
+
+# Wraps another TileProvider and keeps the tiles it returns in a store
+# from the tilecache module, so that they only get downloaded once.
+#
+# If max_age_s is not None, tiles older than that get revalidated with
+# the HTTP validators (ETag, Last-Modified) that came with them, so
+# unchanged tiles cost a 304 response instead of a full download.  With
+# stale_while_revalidate, expired tiles are returned right away and get
+# revalidated in the background for the next render.
+#
+class CachingTileProvider (TileProvider):
+    def __init__ (self, provider, store, max_age_s = None, stale_while_revalidate = False):
+        self.provider = provider
+        self.store = store
+        self.max_age_s = max_age_s
+        self.stale_while_revalidate = stale_while_revalidate
+
+        self.lock = threading.Lock ()
+        self.revalidating = set ()
+        self.revalidation_executor = None
+
+    def get_tile_png (self, z, x, y):
+        data = self.store.get_tile (z, x, y)
+        if data is None:
+            return self.download_tile (z, x, y, {})
+
+        if self.max_age_s is None:
+            return data
+
+        metadata = self.store.get_tile_metadata (z, x, y)
+        if metadata is not None and time.time () - metadata['fetched_at'] < self.max_age_s:
+            return data
+
+        # Tiles cached without metadata have an unknown age, so they count as expired
+        if metadata is not None:
+            validators = metadata['validators']
+        else:
+            validators = {}
+
+        if self.stale_while_revalidate:
+            self.revalidate_in_background (z, x, y, validators)
+            return data
+
+        # If the tile server is down, an expired tile is still better than
+        # failing the whole render.
+        try:
+            new_data = self.download_tile (z, x, y, validators)
+        except requests.RequestException as e:
+            print ("could not revalidate tile {0}/{1}/{2}, using the cached one: {3}".format (z, x, y, e))
+            return data
+
+        if new_data is None:
+            return data
+        else:
+            return new_data
+
+    # Returns the new tile data, or None if the cached tile is still good
+    def download_tile (self, z, x, y, validators):
+        (data, new_validators) = self.provider.get_tile_png_conditional (z, x, y, validators)
+
+        if data is not None:
+            self.store.put_tile (z, x, y, data)
+
+        self.store.put_tile_metadata (z, x, y, { 'fetched_at' : time.time (),
+                                                 'validators' : new_validators })
         return data
 
+    def revalidate_in_background (self, z, x, y, validators):
+        with self.lock:
+            if (z, x, y) in self.revalidating:
+                return
+
+            self.revalidating.add ((z, x, y))
+
+            if self.revalidation_executor is None:
+                self.revalidation_executor = concurrent.futures.ThreadPoolExecutor (max_workers = 2)
+
+        self.revalidation_executor.submit (self.revalidate_tile, z, x, y, validators)
+
+    def revalidate_tile (self, z, x, y, validators):
+        try:
+            self.download_tile (z, x, y, validators)
+        except Exception as e:
+            print ("could not revalidate tile {0}/{1}/{2}: {3}".format (z, x, y, e))
+        finally:
+            with self.lock:
+                self.revalidating.discard ((z, x, y))
+
     def get_tile_size (self):
-        return 512
+        return self.provider.get_tile_size ()
+
+    def get_cache_namespace (self):
+        return self.provider.get_cache_namespace ()
+
+    def prefetch_tiles (self, z, west_x, north_y, east_x, south_y):
+        self.store.prefetch_tiles (z, west_x, north_y, east_x, south_y)
+        self.provider.prefetch_tiles (z, west_x, north_y, east_x, south_y)
+
+    def flush (self):
+        self.store.flush ()
+        self.provider.flush ()
+
+    # Waits for background revalidations to finish, so their results get stored
+    def close (self):
+        if self.revalidation_executor is not None:
+            self.revalidation_executor.shutdown (wait = True)
+            self.revalidation_executor = None
+
+        self.flush ()
+
+# Creates the tile provider described by La Mapería's configuration,
+# wrapped in a tile cache unless the configuration turns it off.
+#
+def make_tile_provider (config_data):
+    provider_classname = '{}TileProvider'.format (config_data['provider'])
+    provider_class = globals ()[provider_classname]
+    provider = provider_class (config_data)
+
+    if provider.needs_cache and config_data.get ('tile_cache', True):
+        cache_dir = config_data.get ('tile_cache_dir', config.config_get_tile_cache_path ())
+        max_size_bytes = config_data.get ('tile_cache_max_mb', tilecache.default_max_cache_size_mb) * 1024 * 1024
+        cache_format = config_data.get ('tile_cache_format', 'directory')
+
+        path = os.path.join (cache_dir, provider.get_cache_namespace ())
+
+        if cache_format == 'directory':
+            store = tilecache.DirectoryTileStore (path, max_size_bytes)
+        elif cache_format == 'mbtiles':
+            store = tilecache.MBTilesTileStore (path + ".mbtiles", max_size_bytes)
+        else:
+            raise ValueError ("tile_cache_format was specified as '{0}'; it must be one of 'directory', 'mbtiles'".format (cache_format))
+
+        provider = CachingTileProvider (provider, store,
+                                        max_age_s = config_data.get ('tile_cache_max_age_s', None),
+                                        stale_while_revalidate = config_data.get ('tile_cache_stale_while_revalidate', False))
+
+    return provider
 
 #################### tests ####################
 
@@ -144,3 +525,203 @@ class TestNullTileProvider (unittest.TestCase):
         self.assertEqual (tile_provider.south_tile_requested_limit, 50)
         self.assertEqual (tile_provider.west_tile_requested_limit, 20)
         self.assertEqual (tile_provider.east_tile_requested_limit, 40)
+
+class TestCachingTileProvider (unittest.TestCase):
+    def setUp (self):
+        self.path = tempfile.mkdtemp ()
+
+    def tearDown (self):
+        shutil.rmtree (self.path)
+
+    def test_only_requests_tiles_once (self):
+        null_provider = NullTileProvider ()
+        store = tilecache.DirectoryTileStore (self.path, 1024 * 1024)
+        provider = CachingTileProvider (null_provider, store)
+
+        first = provider.get_tile_png (15, 20, 30)
+        self.assertEqual (null_provider.west_tile_requested_limit, 20)
+
+        # Tiles that are already cached must not reach the wrapped provider
+        null_provider.west_tile_requested_limit = -1
+        second = provider.get_tile_png (15, 20, 30)
+
+        self.assertEqual (first, second)
+        self.assertEqual (null_provider.west_tile_requested_limit, -1)
+        self.assertEqual (provider.get_tile_size (), null_provider.get_tile_size ())
+
+    def make_revalidating_provider (self):
+        class RevalidatingTileProvider (TileProvider):
+            def __init__ (self):
+                self.requests = []
+                self.data = b"version 1"
+
+            def get_tile_png_conditional (self, z, x, y, validators):
+                self.requests.append (dict (validators))
+
+                etag = '"' + self.data.decode () + '"'
+                if validators.get ('etag') == etag:
+                    return (None, validators)
+                else:
+                    return (self.data, { 'etag' : etag })
+
+        return RevalidatingTileProvider ()
+
+    def test_revalidates_expired_tiles (self):
+        upstream = self.make_revalidating_provider ()
+        store = tilecache.DirectoryTileStore (self.path, 1024 * 1024)
+        provider = CachingTileProvider (upstream, store, max_age_s = 0)
+
+        self.assertEqual (provider.get_tile_png (15, 20, 30), b"version 1")
+        self.assertEqual (upstream.requests, [{}])
+
+        # Unchanged tile: the cached validators get sent, and the cached data is used
+        self.assertEqual (provider.get_tile_png (15, 20, 30), b"version 1")
+        self.assertEqual (upstream.requests[-1], { 'etag' : '"version 1"' })
+
+        upstream.data = b"version 2"
+        self.assertEqual (provider.get_tile_png (15, 20, 30), b"version 2")
+        self.assertEqual (store.get_tile (15, 20, 30), b"version 2")
+
+    def test_does_not_revalidate_fresh_tiles (self):
+        upstream = self.make_revalidating_provider ()
+        store = tilecache.DirectoryTileStore (self.path, 1024 * 1024)
+        provider = CachingTileProvider (upstream, store, max_age_s = 3600)
+
+        provider.get_tile_png (15, 20, 30)
+        provider.get_tile_png (15, 20, 30)
+
+        self.assertEqual (len (upstream.requests), 1)
+
+    def test_serves_expired_tiles_when_revalidation_fails (self):
+        upstream = self.make_revalidating_provider ()
+        store = tilecache.DirectoryTileStore (self.path, 1024 * 1024)
+        provider = CachingTileProvider (upstream, store, max_age_s = 0)
+
+        provider.get_tile_png (15, 20, 30)
+
+        def fail (z, x, y, validators):
+            raise requests.ConnectionError ("tile server is down")
+
+        upstream.get_tile_png_conditional = fail
+        self.assertEqual (provider.get_tile_png (15, 20, 30), b"version 1")
+
+        # Tiles that were never cached still fail
+        with self.assertRaises (requests.ConnectionError):
+            provider.get_tile_png (15, 21, 30)
+
+    def test_serves_stale_tiles_while_revalidating (self):
+        upstream = self.make_revalidating_provider ()
+        store = tilecache.DirectoryTileStore (self.path, 1024 * 1024)
+        provider = CachingTileProvider (upstream, store, max_age_s = 0, stale_while_revalidate = True)
+
+        provider.get_tile_png (15, 20, 30)
+
+        upstream.data = b"version 2"
+        self.assertEqual (provider.get_tile_png (15, 20, 30), b"version 1")
+
+        provider.close ()
+        self.assertEqual (provider.get_tile_png (15, 20, 30), b"version 2")
+
+        # That started another revalidation, which must not write to the
+        # store while tearDown() removes it
+        provider.close ()
+
+class TestMBTilesTileProvider (unittest.TestCase):
+    def setUp (self):
+        self.path = tempfile.mkdtemp ()
+        self.filename = os.path.join (self.path, "null.mbtiles")
+
+        null_provider = NullTileProvider ()
+        store = tilecache.MBTilesTileStore (self.filename, 1024 * 1024)
+        store.put_tile (15, 20, 30, null_provider.get_tile_png (15, 20, 30))
+        store.close ()
+
+    def tearDown (self):
+        shutil.rmtree (self.path)
+
+    def test_reads_tiles_and_their_size (self):
+        provider = MBTilesTileProvider ({ 'mbtiles_filename' : self.filename })
+
+        provider.prefetch_tiles (15, 20, 30, 21, 31)
+        png_data = provider.get_tile_png (15, 20, 30)
+        provider.flush ()
+
+        tile_surf = cairo.ImageSurface.create_from_png (io.BytesIO (png_data))
+        self.assertEqual (tile_surf.get_width (), provider.get_tile_size ())
+        self.assertEqual (provider.get_tile_size (), 512)
+
+        with self.assertRaises (KeyError):
+            provider.get_tile_png (15, 21, 30)
+
+class TestMapboxTileProvider (unittest.TestCase):
+    def make_provider (self, status_code):
+        provider = MapboxTileProvider ({ 'mapbox_username' : 'user',
+                                         'mapbox_style_id' : 'style',
+                                         'mapbox_access_token' : 'token' })
+
+        class FakeSession:
+            def __init__ (self):
+                self.requests = 0
+
+            def get (self, url, params = None, headers = None):
+                self.requests += 1
+
+                r = requests.Response ()
+                r.status_code = status_code
+                r.url = url
+                r._content = b""
+                return r
+
+        provider.session = FakeSession ()
+        return provider
+
+    def test_fails_on_unexpected_statuses (self):
+        for status_code in (204, 404):
+            provider = self.make_provider (status_code)
+
+            with self.assertRaises (requests.HTTPError) as cm:
+                provider.get_tile_png (15, 20, 30)
+
+            self.assertEqual (cm.exception.response.status_code, status_code)
+            self.assertEqual (provider.session.requests, 1)
+
+class TestSharedSession (unittest.TestCase):
+    def test_providers_share_one_session (self):
+        mapbox = MapboxTileProvider ({ 'mapbox_username' : 'user',
+                                       'mapbox_style_id' : 'style',
+                                       'mapbox_access_token' : 'token' })
+        tilestache = TileStacheTileProvider ({ 'tilestache_host' : '127.0.0.1',
+                                               'tilestache_port' : '8080' })
+
+        self.assertIs (mapbox.session, tilestache.session)
+        self.assertIs (mapbox.session, get_shared_session ())
+
+    def test_providers_share_request_limits (self):
+        config = { 'mapbox_username' : 'user',
+                   'mapbox_style_id' : 'style',
+                   'mapbox_access_token' : 'token',
+                   'requests_per_second' : 7 }
+
+        first = MapboxTileProvider (config)
+        second = MapboxTileProvider (dict (config, mapbox_style_id = 'other'))
+
+        self.assertIs (first.rate_limiter, second.rate_limiter)
+        self.assertIs (first.concurrency, second.concurrency)
+
+        other = MapboxTileProvider (dict (config, requests_per_second = 3))
+        self.assertIsNot (first.rate_limiter, other.rate_limiter)
+
+    def test_splits_request_limits_among_processes (self):
+        config = { 'requests_per_second' : 10, 'http_pool_size' : 16 }
+
+        self.assertIs (split_request_limits (config, 1), config)
+
+        split = split_request_limits (config, 4)
+        self.assertEqual (split['requests_per_second'], 2.5)
+        self.assertEqual (split['max_concurrent_requests'], 4)
+        self.assertEqual (split_request_limits (config, 32)['max_concurrent_requests'], 1)
+
+    def test_session_pool_has_the_requested_size (self):
+        session = get_shared_session (3)
+        adapter = session.get_adapter ("https://api.mapbox.com/")
+        self.assertEqual (adapter._pool_maxsize, 3)
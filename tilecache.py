@@ -0,0 +1,506 @@
+import os
+import collections
+import json
+import sqlite3
+import time
+import tempfile
+import threading
+import shutil
+import unittest
+
+default_max_cache_size_mb = 2048
+
+# Stores tiles as z/x/y.png files under a directory.  Each provider/style
+# should get its own directory; see TileProvider.get_cache_namespace().
+#
+# The total size of the tiles is kept under max_size_bytes by evicting
+# the least recently used tiles.  Use is tracked with the files'
+# modification times, so the order survives across runs.
+#
+# The sizes and the use order are only scanned from the disk once, and
+# then kept in memory, so the store is meant for a single process.
+# Several processes can share the directory safely, but each one only
+# evicts the tiles it knows about, and together they can go past
+# max_size_bytes.  MBTilesTileStore keeps the sizes in the file, and is
+# the one to use for parallel renders.
+#
+class DirectoryTileStore:
+    def __init__ (self, path, max_size_bytes):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+
+        self.lock = threading.Lock ()
+
+        # (z, x, y) -> size in bytes, from least to most recently used.
+        # This gets filled lazily the first time we need it.
+        self.entries = None
+        self.total_size = 0
+
+    def get_tile_filename (self, z, x, y):
+        return os.path.join (self.path, str (z), str (x), "{0}.png".format (y))
+
+    # Each tile's metadata (HTTP validators and such) lives in a small
+    # JSON file next to it.
+    def get_metadata_filename (self, z, x, y):
+        return os.path.join (self.path, str (z), str (x), "{0}.json".format (y))
+
+    # Write to a temporary file and rename it into place, so that an
+    # interrupted run or a concurrent reader never sees a half-written file.
+    def write_atomically (self, filename, data):
+        dirname = os.path.dirname (filename)
+        os.makedirs (dirname, exist_ok = True)
+
+        (fd, tmp_filename) = tempfile.mkstemp (dir = dirname, suffix = ".tmp")
+        try:
+            with os.fdopen (fd, "wb") as f:
+                f.write (data)
+            os.replace (tmp_filename, filename)
+        except:
+            os.unlink (tmp_filename)
+            raise
+
+    def scan_entries (self):
+        found = []
+
+        for (dirpath, dirnames, filenames) in os.walk (self.path):
+            for filename in filenames:
+                if not filename.endswith (".png"):
+                    continue
+
+                full_path = os.path.join (dirpath, filename)
+                try:
+                    z = int (os.path.basename (os.path.dirname (dirpath)))
+                    x = int (os.path.basename (dirpath))
+                    y = int (filename[:-4])
+                    st = os.stat (full_path)
+                except (ValueError, OSError):
+                    continue
+
+                found.append ((st.st_mtime, (z, x, y), st.st_size))
+
+        found.sort ()
+
+        self.entries = collections.OrderedDict ()
+        self.total_size = 0
+
+        for (mtime, key, size) in found:
+            self.entries[key] = size
+            self.total_size += size
+
+    def ensure_entries (self):
+        if self.entries is None:
+            self.scan_entries ()
+
+    def has_tile (self, z, x, y):
+        return os.path.exists (self.get_tile_filename (z, x, y))
+
+    # Returns the PNG data for a tile, or None if it is not in the cache
+    def get_tile (self, z, x, y):
+        filename = self.get_tile_filename (z, x, y)
+
+        try:
+            with open (filename, "rb") as f:
+                data = f.read ()
+        except FileNotFoundError:
+            return None
+
+        with self.lock:
+            self.ensure_entries ()
+
+            try:
+                os.utime (filename)
+            except OSError:
+                pass
+
+            key = (z, x, y)
+            if key in self.entries:
+                self.entries.move_to_end (key)
+
+        return data
+
+    def put_tile (self, z, x, y, data):
+        self.write_atomically (self.get_tile_filename (z, x, y), data)
+
+        with self.lock:
+            self.ensure_entries ()
+
+            key = (z, x, y)
+            if key in self.entries:
+                self.total_size -= self.entries[key]
+
+            self.entries[key] = len (data)
+            self.entries.move_to_end (key)
+            self.total_size += len (data)
+
+            self.evict ()
+
+    # Assumes that the lock is held
+    def evict (self):
+        while self.total_size > self.max_size_bytes and len (self.entries) > 1:
+            ((z, x, y), size) = self.entries.popitem (last = False)
+            self.total_size -= size
+
+            for filename in (self.get_tile_filename (z, x, y), self.get_metadata_filename (z, x, y)):
+                try:
+                    os.unlink (filename)
+                except FileNotFoundError:
+                    pass
+
+    # Returns the dict that was stored with put_tile_metadata(), or None
+    def get_tile_metadata (self, z, x, y):
+        try:
+            with open (self.get_metadata_filename (z, x, y), "rb") as f:
+                return json.loads (f.read ().decode ("utf-8"))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put_tile_metadata (self, z, x, y, metadata):
+        self.write_atomically (self.get_metadata_filename (z, x, y), json.dumps (metadata).encode ("utf-8"))
+
+    def prefetch_tiles (self, z, west_x, north_y, east_x, south_y):
+        pass
+
+    def flush (self):
+        pass
+
+# MBTiles numbers tile rows from the south, like TMS, while we number them
+# from the north like the slippy map tiles.
+def flip_tile_row (z, y):
+    return (2 ** z - 1) - y
+
+# Keeps tiles in a single SQLite file with the standard MBTiles schema,
+# so that a city's worth of tiles is one file instead of many thousands.
+#
+# New tiles are kept in memory until flush(), which writes them all in a
+# single transaction; the renderer calls it once per map.  A whole map's
+# worth of tiles can be loaded with one indexed range query through
+# prefetch_tiles().
+#
+# Pass None for max_size_bytes to open an existing file read-only.
+#
+class MBTilesTileStore:
+    # Write pending tiles even before flush() once there are this many,
+    # so that memory use stays bounded for huge maps.
+    max_pending_tiles = 256
+
+    def __init__ (self, filename, max_size_bytes):
+        self.filename = filename
+        self.max_size_bytes = max_size_bytes
+        self.read_only = max_size_bytes is None
+
+        self.lock = threading.Lock ()
+
+        if self.read_only:
+            self.db = sqlite3.connect ("file:{0}?mode=ro".format (filename), uri = True, check_same_thread = False)
+        else:
+            os.makedirs (os.path.dirname (os.path.abspath (filename)), exist_ok = True)
+            self.db = sqlite3.connect (filename, check_same_thread = False)
+            self.create_tables ()
+
+        self.prefetched = {}
+        self.pending = {}
+        self.pending_metadata = {}
+        self.touched = set ()
+
+    def create_tables (self):
+        with self.db:
+            self.db.execute ("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+            self.db.execute ("CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name)")
+
+            # last_used is our own addition for evicting old tiles; MBTiles
+            # readers only look at the standard columns.
+            self.db.execute ("CREATE TABLE IF NOT EXISTS tiles ("
+                             "zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,"
+                             "tile_data BLOB, last_used REAL)")
+            self.db.execute ("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)")
+
+            # Also our own addition, for HTTP validators and such
+            self.db.execute ("CREATE TABLE IF NOT EXISTS lamaperia_tile_metadata ("
+                             "zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, metadata TEXT)")
+            self.db.execute ("CREATE UNIQUE INDEX IF NOT EXISTS lamaperia_tile_metadata_index "
+                             "ON lamaperia_tile_metadata (zoom_level, tile_column, tile_row)")
+
+            name = os.path.splitext (os.path.basename (self.filename))[0]
+            self.db.execute ("INSERT OR IGNORE INTO metadata (name, value) VALUES ('name', ?)", (name,))
+            self.db.execute ("INSERT OR IGNORE INTO metadata (name, value) VALUES ('format', 'png')")
+
+    def has_tile (self, z, x, y):
+        return self.get_tile (z, x, y) is not None
+
+    # Loads all the tiles in the given range of tile numbers (inclusive)
+    # with a single query, so that get_tile() doesn't have to go to
+    # the database for each of them.
+    def prefetch_tiles (self, z, west_x, north_y, east_x, south_y):
+        with self.lock:
+            rows = self.db.execute ("SELECT tile_column, tile_row, tile_data FROM tiles "
+                                    "WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?",
+                                    (z, west_x, east_x, flip_tile_row (z, south_y), flip_tile_row (z, north_y)))
+
+            for (x, row, data) in rows:
+                self.prefetched[(z, x, flip_tile_row (z, row))] = bytes (data)
+
+    def get_tile (self, z, x, y):
+        key = (z, x, y)
+
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+
+            data = self.prefetched.get (key)
+            if data is None:
+                row = self.db.execute ("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                       (z, x, flip_tile_row (z, y))).fetchone ()
+                if row is None:
+                    return None
+
+                data = bytes (row[0])
+
+            if not self.read_only:
+                self.touched.add (key)
+
+            return data
+
+    def put_tile (self, z, x, y, data):
+        assert not self.read_only
+
+        with self.lock:
+            self.pending[(z, x, y)] = data
+
+            if len (self.pending) + len (self.pending_metadata) >= self.max_pending_tiles:
+                self.write_pending ()
+
+    # Assumes that the lock is held
+    def write_pending (self):
+        now = time.time ()
+
+        with self.db:
+            self.db.executemany ("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, last_used) "
+                                 "VALUES (?, ?, ?, ?, ?)",
+                                 [(z, x, flip_tile_row (z, y), data, now) for ((z, x, y), data) in self.pending.items ()])
+
+            self.db.executemany ("UPDATE tiles SET last_used = ? WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                 [(now, z, x, flip_tile_row (z, y)) for (z, x, y) in self.touched])
+
+            self.db.executemany ("INSERT OR REPLACE INTO lamaperia_tile_metadata (zoom_level, tile_column, tile_row, metadata) "
+                                 "VALUES (?, ?, ?, ?)",
+                                 [(z, x, flip_tile_row (z, y), json.dumps (metadata))
+                                  for ((z, x, y), metadata) in self.pending_metadata.items ()])
+
+            self.evict ()
+
+        self.pending = {}
+        self.pending_metadata = {}
+        self.touched = set ()
+
+    # Assumes that the lock is held, and that we are inside a transaction
+    def evict (self):
+        (total_size,) = self.db.execute ("SELECT TOTAL(LENGTH(tile_data)) FROM tiles").fetchone ()
+        if total_size <= self.max_size_bytes:
+            return
+
+        victims = []
+        rows = self.db.execute ("SELECT rowid, LENGTH(tile_data) FROM tiles ORDER BY last_used")
+        for (rowid, size) in rows:
+            if total_size <= self.max_size_bytes:
+                break
+
+            victims.append ((rowid,))
+            total_size -= size
+
+        self.db.executemany ("DELETE FROM tiles WHERE rowid = ?", victims)
+        self.db.execute ("DELETE FROM lamaperia_tile_metadata WHERE NOT EXISTS "
+                         "(SELECT 1 FROM tiles WHERE tiles.zoom_level = lamaperia_tile_metadata.zoom_level "
+                         "AND tiles.tile_column = lamaperia_tile_metadata.tile_column "
+                         "AND tiles.tile_row = lamaperia_tile_metadata.tile_row)")
+
+    def get_tile_metadata (self, z, x, y):
+        key = (z, x, y)
+
+        with self.lock:
+            if key in self.pending_metadata:
+                return self.pending_metadata[key]
+
+            try:
+                row = self.db.execute ("SELECT metadata FROM lamaperia_tile_metadata "
+                                       "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                       (z, x, flip_tile_row (z, y))).fetchone ()
+            except sqlite3.OperationalError:
+                # A plain MBTiles file opened read-only doesn't have our table
+                return None
+
+            if row is None:
+                return None
+
+            return json.loads (row[0])
+
+    def put_tile_metadata (self, z, x, y, metadata):
+        assert not self.read_only
+
+        with self.lock:
+            self.pending_metadata[(z, x, y)] = metadata
+
+    def flush (self):
+        with self.lock:
+            if not self.read_only:
+                self.write_pending ()
+
+            self.prefetched = {}
+
+    def close (self):
+        self.flush ()
+        self.db.close ()
+
+#################### tests ####################
+
+class TestDirectoryTileStore (unittest.TestCase):
+    def setUp (self):
+        self.path = tempfile.mkdtemp ()
+
+    def tearDown (self):
+        shutil.rmtree (self.path)
+
+    def test_returns_none_for_missing_tiles (self):
+        store = DirectoryTileStore (self.path, 1000)
+        self.assertIsNone (store.get_tile (15, 1, 2))
+        self.assertFalse (store.has_tile (15, 1, 2))
+
+    def test_roundtrips_tiles (self):
+        store = DirectoryTileStore (self.path, 1000)
+        store.put_tile (15, 1, 2, b"hello")
+
+        self.assertTrue (store.has_tile (15, 1, 2))
+        self.assertEqual (store.get_tile (15, 1, 2), b"hello")
+        self.assertTrue (os.path.exists (os.path.join (self.path, "15", "1", "2.png")))
+
+    def test_leaves_no_temporary_files (self):
+        store = DirectoryTileStore (self.path, 1000)
+        store.put_tile (15, 1, 2, b"hello")
+        store.put_tile (15, 1, 2, b"again")
+
+        self.assertEqual (os.listdir (os.path.join (self.path, "15", "1")), ["2.png"])
+        self.assertEqual (store.get_tile (15, 1, 2), b"again")
+
+    def test_evicts_least_recently_used_tiles (self):
+        store = DirectoryTileStore (self.path, 30)
+        store.put_tile (15, 0, 0, b"0123456789")
+        store.put_tile (15, 1, 0, b"0123456789")
+        store.put_tile (15, 2, 0, b"0123456789")
+
+        # Touch the first tile so that the second one is the oldest
+        store.get_tile (15, 0, 0)
+        store.put_tile (15, 3, 0, b"0123456789")
+
+        self.assertTrue (store.has_tile (15, 0, 0))
+        self.assertFalse (store.has_tile (15, 1, 0))
+        self.assertTrue (store.has_tile (15, 2, 0))
+        self.assertTrue (store.has_tile (15, 3, 0))
+        self.assertEqual (store.total_size, 30)
+
+    def test_roundtrips_tile_metadata (self):
+        store = DirectoryTileStore (self.path, 1000)
+        self.assertIsNone (store.get_tile_metadata (15, 1, 2))
+
+        store.put_tile (15, 1, 2, b"hello")
+        store.put_tile_metadata (15, 1, 2, { "etag" : "abc" })
+
+        self.assertEqual (store.get_tile_metadata (15, 1, 2), { "etag" : "abc" })
+
+    def test_evicts_metadata_with_its_tile (self):
+        store = DirectoryTileStore (self.path, 10)
+        store.put_tile (15, 0, 0, b"0123456789")
+        store.put_tile_metadata (15, 0, 0, { "etag" : "abc" })
+        store.put_tile (15, 1, 0, b"0123456789")
+
+        self.assertIsNone (store.get_tile_metadata (15, 0, 0))
+
+    def test_picks_up_existing_tiles_from_previous_runs (self):
+        store = DirectoryTileStore (self.path, 1000)
+        store.put_tile (15, 1, 2, b"hello")
+        store.put_tile (16, 3, 4, b"world!")
+
+        store = DirectoryTileStore (self.path, 1000)
+        store.ensure_entries ()
+
+        self.assertEqual (store.total_size, 11)
+        self.assertEqual (set (store.entries.keys ()), { (15, 1, 2), (16, 3, 4) })
+
+class TestMBTilesTileStore (unittest.TestCase):
+    def setUp (self):
+        self.path = tempfile.mkdtemp ()
+        self.filename = os.path.join (self.path, "tiles.mbtiles")
+
+    def tearDown (self):
+        shutil.rmtree (self.path)
+
+    def test_flips_tile_rows (self):
+        self.assertEqual (flip_tile_row (0, 0), 0)
+        self.assertEqual (flip_tile_row (2, 0), 3)
+        self.assertEqual (flip_tile_row (2, 3), 0)
+
+    def test_roundtrips_tiles_before_and_after_flushing (self):
+        store = MBTilesTileStore (self.filename, 1000)
+        self.assertIsNone (store.get_tile (15, 1, 2))
+
+        store.put_tile (15, 1, 2, b"hello")
+        self.assertEqual (store.get_tile (15, 1, 2), b"hello")
+
+        store.close ()
+
+        store = MBTilesTileStore (self.filename, None)
+        self.assertEqual (store.get_tile (15, 1, 2), b"hello")
+        self.assertIsNone (store.get_tile (15, 2, 1))
+
+    def test_uses_the_mbtiles_schema (self):
+        store = MBTilesTileStore (self.filename, 1000)
+        store.put_tile (2, 1, 0, b"hello")
+        store.close ()
+
+        db = sqlite3.connect (self.filename)
+        row = db.execute ("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles").fetchone ()
+        self.assertEqual (row, (2, 1, 3, b"hello"))
+        self.assertEqual (db.execute ("SELECT value FROM metadata WHERE name = 'format'").fetchone (), ("png",))
+        db.close ()
+
+    def test_roundtrips_tile_metadata (self):
+        store = MBTilesTileStore (self.filename, 1000)
+        self.assertIsNone (store.get_tile_metadata (15, 1, 2))
+
+        store.put_tile (15, 1, 2, b"hello")
+        store.put_tile_metadata (15, 1, 2, { "etag" : "abc" })
+        self.assertEqual (store.get_tile_metadata (15, 1, 2), { "etag" : "abc" })
+
+        store.close ()
+
+        store = MBTilesTileStore (self.filename, None)
+        self.assertEqual (store.get_tile_metadata (15, 1, 2), { "etag" : "abc" })
+
+    def test_prefetches_a_range_of_tiles (self):
+        store = MBTilesTileStore (self.filename, 1000)
+        for y in range (10, 13):
+            for x in range (20, 23):
+                store.put_tile (15, x, y, "{0},{1}".format (x, y).encode ())
+        store.flush ()
+
+        store.prefetch_tiles (15, 20, 11, 21, 12)
+        self.assertEqual (set (store.prefetched.keys ()),
+                          { (15, 20, 11), (15, 21, 11), (15, 20, 12), (15, 21, 12) })
+        self.assertEqual (store.get_tile (15, 21, 12), b"21,12")
+
+        # Tiles outside the prefetched range are still available
+        self.assertEqual (store.get_tile (15, 22, 10), b"22,10")
+
+    def test_evicts_least_recently_used_tiles (self):
+        store = MBTilesTileStore (self.filename, 30)
+        store.put_tile (15, 0, 0, b"0123456789")
+        store.put_tile (15, 1, 0, b"0123456789")
+        store.put_tile (15, 2, 0, b"0123456789")
+        store.flush ()
+
+        time.sleep (0.01)
+        store.get_tile (15, 0, 0)
+        store.put_tile (15, 3, 0, b"0123456789")
+        store.flush ()
+
+        self.assertTrue (store.has_tile (15, 0, 0))
+        self.assertFalse (store.has_tile (15, 1, 0))
+        self.assertTrue (store.has_tile (15, 3, 0))
@@ -1,4 +1,6 @@
 import math
+import time
+import numpy
 import testutils
 
 # stolen from https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
@@ -33,6 +35,68 @@ def compute_real_world_mm_per_tile (latitude, zoom):
     mm_per_tile = meridian_length / tiles_around_the_earth
     return mm_per_tile
 
+# Array versions of the functions above, for transforming thousands or
+# millions of points at once.  They take NumPy arrays (or anything that
+# numpy.asarray() accepts) and return float64 arrays; the results match
+# the scalar functions to within floating-point tolerance.
+
+def coordinates_to_tile_and_fraction_array (z, lat, lon):
+    lat_rad = numpy.radians (numpy.asarray (lat, dtype = numpy.float64))
+    lon = numpy.asarray (lon, dtype = numpy.float64)
+
+    n = 2.0 ** z
+    xtile = (lon + 180.0) / 360.0 * n
+    ytile = (1.0 - numpy.log (numpy.tan (lat_rad) + (1 / numpy.cos (lat_rad))) / math.pi) / 2.0 * n
+    return (xtile, ytile)
+
+def tile_number_to_coordinates_array (z, xtile, ytile):
+    xtile = numpy.asarray (xtile, dtype = numpy.float64)
+    ytile = numpy.asarray (ytile, dtype = numpy.float64)
+
+    n = 2.0 ** z
+    lon_deg = xtile / n * 360.0 - 180.0
+    lat_rad = numpy.arctan (numpy.sinh (math.pi * (1 - 2 * ytile / n)))
+    lat_deg = numpy.degrees (lat_rad)
+    return (lat_deg, lon_deg)
+
+def compute_real_world_mm_per_tile_array (latitude, zoom):
+    lat_rad = numpy.radians (numpy.asarray (latitude, dtype = numpy.float64))
+
+    circumference_at_equator = 40075016686 # millimeters
+    meridian_length = circumference_at_equator * numpy.cos (lat_rad)
+    tiles_around_the_earth = 2 ** zoom
+
+    return meridian_length / tiles_around_the_earth
+
+# Compares the scalar and array functions on num_points random points:
+# checks that they agree, and prints how long each one takes.
+def benchmark (num_points = 1000000, z = 15):
+    random = numpy.random.default_rng (42)
+    lat = random.uniform (-85.0, 85.0, num_points)
+    lon = random.uniform (-180.0, 180.0, num_points)
+
+    lat_list = lat.tolist ()
+    lon_list = lon.tolist ()
+
+    start = time.perf_counter ()
+    tiles = [coordinates_to_tile_and_fraction (z, a, b) for (a, b) in zip (lat_list, lon_list)]
+    coords = [tile_number_to_coordinates (z, x, y) for (x, y) in tiles]
+    scale = [compute_real_world_mm_per_tile (a, z) for a in lat_list]
+    scalar_s = time.perf_counter () - start
+
+    start = time.perf_counter ()
+    (xtile, ytile) = coordinates_to_tile_and_fraction_array (z, lat, lon)
+    (lat2, lon2) = tile_number_to_coordinates_array (z, xtile, ytile)
+    scale2 = compute_real_world_mm_per_tile_array (lat, z)
+    array_s = time.perf_counter () - start
+
+    assert numpy.allclose (numpy.array (tiles), numpy.column_stack ((xtile, ytile)), rtol = 1e-12, atol = 0)
+    assert numpy.allclose (numpy.array (coords), numpy.column_stack ((lat2, lon2)), rtol = 0, atol = 1e-9)
+    assert numpy.allclose (numpy.array (scale), scale2, rtol = 1e-12, atol = 0)
+
+    print ("{0} points: scalar {1:.3f} s, arrays {2:.3f} s, {3:.0f}x faster".format (num_points, scalar_s, array_s,
+                                                                                  scalar_s / array_s))
+
 #################### tests ####################
 
 class TestTileCoords (testutils.TestCaseHelper):
@@ -59,3 +123,33 @@ class TestTileCoords (testutils.TestCaseHelper):
 
         self.assertFloatEquals (tile_x, expected_tile_x)
         self.assertFloatEquals (tile_y, expected_tile_y)
+
+    def test_array_functions_match_scalar_functions (self):
+        random = numpy.random.default_rng (1)
+        lat = random.uniform (-85.0, 85.0, 1000)
+        lon = random.uniform (-180.0, 180.0, 1000)
+
+        for zoom in (0, 10, 15, 19):
+            (xtile, ytile) = coordinates_to_tile_and_fraction_array (zoom, lat, lon)
+            (lat2, lon2) = tile_number_to_coordinates_array (zoom, xtile, ytile)
+            mm_per_tile = compute_real_world_mm_per_tile_array (lat, zoom)
+
+            for i in range (len (lat)):
+                (x, y) = coordinates_to_tile_and_fraction (zoom, lat[i], lon[i])
+                self.assertAlmostEqual (xtile[i], x, delta = abs (x) * 1e-12)
+                self.assertAlmostEqual (ytile[i], y, delta = abs (y) * 1e-12)
+
+                (a, b) = tile_number_to_coordinates (zoom, x, y)
+                self.assertAlmostEqual (lat2[i], a, delta = 1e-9)
+                self.assertAlmostEqual (lon2[i], b, delta = 1e-9)
+
+                self.assertAlmostEqual (mm_per_tile[i], compute_real_world_mm_per_tile (lat[i], zoom),
+                                        delta = mm_per_tile[i] * 1e-12)
+
+    def test_array_functions_accept_lists (self):
+        (xtile, ytile) = coordinates_to_tile_and_fraction_array (15, [19.4621106], [-96.9040473])
+
+        self.assertEqual ((int (xtile[0]), int (ytile[0])), (7563, 14577))
+
+if __name__ == "__main__":
+    benchmark ()
@@ -0,0 +1,227 @@
+import collections
+import concurrent.futures
+import io
+import unittest
+import multiprocessing
+import multiprocessing.util
+from multiprocessing import shared_memory, resource_tracker
+import cairo
+
+# Decodes tile PNGs in a pool of worker processes, so that decoding a big
+# map uses all the CPU cores instead of one thread holding the GIL.
+#
+# The workers write the decoded pixels straight into slots of a shared
+# memory block, and the main process wraps each slot with
+# cairo.ImageSurface.create_for_data(), so the pixels never get copied
+# or pickled on their way back.
+
+default_decode_processes = 0
+
+# The workers get started while tilefetcher's download threads are
+# running, and forking a process with threads that hold locks is unsafe,
+# so they come from a fork server instead.
+worker_start_method = "forkserver"
+
+# Set in each worker process by attach_to_shared_memory()
+worker_shared_memory = None
+
+# The main process owns the shared memory block and unlinks it.  Before
+# Python 3.13, attaching to a block also registers it with the resource
+# tracker, which then warns about a leak or unlinks the block when the
+# worker exits if the worker has a tracker of its own.  With the fork
+# server the workers share the main process's tracker instead, and
+# unregistering the block after attaching would drop the main process's
+# registration.  So the worker attaches without registering at all.
+#
+def attach_to_shared_memory (name):
+    global worker_shared_memory
+
+    try:
+        worker_shared_memory = shared_memory.SharedMemory (name = name, track = False)
+    except TypeError:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+
+        try:
+            worker_shared_memory = shared_memory.SharedMemory (name = name)
+        finally:
+            resource_tracker.register = register
+
+    multiprocessing.util.Finalize (None, worker_shared_memory.close, exitpriority = 0)
+
+# Runs in a worker process.  Decodes png_data and copies the pixels into
+# the shared memory slot at offset.  Returns (format, width, height,
+# stride, None), or (format, width, height, stride, pixels) if the tile
+# is too big for the slot and the pixels had to come back the slow way.
+#
+def decode_into_slot (png_data, offset, slot_size):
+    surface = cairo.ImageSurface.create_from_png (io.BytesIO (png_data))
+    surface.flush ()
+
+    width = surface.get_width ()
+    height = surface.get_height ()
+    stride = surface.get_stride ()
+    data = surface.get_data ()
+
+    size = stride * height
+
+    if size > slot_size:
+        return (surface.get_format (), width, height, stride, bytes (data))
+
+    worker_shared_memory.buf[offset : offset + size] = data
+    return (surface.get_format (), width, height, stride, None)
+
+def decode_png (png_data):
+    return cairo.ImageSurface.create_from_png (io.BytesIO (png_data))
+
+# Returns a copy of a surface from TileDecoder.decode_tiles() that stays
+# valid after its slot gets reused.
+def copy_surface (surface):
+    copy = cairo.ImageSurface (surface.get_format (), surface.get_width (), surface.get_height ())
+
+    cr = cairo.Context (copy)
+    cr.set_source_surface (surface, 0, 0)
+    cr.set_operator (cairo.OPERATOR_SOURCE)
+    cr.paint ()
+    del cr
+
+    copy.flush ()
+    return copy
+
+class TileDecoder:
+    # tile_size is the expected width and height of the tiles in pixels;
+    # it determines the size of the shared memory slots.
+    def __init__ (self, num_processes, tile_size):
+        self.num_processes = num_processes
+
+        # Enough slots to keep all the workers busy while the caller paints
+        # the tiles at the head of the queue.
+        self.num_slots = num_processes * 2
+        self.slot_size = cairo.ImageSurface.format_stride_for_width (cairo.FORMAT_ARGB32, tile_size) * tile_size
+
+        self.shared_memory = shared_memory.SharedMemory (create = True, size = self.num_slots * self.slot_size)
+        self.slot_buffers = [self.shared_memory.buf[i * self.slot_size : (i + 1) * self.slot_size]
+                             for i in range (self.num_slots)]
+
+        self.executor = concurrent.futures.ProcessPoolExecutor (max_workers = num_processes,
+                                                                mp_context = multiprocessing.get_context (worker_start_method),
+                                                                initializer = attach_to_shared_memory,
+                                                                initargs = (self.shared_memory.name,))
+
+    # Takes an iterator of (x, y, png_data), like the one from
+    # tilefetcher.fetch_tiles(), and yields (x, y, surface) in the same
+    # order.  A surface is only valid until the next one is requested,
+    # since its pixels live in a slot that gets reused; use copy_surface()
+    # to keep it.
+    #
+    def decode_tiles (self, tiles):
+        free_slots = collections.deque (range (self.num_slots))
+        pending = collections.deque ()
+
+        try:
+            for (x, y, png_data) in tiles:
+                if len (free_slots) == 0:
+                    yield from self.yield_decoded_tile (pending, free_slots)
+
+                slot = free_slots.popleft ()
+                future = self.executor.submit (decode_into_slot, png_data, slot * self.slot_size, self.slot_size)
+                pending.append ((x, y, slot, future))
+
+            while len (pending) > 0:
+                yield from self.yield_decoded_tile (pending, free_slots)
+        finally:
+            for (x, y, slot, future) in pending:
+                future.cancel ()
+
+            # Let workers that are still writing to their slots finish
+            concurrent.futures.wait ([future for (x, y, slot, future) in pending])
+
+    def yield_decoded_tile (self, pending, free_slots):
+        (x, y, slot, future) = pending.popleft ()
+        (format, width, height, stride, pixels) = future.result ()
+
+        if pixels is not None:
+            surface = cairo.ImageSurface.create_for_data (bytearray (pixels), format, width, height, stride)
+            yield (x, y, surface)
+        else:
+            surface = cairo.ImageSurface.create_for_data (self.slot_buffers[slot], format, width, height, stride)
+
+            try:
+                yield (x, y, surface)
+            finally:
+                # PDF and SVG surfaces keep a reference to the source
+                # surfaces that were painted on them.  Finishing the surface
+                # makes cairo copy the pixels for them before the slot gets
+                # overwritten.
+                surface.finish ()
+
+        free_slots.append (slot)
+
+    def close (self):
+        self.executor.shutdown (wait = True)
+
+        self.shared_memory.unlink ()
+
+        # If the caller still holds on to a surface, its slot stays mapped
+        # until the surface gets freed.
+        try:
+            for buf in self.slot_buffers:
+                buf.release ()
+
+            self.shared_memory.close ()
+        except BufferError:
+            pass
+
+#################### tests ####################
+
+class TestTileDecoder (unittest.TestCase):
+    def make_tiles (self, num_tiles):
+        f = open ("null-tile-512.png", "rb")
+        png_data = f.read ()
+        f.close ()
+
+        return [(x, 0, png_data) for x in range (num_tiles)]
+
+    def test_decodes_tiles_in_order (self):
+        tiles = self.make_tiles (10)
+        expected = bytes (decode_png (tiles[0][2]).get_data ())
+
+        decoder = TileDecoder (2, 512)
+
+        try:
+            decoded = []
+            for (x, y, surface) in decoder.decode_tiles (iter (tiles)):
+                self.assertEqual ((surface.get_width (), surface.get_height ()), (512, 512))
+                self.assertEqual (bytes (surface.get_data ()), expected)
+                decoded.append ((x, y))
+        finally:
+            decoder.close ()
+
+        self.assertEqual (decoded, [(x, y) for (x, y, png_data) in tiles])
+
+    def test_falls_back_for_tiles_bigger_than_slots (self):
+        tiles = self.make_tiles (3)
+        expected = bytes (decode_png (tiles[0][2]).get_data ())
+
+        decoder = TileDecoder (1, 256)
+
+        try:
+            for (x, y, surface) in decoder.decode_tiles (iter (tiles)):
+                self.assertEqual (bytes (surface.get_data ()), expected)
+        finally:
+            decoder.close ()
+
+    def test_copied_surface_outlives_its_slot (self):
+        tiles = self.make_tiles (5)
+
+        decoder = TileDecoder (1, 512)
+
+        try:
+            copies = [copy_surface (surface) for (x, y, surface) in decoder.decode_tiles (iter (tiles))]
+        finally:
+            decoder.close ()
+
+        expected = bytes (decode_png (tiles[0][2]).get_data ())
+
+        for copy in copies:
+            self.assertEqual (bytes (copy.get_data ()), expected)
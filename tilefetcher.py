@@ -0,0 +1,117 @@
+import collections
+import concurrent.futures
+import threading
+import time
+import unittest
+
+default_max_tiles_in_flight = 8
+
+# Fetches the PNG data for a sequence of (x, y) tile numbers at zoom
+# level z, with a bounded pool of worker threads.  Yields (x, y,
+# png_data) tuples in the same order as tile_coords, so callers that
+# paint tiles as they arrive produce the same output on every run.
+#
+# max_in_flight worker threads download tiles, and up to the same
+# number of requests are kept queued behind them so that the workers
+# don't go idle while the caller is busy decoding a slow tile at the
+# head of the queue.
+#
+def fetch_tiles (provider, z, tile_coords, max_in_flight = default_max_tiles_in_flight):
+    if max_in_flight <= 1:
+        for (x, y) in tile_coords:
+            yield (x, y, provider.get_tile_png (z, x, y))
+        return
+
+    window = max_in_flight * 2
+    pending = collections.deque ()
+
+    executor = concurrent.futures.ThreadPoolExecutor (max_workers = max_in_flight)
+
+    try:
+        for (x, y) in tile_coords:
+            pending.append ((x, y, executor.submit (provider.get_tile_png, z, x, y)))
+
+            if len (pending) >= window:
+                (tx, ty, future) = pending.popleft ()
+                yield (tx, ty, future.result ())
+
+        while len (pending) > 0:
+            (tx, ty, future) = pending.popleft ()
+            yield (tx, ty, future.result ())
+    finally:
+        # If the caller stopped early or a download failed, don't wait
+        # for requests that nobody is going to look at.
+        for (tx, ty, future) in pending:
+            future.cancel ()
+
+        executor.shutdown (wait = True)
+
+#################### tests ####################
+
+class SlowTileProvider:
+    def __init__ (self):
+        self.lock = threading.Lock ()
+        self.in_flight = 0
+        self.max_in_flight_seen = 0
+        self.requested = []
+
+    def get_tile_png (self, z, x, y):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight_seen = max (self.max_in_flight_seen, self.in_flight)
+            self.requested.append ((x, y))
+
+        # Make later tiles finish first, to check that the output order
+        # doesn't depend on completion order.
+        time.sleep (0.001 * ((7 - x) % 4))
+
+        with self.lock:
+            self.in_flight -= 1
+
+        return "{0}/{1}/{2}".format (z, x, y).encode ()
+
+    def get_tile_size (self):
+        return 512
+
+class TestTileFetcher (unittest.TestCase):
+    def make_coords (self):
+        return [(x, y) for y in range (5) for x in range (8)]
+
+    def test_yields_tiles_in_request_order (self):
+        provider = SlowTileProvider ()
+        coords = self.make_coords ()
+
+        result = list (fetch_tiles (provider, 15, coords, max_in_flight = 4))
+
+        self.assertEqual ([(x, y) for (x, y, data) in result], coords)
+        for (x, y, data) in result:
+            self.assertEqual (data, "15/{0}/{1}".format (x, y).encode ())
+
+    def test_limits_number_of_requests_in_flight (self):
+        provider = SlowTileProvider ()
+
+        list (fetch_tiles (provider, 15, self.make_coords (), max_in_flight = 3))
+
+        self.assertLessEqual (provider.max_in_flight_seen, 3)
+        self.assertEqual (len (provider.requested), 40)
+
+    def test_serial_fetching_works (self):
+        provider = SlowTileProvider ()
+        coords = self.make_coords ()
+
+        result = list (fetch_tiles (provider, 15, coords, max_in_flight = 1))
+
+        self.assertEqual ([(x, y) for (x, y, data) in result], coords)
+        self.assertEqual (provider.max_in_flight_seen, 1)
+
+    def test_propagates_download_errors (self):
+        class FailingTileProvider (SlowTileProvider):
+            def get_tile_png (self, z, x, y):
+                if (x, y) == (3, 2):
+                    raise IOError ("no such tile")
+                return SlowTileProvider.get_tile_png (self, z, x, y)
+
+        provider = FailingTileProvider ()
+
+        with self.assertRaises (IOError):
+            list (fetch_tiles (provider, 15, self.make_coords (), max_in_flight = 4))
@@ -21,11 +21,10 @@ class UTMRenderer:
         (x2, y2) = (layout.map_to_left_margin_mm + layout.map_width_mm,
                     layout.map_to_top_margin_mm + layout.map_height_mm)
 
-        (top_left_lat, top_left_lon) = self.geometry.transform_page_mm_to_lat_lon (x1, y1)
-        (top_right_lat, top_right_lon) = self.geometry.transform_page_mm_to_lat_lon (x2, y1)
+        (lats, lons) = self.geometry.transform_page_mm_to_lat_lon_array ([x1, x2, x1, x2], [y1, y1, y2, y2])
 
-        (bottom_left_lat, bottom_left_lon) = self.geometry.transform_page_mm_to_lat_lon (x1, y2)
-        (bottom_right_lat, bottom_right_lon) = self.geometry.transform_page_mm_to_lat_lon (x2, y2)
+        (top_left_lat, top_right_lat, bottom_left_lat, bottom_right_lat) = lats.tolist ()
+        (top_left_lon, top_right_lon, bottom_left_lon, bottom_right_lon) = lons.tolist ()
 
         top_left_zone = longitude_to_zone (top_left_lon)
         top_right_zone = longitude_to_zone (top_right_lon)